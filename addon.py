@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import collections
 import datetime
-import operator
+import io
+import os
 import sys
 
 import xbmc as kodi
@@ -10,17 +12,25 @@ import xbmcaddon as kodiaddon
 import xbmcgui as kodigui
 import xbmcplugin as kodiplugin
 
-from resources.lib import common, utils
-from resources.lib.db import (
-    AusisDatabase,
-    DB_FILE_NAME,
-)
+from resources.lib import chapters, common, search, tracks, utils
+from resources.lib.profiling import call_profiled, profiler
+
 
-by_file = operator.itemgetter('file')
+DEFAULT_PAGE_SIZE = 50
+EXPORT_FILE_NAME = 'ausis-bookmarks.%s'
 on_click_actions = {
     '0': 'resume_latest',
     '1': 'album_bookmarks',
 }
+BOOKMARK_NAMES = (
+    'started',
+    'paused',
+    'resumed',
+    'seeked',
+    'ended',
+    'stopped',
+    'checkpoint',
+)
 
 
 class Ausis(common.KodiPlugin):
@@ -38,172 +48,389 @@ class Ausis(common.KodiPlugin):
         'seeked': 30013,
         'ended': 30014,
         'stopped': 30015,
+        'checkpoint': 30025,
+        'next_page': 30022,
+        'progress': 30023,
+        'search': 30027,
+        'filter_results': 30028,
+        'search_field': 30029,
+        'any_field': 30030,
+        'title': 30031,
+        'artist': 30032,
+        'song': 30033,
+        'bookmark_type': 30034,
+        'any_bookmark': 30035,
+        'export_bookmarks': 30036,
+        'import_bookmarks': 30037,
+        'file_format': 30038,
+        'exported': 30039,
+        'imported': 30040,
+        'import_failed': 30041,
+        'export_failed': 30044,
     }
 
-    def __init__(self, base_url, handle, addon, db):
+    def __init__(self, base_url, handle, addon, open_db):
+        '''
+        :param open_db: a callable which returns an opened
+            :class:`resources.lib.db.AusisDatabase`. It is only called
+            once a mode uses the database.
+        '''
         super(Ausis, self).__init__(base_url, handle, addon)
-        self._db = db
+        self._open_db = open_db
+        self._db = None
+        self._cache = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_class, exc, traceback):
+        if self._db is not None:
+            self._db.__exit__(exc_class, exc, traceback)
+            self._db, self._cache = None, None
 
     @property
     def db(self):
+        if self._db is None:
+            self._db = self._open_db()
         return self._db
 
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = common.MetadataCache(
+                self.db,
+                common.get_cache_max_age(self._addon),
+                common.ALBUM_PROPERTIES,
+                common.SONG_PROPERTIES,
+            )
+        return self._cache
+
+    @property
+    def page_size(self):
+        try:
+            return max(1, int(self._addon.getSetting('page_size')))
+        except ValueError:
+            return DEFAULT_PAGE_SIZE
+
+    def run(self, args):
+        result = super(Ausis, self).run(args)
+        if self._cache is not None:
+            self.log('Metadata cache: %s' % dict(self._cache.stats))
+        common.rpc.log_stats(self.log)
+        if profiler.enabled:
+            profiler.log_summary(self._log_notice)
+        return result
+
+    def _log_notice(self, msg):
+        self.log(msg, level=kodi.LOGNOTICE)
+
+    def _get_page(self, args, iter_rows, *iter_args):
+        '''
+        Returns the rows of the page requested in `args` and the URL of
+        the next page (`None` on the last page).
+
+        `iter_rows` is called with `iter_args` and the `limit` and
+        `offset` of the page. One row more than the page size is fetched
+        to find out if there is a next page.
+        '''
+        try:
+            page = max(0, int(args.get('page', 0)))
+        except ValueError:
+            page = 0
+        rows = list(iter_rows(
+            *iter_args, limit=self.page_size + 1,
+            offset=page * self.page_size))
+        next_url = None
+        if len(rows) > self.page_size:
+            next_url = self._build_url(**dict(args, page=page + 1))
+        return rows[:self.page_size], next_url
+
+    def _next_page_item(self, url):
+        return url, self._list_item(self._t('next_page')), True
+
+    def _format_progress(self, position, duration):
+        '''Formats the progress within a whole book, if it is known.'''
+        if duration <= 0:
+            return None
+        position = max(0, min(position, duration))
+        return self._t('progress').format(
+            percent=int(100 * position / duration),
+            remaining=utils.format_duration(duration - position),
+        )
+
     def mode_main(self, args):
-        albums = self.db.get_albums()
+        albums, next_url = self._get_page(args, self.db.iter_albums)
+
+        items = []
+        if not args.get('page'):
+            items.append((
+                self._build_url(mode='search'),
+                self._list_item(self._t('search')),
+                True,
+            ))
+        items.extend(self._album_items(albums))
+        if next_url:
+            items.append(self._next_page_item(next_url))
+        self._add_items(items)
+        kodiplugin.endOfDirectory(self._handle)
 
+    def _album_items(self, albums):
+        '''Returns the directory items of albums given by a bookmark.'''
         mode = on_click_actions.get(
             self._addon.getSetting('on_audiobook_click'), 'resume_latest')
 
+        albums_info = self.cache.get_albums(
+            bookmark.album_id for bookmark in albums)
+        albums_progress = self.db.get_albums_progress(
+            bookmark.album_id for bookmark in albums)
+
+        items = []
         for bookmark in albums:
             url = self._build_url(mode=mode, album_id=bookmark.album_id)
-            album_info = common.json_rpc(
-                'AudioLibrary.GetAlbumDetails',
-                albumid=bookmark.album_id,
-                properties=[
-                    'title',
-                    'artist',
-                    'fanart',
-                    'thumbnail',
-                    'dateadded',
-                ],
-            ).get('result', {}).get('albumdetails', {})
+            album_info = albums_info.get(bookmark.album_id)
             if not album_info:
                 continue
 
             last_played = datetime.datetime.fromtimestamp(bookmark.date_added)
-            li = kodigui.ListItem(album_info['title'])
-
-            li.setArt({
-                'thumb': album_info.get('thumbnail'),
-                'fanart': album_info.get('fanart'),
-            })
-            li.setInfo('music', {
-                'artist': u', '.join(album_info.get('artist', [])),
-                'album': album_info['title'],
-                'genre': 'Audiobook',
-                'lastplayed': last_played.strftime(common.DATETIME_FORMAT),
-            })
-
-            context_menu = [(
-                self._t('remove_bookmarks'),
-                'RunPlugin(%s)' % self._build_url(
-                    mode='remove_album_bookmarks',
-                    album_id=bookmark.album_id,
-                ),
-            )]
-            li.addContextMenuItems(items=context_menu)
-
-            kodiplugin.addDirectoryItem(
-                handle=self._handle,
-                url=url,
-                listitem=li,
-                isFolder=True,
-                totalItems=len(albums),
+            progress = self._format_progress(
+                *albums_progress.get(bookmark.album_id, (0, 0)))
+            li = self._list_item(
+                album_info['title'],
+                label2=progress,
+                art={
+                    'thumb': album_info.get('thumbnail'),
+                    'fanart': album_info.get('fanart'),
+                },
+                info={
+                    'artist': u', '.join(album_info.get('artist', [])),
+                    'album': album_info['title'],
+                    'genre': 'Audiobook',
+                    'lastplayed': last_played.strftime(
+                        common.DATETIME_FORMAT),
+                    'comment': progress,
+                },
+                context_menu=[(
+                    self._t('remove_bookmarks'),
+                    'RunPlugin(%s)' % self._build_url(
+                        mode='remove_album_bookmarks',
+                        album_id=bookmark.album_id,
+                    ),
+                )],
             )
+            items.append((url, li, True))
+        return items
+
+    def _search_url(self, **kwargs):
+        return self._build_url(mode='search', **{
+            k: v for k, v in kwargs.items() if v})
+
+    def mode_search(self, args):
+        '''
+        Lists the albums matching the `query`, optionally only in one
+        `field` (see :data:`resources.lib.search.FIELDS`) and only those
+        with a bookmark of type `name`.
+
+        Asks for the query if it is not given.
+        '''
+        query = args.get('query')
+        if not query:
+            query = kodigui.Dialog().input(self._t('search'))
+            # Kodi waits for the listing of the folder, which is replaced
+            # by the results.
+            kodiplugin.endOfDirectory(self._handle, succeeded=False)
+            if query:
+                kodi.executebuiltin(
+                    'Container.Update(%s)' % self._search_url(query=query))
+            return
+
+        field = args.get('field')
+        if field not in search.FIELDS:
+            field = None
+        name = args.get('name') or None
+
+        # Albums and songs which were never listed are fetched once, so that
+        # all the albums with bookmarks can be found.
+        self.cache.get_albums(self.db.get_unindexed_album_ids())
+        if field in (None, 'song'):
+            self.cache.cache_albums_songs(
+                self.db.get_unindexed_album_ids(songs=True))
+        albums, next_url = self._get_page(
+            args, self.db.iter_search, query, field, name)
+
+        items = []
+        if not args.get('page'):
+            items.append((
+                self._build_url(
+                    mode='search_filter', query=query, field=field or '',
+                    name=name or ''),
+                self._list_item(self._t('filter_results')),
+                False,
+            ))
+        items.extend(self._album_items(albums))
+        if next_url:
+            items.append(self._next_page_item(next_url))
+        self._add_items(items)
         kodiplugin.endOfDirectory(self._handle)
 
+    def mode_search_filter(self, args):
+        '''Asks for the field and the bookmark type to filter a search by.'''
+        dialog = kodigui.Dialog()
+        fields = (None,) + search.FIELDS
+        field = dialog.select(
+            self._t('search_field'),
+            [self._t(f or 'any_field') for f in fields])
+        if field < 0:
+            return
+        names = (None,) + BOOKMARK_NAMES
+        name = dialog.select(
+            self._t('bookmark_type'),
+            [self._t(n or 'any_bookmark') for n in names])
+        if name < 0:
+            return
+        kodi.executebuiltin('Container.Update(%s,replace)' % self._search_url(
+            query=args.get('query'), field=fields[field], name=names[name]))
+
     def mode_album_bookmarks(self, args):
         album_id = args.get('album_id')
 
         if album_id is None:
             return kodi.log('album_id not set', level=kodi.LOGERROR)
 
-        bookmarks = self.db.get_album_bookmarks(album_id)
+        bookmarks, next_url = self._get_page(
+            args, self.db.iter_album_bookmarks, album_id)
+        album_songs = self.cache.get_album_songs(
+            int(album_id)) if bookmarks else []
+        songs_info = {song['songid']: song for song in album_songs}
+
+        items, file_chapters = [], {}
         for bookmark in bookmarks:
             url = self._build_url(
                 mode='resume', bookmark_id=bookmark.id)
-            song_info = common.json_rpc(
-                'AudioLibrary.GetSongDetails',
-                songid=bookmark.song_id,
-                properties=[
-                    'artist',
-                    'title',
-                    'duration',
-                    'thumbnail',
-                    'album',
-                    'track',
-                ],
-            ).get('result', {}).get('songdetails', {})
+            song_info = songs_info.get(bookmark.song_id)
             if not song_info:
                 continue
 
-            li = kodigui.ListItem(
+            title = song_info.get('title', '')
+            chapter = self._chapter_at(
+                song_info, bookmark.position, file_chapters)
+            if chapter is not None:
+                title = u'{0}: {1}'.format(title, chapter.title)
+            li = self._list_item(
                 u'[{name}] {title} ({position})'.format(
                     name=self._t(bookmark.name),
-                    position=utils.format_duration(bookmark.position),
-                    **song_info),
-                iconImage=song_info.get('thumbnail'),
-            )
-            li.setInfo('music', {
-                'duration': song_info.get('duration', 0),
-                'artist': u', '.join(song_info.get('artist', [])),
-                'album': song_info.get('album'),
-                'genre': 'Audiobook',
-                'tracknumber': song_info.get('track'),
-            })
-            kodiplugin.addDirectoryItem(
-                handle=self._handle,
-                url=url,
-                listitem=li,
-                isFolder=False,
-                totalItems=len(bookmarks),
+                    title=title,
+                    position=utils.format_duration(bookmark.position)),
+                icon=song_info.get('thumbnail'),
+                info={
+                    'duration': song_info.get('duration', 0),
+                    'artist': u', '.join(song_info.get('artist', [])),
+                    'album': song_info.get('album'),
+                    'genre': 'Audiobook',
+                    'tracknumber': song_info.get('track'),
+                },
             )
+            items.append((url, li, False))
+        if next_url:
+            items.append(self._next_page_item(next_url))
+        self._add_items(items)
         kodiplugin.endOfDirectory(self._handle)
 
+    def _chapter_at(self, song, position, file_chapters=None):
+        '''
+        Returns the chapter of a song at a position or `None`.
+
+        :param file_chapters: a dict of the chapters of the files looked
+            up before, which is filled in as new files are looked up.
+        '''
+        path = song.get('file')
+        if not path:
+            return None
+        if file_chapters is None:
+            file_chapters = {}
+        if path not in file_chapters:
+            file_chapters[path] = common.get_chapters(self.db, path)
+        song_chapters = file_chapters[path]
+        i = chapters.chapter_at(song_chapters, position)
+        return song_chapters[i] if i is not None else None
+
+    def _resume_position(self, song, position):
+        '''
+        Returns where to resume a song from a bookmark position: the start
+        of its chapter if set so in the settings.
+        '''
+        position = max(0.0, position)
+        if self._addon.getSetting('resume_chapter_start') == 'true':
+            chapter = self._chapter_at(song, position)
+            if chapter is not None:
+                return chapter.start
+        return position
+
+    def _song_list_item(self, song, offset=None):
+        # TODO(naglis): add more fields
+        music_info = {
+            'year': song.get('year'),
+            'artist': u', '.join(song.get('artist', [])),
+            'duration': song.get('duration'),
+            'title': song.get('title'),
+        }
+        if offset is not None:
+            music_info.update({
+                'comment': common.dump_comment({'offset': offset}),
+            })
+        li = self._list_item(song.get('title', ''), info=music_info)
+        if offset is not None:
+            li.setProperty('StartOffset', '{0:.2f}'.format(offset))
+        return li
+
     def mode_resume(self, args):
         bookmark_id = args.get('bookmark_id')
         if bookmark_id:
             bookmark = self.db.get_bookmark(bookmark_id)
             if not bookmark:
                 return kodi.log('Bookmark does not exist', level=kodi.LOGERROR)
-            album_songs = sorted(common.json_rpc(
-                'AudioLibrary.GetSongs',
-                # TODO(naglis): add more fields
-                properties=[
-                    'file',
-                    'artist',
-                    'title',
-                    'duration',
-                    'year',
-                ],
-                filter={
-                    'albumid': bookmark.album_id,
-                },
-            ).get('result', {}).get('songs', []), key=by_file)
+            album_songs = sorted(
+                self.cache.get_album_songs(bookmark.album_id),
+                key=tracks.playback_order)
 
             playlist = kodi.PlayList(kodi.PLAYLIST_MUSIC)
             playlist.clear()
 
-            playlist_pos = -1
-            for idx, item in enumerate(album_songs):
-                offset = None
-
-                li = kodigui.ListItem(item.get('title', ''))
-
-                if item['songid'] == bookmark.song_id:
-                    playlist_pos = idx
-                    offset = max(0.0, bookmark.position)
-                    li.setProperty('StartOffset', '{0:.2f}'.format(offset))
-
-                music_info = {
-                    'year': item.get('year'),
-                    'artist': u', '.join(item.get('artist', [])),
-                    'duration': item.get('duration'),
-                    'title': item.get('title'),
-                }
-
-                if offset is not None:
-                    music_info.update({
-                        'comment': common.dump_comment({'offset': offset}),
-                    })
-
-                # TODO(naglis): add more fields
-                # TODO(naglis): make nicer
-                li.setInfo('music', music_info)
-
-                playlist.add(item['file'], li)
-
-            kodi.Player().play(playlist, startpos=playlist_pos)
+            current = self.cache.get_track_index(
+                bookmark.album_id, songs=album_songs).track_of(
+                    bookmark.song_id)
+            if current is None or current >= len(album_songs) or (
+                    album_songs[current]['songid'] != bookmark.song_id):
+                # The songs changed since the index was stored.
+                current = next((
+                    track for track, song in enumerate(album_songs)
+                    if song['songid'] == bookmark.song_id
+                ), None)
+            if current is None:
+                for song in album_songs:
+                    playlist.add(song['file'], self._song_list_item(song))
+                return kodi.Player().play(playlist)
+
+            # Start playing the bookmarked song before building the rest
+            # of the playlist, which takes a while for long audiobooks.
+            song = album_songs[current]
+            playlist.add(song['file'], self._song_list_item(
+                song, offset=self._resume_position(song, bookmark.position)))
+            kodi.Player().play(playlist, startpos=0)
+
+            for song in album_songs[current + 1:]:
+                playlist.add(song['file'], self._song_list_item(song))
+            if current:
+                # Unlike xbmc.PlayList.add, Playlist.Insert keeps the
+                # position of the playing song in sync.
+                common.json_rpc(
+                    'Playlist.Insert',
+                    playlistid=kodi.PLAYLIST_MUSIC,
+                    position=0,
+                    item=[
+                        {'songid': song['songid']}
+                        for song in album_songs[:current]
+                    ],
+                )
 
     def mode_resume_latest(self, args):
         album_id = args.get('album_id')
@@ -211,8 +438,9 @@ class Ausis(common.KodiPlugin):
         if album_id is None:
             return kodi.log('album_id not set', level=kodi.LOGERROR)
 
-        latest_bookmark = utils.first_of(
-            self.db.get_album_bookmarks(album_id))
+        latest_bookmark = self.db.get_latest_album_bookmark(album_id)
+        if not latest_bookmark:
+            return kodi.log('Album has no bookmarks', level=kodi.LOGERROR)
         return self.mode_resume({
             'bookmark_id': latest_bookmark.id,
         })
@@ -235,15 +463,98 @@ class Ausis(common.KodiPlugin):
             self.db.remove_album_bookmarks(album_id)
             kodi.executebuiltin('Container.Refresh()')
 
+    def mode_export(self, args):
+        '''
+        Exports all the bookmarks to a file in a chosen directory, in a
+        chosen format (see :data:`resources.lib.transfer.FORMATS`).
+        '''
+        from resources.lib import transfer
+
+        dialog = kodigui.Dialog()
+        directory = dialog.browse(3, self._t('export_bookmarks'), 'files')
+        if not directory:
+            return
+        fmt = dialog.select(self._t('file_format'), list(transfer.FORMATS))
+        if fmt < 0:
+            return
+        fmt = transfer.FORMATS[fmt]
+        path = os.path.join(
+            kodi.translatePath(directory).decode('utf-8'),
+            EXPORT_FILE_NAME % fmt)
+
+        song_files = {
+            song['songid']: song['file']
+            for song in common.get_library_songs(['file'])
+        }
+        try:
+            with io.open(path, 'wb') as f:
+                count = transfer.write_rows(transfer.export_rows(
+                    self.db.iter_all_bookmarks(), song_files), f, fmt)
+        except IOError as e:
+            # Such as a network share chosen in the dialog, which io can
+            # not open.
+            self.log('Failed to export %s: %s' % (path, e),
+                     level=kodi.LOGERROR)
+            return dialog.notification(
+                self._t('export_bookmarks'), self._t('export_failed'))
+        dialog.notification(
+            self._t('export_bookmarks'),
+            self._t('exported').format(count=count))
+
+    def mode_import(self, args):
+        '''
+        Imports the bookmarks of a file written by :meth:`mode_export`,
+        possibly in another Kodi installation.
+
+        Songs are found by their file paths, since the IDs of the same
+        song differ between music libraries.
+        '''
+        from resources.lib import transfer
+
+        dialog = kodigui.Dialog()
+        path = dialog.browse(
+            1, self._t('import_bookmarks'), 'files',
+            '|'.join('.%s' % fmt for fmt in transfer.FORMATS))
+        if not path:
+            return
+        path = kodi.translatePath(path).decode('utf-8')
+        fmt = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+        songs_by_file = {
+            song['file']: (song['songid'], song['albumid'])
+            for song in common.get_library_songs(['file', 'albumid'])
+        }
+        stats = collections.Counter(added=0, duplicate=0, unknown=0)
+        try:
+            with io.open(path, 'rb') as f:
+                transfer.import_rows(self.db, transfer.remap_rows(
+                    transfer.read_rows(f, fmt), songs_by_file, stats), stats)
+        except (IOError, ValueError) as e:
+            self.log('Failed to import %s: %s' % (path, e),
+                     level=kodi.LOGERROR)
+            return dialog.notification(
+                self._t('import_bookmarks'), self._t('import_failed'))
+        dialog.notification(
+            self._t('import_bookmarks'), self._t('imported').format(**stats))
+
+
+def open_db(profile=None):
+    # sqlite3 and the schema are only loaded once a mode needs them.
+    from resources.lib.db import AusisDatabase, DB_FILE_NAME
+    return AusisDatabase(
+        common.get_db_path(DB_FILE_NAME), profile=profile).open()
+
 
 def main():
     addon = kodiaddon.Addon(id='plugin.audio.ausis')
     base_url, handle = sys.argv[0], int(sys.argv[1])
 
     args = utils.parse_query(sys.argv[2][1:])
-    db_filename = common.get_db_path(DB_FILE_NAME)
-    with AusisDatabase(db_filename) as db:
-        Ausis(base_url, handle, addon, db).run(args)
+    dump_path = common.setup_profiling(
+        addon, 'plugin-%s' % (args.get('mode') or 'main'))
+    with Ausis(base_url, handle, addon,
+               lambda: open_db(common.get_profile(addon))) as plugin:
+        call_profiled(dump_path, plugin.run, args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+
+'''Helpers shared by the benchmark scripts.'''
+
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from resources.tests import kodi_stubs  # noqa: E402
+
+kodi_stubs.install()
+
+
+def simulate_rpc_latency(seconds):
+    '''Makes every stubbed JSON-RPC round-trip take at least `seconds`.'''
+    execute = kodi_stubs.executeJSONRPC
+
+    def slow_execute(request):
+        time.sleep(seconds)
+        return execute(request)
+    sys.modules['xbmc'].executeJSONRPC = slow_execute
+
+
+def timed(func, *args, **kwargs):
+    '''Returns the wall time of a single call in seconds.'''
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+
+def report(title, rows, header):
+    cells = [header] + [[
+        '%.4f' % v if isinstance(v, float) else '%s' % v for v in row
+    ] for row in rows]
+    widths = [max(len(c) for c in column) for column in zip(*cells)]
+    print(title)
+    for row in cells:
+        print('  '.join(c.rjust(w) for c, w in zip(row, widths)))
+    print()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+
+'''
+Times the bookmark listing queries on a synthetic bookmark table, and on
+one where another profile has as many bookmarks again.
+
+Usage: python benchmarks/bench_bookmark_queries.py [rows]
+'''
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from _common import report, timed
+
+from resources.lib.db import AusisDatabase
+
+ROWS = 1000000
+ALBUMS = 500
+SONGS_PER_ALBUM = 20
+NAMES = ('started', 'paused', 'resumed', 'seeked', 'ended', 'stopped')
+OTHER_PROFILE = 'kids'
+
+# The queries used before the composite indexes were added.
+OLD_SCHEMA = '''
+CREATE TABLE bookmark (
+    id         INTEGER      NOT NULL,
+    name       VARCHAR(255),
+    song_id    INTEGER      NOT NULL,
+    album_id   INTEGER      NOT NULL,
+    position   REAL         NOT NULL,
+    date_added INTEGER      DEFAULT 0,
+    PRIMARY KEY (id)
+);
+CREATE INDEX bookmark_name_idx ON bookmark(name);
+CREATE INDEX bookmark_song_idx ON bookmark(song_id);
+CREATE INDEX bookmark_album_idx ON bookmark(album_id);
+'''
+OLD_GET_ALBUMS = '''
+  SELECT *
+    FROM bookmark
+GROUP BY album_id
+ORDER BY date_added DESC;'''
+OLD_GET_ALBUM_BOOKMARKS = '''
+  SELECT *
+    FROM bookmark
+   WHERE album_id = :album_id
+ORDER BY date_added DESC;'''
+
+
+def synthetic_rows(count):
+    rnd = random.Random(42)
+    for i in range(count):
+        album_id = rnd.randint(1, ALBUMS)
+        yield (
+            rnd.choice(NAMES),
+            album_id * SONGS_PER_ALBUM + rnd.randint(0, SONGS_PER_ALBUM - 1),
+            album_id,
+            rnd.random() * 3600,
+            1500000000 + i,
+        )
+
+
+def fill(db, count, profile=None):
+    columns = ['name', 'song_id', 'album_id', 'position', 'date_added']
+    rows = synthetic_rows(count)
+    if profile is not None:
+        columns.append('profile')
+        rows = (row + (profile,) for row in rows)
+    db.cr.executemany('''
+INSERT INTO bookmark (%s)
+     VALUES (%s);''' % (
+        ', '.join(columns), ', '.join('?' for _ in columns)), rows)
+    db._conn.commit()
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else ROWS
+    tmp_dir = tempfile.mkdtemp()
+    rows = []
+    try:
+        old = AusisDatabase(os.path.join(tmp_dir, 'old.db'))
+        old.MIGRATIONS = [OLD_SCHEMA]
+        with old as db:
+            fill(db, count)
+            rows.append(('get_albums', 'old', timed(
+                lambda: db.cr.execute(OLD_GET_ALBUMS).fetchall())))
+            rows.append(('get_album_bookmarks', 'old', timed(
+                lambda: db.cr.execute(
+                    OLD_GET_ALBUM_BOOKMARKS, {'album_id': 1}).fetchall())))
+
+        with AusisDatabase(os.path.join(tmp_dir, 'new.db')) as db:
+            fill(db, count)
+            rows.append(('get_albums', 'new', timed(db.get_albums)))
+            rows.append(('get_album_bookmarks', 'new', timed(
+                db.get_album_bookmarks, 1)))
+
+        with AusisDatabase(os.path.join(tmp_dir, 'profiles.db')) as db:
+            fill(db, count)
+            fill(db, count, profile=OTHER_PROFILE)
+            rows.append(('get_albums', 'new, 2 profiles', timed(
+                db.get_albums)))
+            rows.append(('get_album_bookmarks', 'new, 2 profiles', timed(
+                db.get_album_bookmarks, 1)))
+    finally:
+        shutil.rmtree(tmp_dir)
+    report(
+        'Bookmark queries (%d rows, %d albums)' % (count, ALBUMS), rows,
+        ('query', 'schema', 'seconds'))
+
+
+if __name__ == '__main__':
+    main()
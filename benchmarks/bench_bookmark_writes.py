@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+
+'''
+Measures the latency of storing one playback event bookmark.
+
+Compares opening a new database connection per event with reusing one
+long-lived connection, as the service does.
+
+Usage: python benchmarks/bench_bookmark_writes.py
+'''
+
+import os
+import shutil
+import tempfile
+
+from _common import report, timed
+
+from resources.lib.db import AusisDatabase
+
+EVENTS = 500
+
+
+def per_event_connection(db_path):
+    for i in range(EVENTS):
+        with AusisDatabase(db_path) as db:
+            db.add_bookmark('seeked', 1, 1, float(i))
+
+
+def persistent_connection(db_path):
+    db = AusisDatabase(db_path).open()
+    for i in range(EVENTS):
+        with db.transaction():
+            db.add_bookmark('seeked', 1, 1, float(i))
+    db.close()
+
+
+def main():
+    tmp_dir = tempfile.mkdtemp()
+    rows = []
+    try:
+        for func in (per_event_connection, persistent_connection):
+            db_path = os.path.join(tmp_dir, '%s.db' % func.__name__)
+            total = timed(func, db_path)
+            rows.append((func.__name__, total, total / EVENTS * 1000))
+    finally:
+        shutil.rmtree(tmp_dir)
+    report(
+        'Bookmark writes (%d events)' % EVENTS, rows,
+        ('connection', 'total sec', 'ms/event'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+
+'''
+Times reading the chapters of a large single-file audiobook and looking
+them up in the chapter cache afterwards.
+
+The synthetic .m4b file has its movie metadata after the audio data, as
+files which were not optimized for streaming do, and a sparse audio data
+box of the given size, so that it takes no disk space.
+
+Usage: python benchmarks/bench_chapters.py [size in MiB] [chapters]
+'''
+
+import io
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+from _common import report, timed
+
+from resources.lib import chapters
+from resources.lib.db import AusisDatabase
+
+SIZE_MIB = 1024
+CHAPTERS = 200
+RUNS = 100
+
+
+def box(kind, payload):
+    return struct.pack(b'>I4s', 8 + len(payload), kind) + payload
+
+
+def write_book(path, size, count):
+    entries = b''.join(
+        struct.pack(b'>QB', i * 360 * chapters.CHPL_TIMESCALE, 11) +
+        ('Chapter %03d' % i).encode('utf-8') for i in range(count))
+    chpl = box(b'chpl', struct.pack(b'>B3x4xB', 1, count) + entries)
+    with io.open(path, 'wb') as f:
+        f.write(box(b'ftyp', b'M4B \0\0\0\0'))
+        # A 64-bit mdat box, only its header is written.
+        f.write(struct.pack(b'>I4sQ', 1, b'mdat', size))
+        f.seek(size - 16, os.SEEK_CUR)
+        f.write(box(b'moov', box(b'udta', chpl)))
+
+
+def main():
+    size = int(sys.argv[1] if len(sys.argv) > 1 else SIZE_MIB) * 1024 ** 2
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else CHAPTERS
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'book.m4b')
+        write_book(path, size, count)
+        assert len(chapters.read_chapters(path)) == count
+        mtime = os.path.getmtime(path)
+        with AusisDatabase(os.path.join(tmp_dir, 'chapters.db')) as db:
+            db.cache_chapters(path, mtime, chapters.read_chapters(path))
+            rows = [
+                ('parse file', timed(
+                    lambda: [chapters.read_chapters(path)
+                             for _ in range(RUNS)]) / RUNS * 1000),
+                ('cached', timed(
+                    lambda: [db.get_cached_chapters(path, mtime)
+                             for _ in range(RUNS)]) / RUNS * 1000),
+            ]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    report(
+        'Chapters of a %d MiB file with %d chapters (ms per lookup)' % (
+            size // 1024 ** 2, count),
+        rows, ('lookup', 'ms'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+
+'''
+Measures the per-item cost of building a directory listing.
+
+Compares adding every item with its own addDirectoryItem call against
+building the items with KodiPlugin._list_item and adding them with one
+addDirectoryItems call. Every call into the stubbed Kodi modules is
+counted.
+
+Usage: python benchmarks/bench_list_items.py
+'''
+
+from _common import kodi_stubs, report, timed
+
+import xbmcgui as kodigui
+import xbmcplugin as kodiplugin
+
+from resources.lib import common
+
+ITEM_COUNTS = (1000, 10000)
+KODI_CALLS = (
+    'ListItem',
+    'ListItem.setArt',
+    'ListItem.setInfo',
+    'ListItem.addContextMenuItems',
+    'addDirectoryItem',
+    'addDirectoryItems',
+)
+
+
+def item_values(i):
+    return (
+        'plugin://plugin.audio.ausis/?album_id=%d' % i,
+        'Album %d' % i,
+        {'thumb': 'thumb%d.jpg' % i, 'fanart': 'fanart%d.jpg' % i},
+        {'artist': 'Artist', 'album': 'Album %d' % i, 'genre': 'Audiobook'},
+        [('Remove bookmarks', 'RunPlugin(%d)' % i)],
+    )
+
+
+def per_item(count):
+    for i in range(count):
+        url, label, art, info, context_menu = item_values(i)
+        li = kodigui.ListItem(label)
+        li.setArt(art)
+        li.setInfo('music', info)
+        li.addContextMenuItems(items=context_menu)
+        kodiplugin.addDirectoryItem(
+            handle=1, url=url, listitem=li, isFolder=True, totalItems=count)
+
+
+def batched(count):
+    plugin = common.KodiPlugin('plugin://plugin.audio.ausis/', 1, None)
+    items = []
+    for i in range(count):
+        url, label, art, info, context_menu = item_values(i)
+        items.append((url, plugin._list_item(
+            label, art=art, info=info, context_menu=context_menu), True))
+    plugin._add_items(items)
+
+
+def main():
+    rows = []
+    for count in ITEM_COUNTS:
+        for func in (per_item, batched):
+            kodi_stubs.reset()
+            seconds = timed(func, count)
+            kodi_calls = sum(kodi_stubs.calls[c] for c in KODI_CALLS)
+            rows.append((
+                func.__name__, count, kodi_calls,
+                seconds / count * 1e6,
+            ))
+    report(
+        'Directory listing construction', rows,
+        ('path', 'items', 'kodi calls', 'us/item'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+
+'''
+Counts JSON-RPC round-trips and wall time of the main listing.
+
+Usage: python benchmarks/bench_main_listing.py
+'''
+
+from _common import kodi_stubs, report, simulate_rpc_latency, timed
+
+import addon
+from resources.lib import common
+from resources.lib.db import AusisDatabase
+
+ALBUM_COUNTS = (10, 100, 500)
+RPC_LATENCY = 0.002
+PROPERTIES = ['title', 'artist', 'fanart', 'thumbnail', 'dateadded']
+
+
+def album_details(albumid=None, **kwargs):
+    return {'albumdetails': {'albumid': albumid, 'title': 'A%d' % albumid}}
+
+
+def per_album_lookup(album_ids):
+    '''The previous implementation: one GetAlbumDetails per album.'''
+    return [common.json_rpc(
+        'AudioLibrary.GetAlbumDetails',
+        albumid=album_id,
+        properties=PROPERTIES,
+    ) for album_id in album_ids]
+
+
+def main():
+    simulate_rpc_latency(RPC_LATENCY)
+    rows = []
+    for count in ALBUM_COUNTS:
+        kodi_stubs.reset()
+        kodi_stubs.rpc_handlers.update({
+            'AudioLibrary.GetAlbumDetails': album_details,
+        })
+        with AusisDatabase(':memory:') as db:
+            for album_id in range(1, count + 1):
+                db.add_bookmark('started', album_id, album_id, 1.0)
+            plugin = addon.Ausis(
+                'plugin://plugin.audio.ausis/', 1, kodi_stubs.Addon(),
+                lambda: db)
+
+            before = timed(per_album_lookup, range(1, count + 1))
+            before_rpcs = len(kodi_stubs.rpc_calls)
+            del kodi_stubs.rpc_calls[:]
+
+            after = timed(plugin.run, {'mode': 'main'})
+            after_rpcs = len(kodi_stubs.rpc_calls)
+        rows.append((count, before_rpcs, before, after_rpcs, after))
+
+    report(
+        'mode_main (%.1f ms simulated RPC latency)' % (RPC_LATENCY * 1000),
+        rows,
+        ('albums', 'rpcs before', 'sec before', 'rpcs after', 'sec after'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+
+'''
+Measures time-to-first-audio of resuming a long multi-file audiobook.
+
+The time is measured from the start of mode_resume until the stubbed
+Player.play is called. PlayList.add is slowed down to roughly model the
+cost of adding an item in Kodi.
+
+Usage: python benchmarks/bench_resume.py
+'''
+
+import time
+
+from _common import kodi_stubs, report
+
+import xbmc as kodi
+
+import addon
+from resources.lib.db import AusisDatabase
+
+TRACK_COUNTS = (100, 500, 2000)
+PLAYLIST_ADD_COST = 0.0002
+
+
+class TimedPlayer(kodi.Player):
+    started = None
+
+    def play(self, *args, **kwargs):
+        TimedPlayer.started = time.time()
+
+
+def slow_add(add):
+    def wrapper(self, *args, **kwargs):
+        time.sleep(PLAYLIST_ADD_COST)
+        return add(self, *args, **kwargs)
+    return wrapper
+
+
+def add_all_then_play(plugin, songs, bookmark):
+    '''The previous implementation of mode_resume.'''
+    playlist = kodi.PlayList(kodi.PLAYLIST_MUSIC)
+    playlist.clear()
+    playlist_pos = -1
+    for idx, song in enumerate(songs):
+        offset = None
+        if song['songid'] == bookmark.song_id:
+            playlist_pos, offset = idx, bookmark.position
+        playlist.add(song['file'], plugin._song_list_item(song, offset))
+    kodi.Player().play(playlist, startpos=playlist_pos)
+
+
+def main():
+    kodi.Player = TimedPlayer
+    kodi.PlayList.add = slow_add(kodi.PlayList.add)
+    rows = []
+    for count in TRACK_COUNTS:
+        songs = [{
+            'songid': i,
+            'file': '/books/%05d.mp3' % i,
+            'title': 'Chapter %d' % i,
+        } for i in range(1, count + 1)]
+        kodi_stubs.reset()
+        kodi_stubs.rpc_handlers.update({
+            'AudioLibrary.GetSongs': lambda **kwargs: {'songs': songs},
+            'Playlist.Insert': lambda **kwargs: 'OK',
+        })
+        with AusisDatabase(':memory:') as db:
+            plugin = addon.Ausis(
+                'plugin://plugin.audio.ausis/', 1, kodi_stubs.Addon(),
+                lambda: db)
+            bookmark_id = db.add_bookmark('paused', count // 2, 1, 10.0)
+            # Warm up the metadata cache.
+            plugin.cache.get_album_songs(1)
+
+            start = time.time()
+            add_all_then_play(plugin, songs, db.get_bookmark(bookmark_id))
+            before = TimedPlayer.started - start
+
+            start = time.time()
+            plugin.run({'mode': 'resume', 'bookmark_id': bookmark_id})
+            after = TimedPlayer.started - start
+        rows.append((count, before, after))
+    report(
+        'Time to Player.play (%.1f ms per PlayList.add)' % (
+            PLAYLIST_ADD_COST * 1000),
+        rows, ('tracks', 'sec before', 'sec after'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+
+'''
+Times searches on a synthetic library with cached album and song details.
+
+Every search is compared with scanning and decoding the cached details,
+which is what searching without an index would take.
+
+Usage: python benchmarks/bench_search.py [albums]
+'''
+
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+from _common import report, timed
+
+from resources.lib.db import AusisDatabase
+
+ALBUMS = 10000
+SONGS_PER_ALBUM = 10
+WORDS = (
+    'the', 'dark', 'tower', 'house', 'river', 'winter', 'stone', 'night',
+    'silent', 'garden', 'empire', 'shadow', 'kingdom', 'lost', 'city',
+    'children', 'storm', 'queen', 'glass', 'forest', 'hobbit', 'dune',
+)
+NAMES = ('started', 'paused', 'resumed', 'stopped', 'checkpoint')
+SEARCHES = (
+    ('common word', {'query': 'the'}),
+    ('rare words', {'query': 'hobbit river'}),
+    ('two letters', {'query': 'du'}),
+    ('artist', {'query': 'author 42', 'field': 'artist'}),
+    ('song title', {'query': 'chapter 7', 'field': 'song'}),
+    ('bookmark type', {'query': 'storm', 'name': 'stopped'}),
+)
+PAGE_SIZE = 50
+
+
+def populate(db, albums):
+    rnd = random.Random(42)
+    for album_id in range(1, albums + 1):
+        db.cache_albums({album_id: {
+            'albumid': album_id,
+            'title': ' '.join(rnd.sample(WORDS, 3)).title(),
+            'artist': ['Author %d' % rnd.randint(1, albums // 10)],
+        }})
+        db.cache_album_songs(album_id, [{
+            'songid': album_id * SONGS_PER_ALBUM + i,
+            'title': 'Chapter %d' % i,
+        } for i in range(SONGS_PER_ALBUM)])
+        db.add_bookmark(
+            rnd.choice(NAMES), album_id * SONGS_PER_ALBUM, album_id, 1.0,
+            date_added=rnd.randint(0, 10 ** 6))
+
+
+def scan_search(db, query):
+    '''Searches the album titles and artists by decoding all of them.'''
+    query = query.lower()
+    matches = []
+    for album_id, details in db.cr.execute(
+            'SELECT album_id, details FROM album_cache;'):
+        details = json.loads(details)
+        text = ' '.join([details['title']] + details['artist']).lower()
+        if query in text:
+            matches.append(album_id)
+    return matches
+
+
+def main():
+    albums = int(sys.argv[1]) if len(sys.argv) > 1 else ALBUMS
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        with AusisDatabase(os.path.join(tmp_dir, 'search.db')) as db:
+            build = timed(populate, db, albums)
+        rows = []
+        with AusisDatabase(os.path.join(tmp_dir, 'search.db')) as db:
+            for name, kwargs in SEARCHES:
+                search = lambda: list(  # noqa: E731
+                    db.iter_search(limit=PAGE_SIZE + 1, **kwargs))
+                search()
+                rows.append((
+                    name,
+                    len(search()),
+                    timed(search),
+                    timed(scan_search, db, kwargs['query']),
+                ))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    report(
+        'Search on %d albums, %d songs (indexed in %.1f s)' % (
+            albums, albums * SONGS_PER_ALBUM, build),
+        rows, ('search', 'results', 'sec indexed', 'sec scan'))
+
+
+if __name__ == '__main__':
+    main()
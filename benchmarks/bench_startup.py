@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+
+'''
+Measures the cold start of the plugin per mode: the time to import addon.py
+and the time until the listing is finished (endOfDirectory) or playback is
+started. Every run is a fresh interpreter, like a click in Kodi.
+
+Usage: python benchmarks/bench_startup.py
+'''
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from _common import report
+
+RUNS = 5
+MODES = (
+    ('main', 'mode=main'),
+    ('album_bookmarks', 'mode=album_bookmarks&album_id=1'),
+    ('resume_latest', 'mode=resume_latest&album_id=1'),
+    ('unknown', 'mode=unknown'),
+)
+# Modules which are only needed by some of the modes.
+HEAVY_MODULES = ('sqlite3', 'urllib', 'cProfile', 'socket')
+
+
+def child(query, db_dir):
+    '''Runs the plugin once and prints its timings as JSON.'''
+    from _common import kodi_stubs
+
+    kodi = sys.modules['xbmc']
+    kodi.translatePath = lambda path: db_dir.encode('utf-8')
+    kodi_stubs.rpc_handlers.update({
+        'AudioLibrary.GetAlbumDetails': lambda albumid, **kw: {
+            'albumdetails': {'albumid': albumid, 'title': 'A%d' % albumid},
+        },
+        'AudioLibrary.GetSongs': lambda **kw: {'songs': [{
+            'songid': song_id,
+            'file': '/books/%02d.mp3' % song_id,
+            'title': 'Song %d' % song_id,
+            'duration': 600,
+        } for song_id in range(1, 21)]},
+    })
+    ready = []
+
+    def finish(*args, **kwargs):
+        ready.append(time.time())
+    sys.modules['xbmcplugin'].endOfDirectory = finish
+    kodi.Player.play = finish
+
+    start = time.time()
+    import addon
+    imported = time.time()
+    sys.argv = ['plugin://plugin.audio.ausis/', '1', '?' + query]
+    addon.main()
+    print(json.dumps({
+        'import': imported - start,
+        'ready': (ready[0] if ready else time.time()) - start,
+        'modules': [m for m in HEAVY_MODULES if m in sys.modules],
+    }))
+
+
+def populate(db_dir):
+    from resources.lib.db import AusisDatabase, DB_FILE_NAME
+
+    with AusisDatabase(os.path.join(db_dir, DB_FILE_NAME)) as db:
+        for album_id in range(1, 51):
+            for song_id in range(1, 21):
+                db.add_bookmark('paused', song_id, album_id, 30.0)
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def main():
+    db_dir = tempfile.mkdtemp()
+    try:
+        populate(db_dir)
+        rows = []
+        for name, query in MODES:
+            runs = [json.loads(subprocess.check_output([
+                sys.executable, __file__, '--child', query, db_dir,
+            ]).decode('utf-8')) for _ in range(RUNS)]
+            rows.append((
+                name,
+                median([run['import'] for run in runs]) * 1000,
+                median([run['ready'] for run in runs]) * 1000,
+                ', '.join(runs[0]['modules']) or '-',
+            ))
+    finally:
+        shutil.rmtree(db_dir)
+
+    report(
+        'Plugin cold start (median of %d runs, ms)' % RUNS,
+        rows, ('mode', 'import', 'ready', 'heavy modules loaded'))
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(*sys.argv[2:4])
+    else:
+        main()
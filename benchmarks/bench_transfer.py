@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+
+'''
+Times the export and import of a large bookmark history and the growth of
+the peak memory use, which should not depend on the number of bookmarks.
+
+The import goes into an empty database with other song IDs, like a move to
+another Kodi installation, and then once more, when every bookmark is a
+duplicate.
+
+Usage: python benchmarks/bench_transfer.py [bookmarks]
+'''
+
+import collections
+import io
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from _common import report
+
+from resources.lib import transfer
+from resources.lib.db import AusisDatabase
+
+BOOKMARKS = 1000000
+SONGS = 20000
+SONGS_PER_ALBUM = 20
+NAMES = ('started', 'paused', 'resumed', 'stopped', 'checkpoint')
+
+
+def peak_memory():
+    '''Returns the peak resident set size of the process in MiB.'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def song_file(song_id):
+    return '/books/%04d/%02d.mp3' % divmod(song_id, SONGS_PER_ALBUM)
+
+
+def generate(count):
+    rnd = random.Random(42)
+    for i in range(count):
+        song_id = rnd.randint(1, SONGS)
+        yield {
+            'name': rnd.choice(NAMES),
+            'song_id': song_id,
+            'album_id': song_id // SONGS_PER_ALBUM,
+            'position': rnd.random() * 3600,
+            'date_added': i,
+        }
+
+
+def export(db_path, path, fmt):
+    song_files = {song_id: song_file(song_id) for song_id in range(SONGS)}
+    with AusisDatabase(db_path) as db, io.open(path, 'wb') as f:
+        return transfer.write_rows(transfer.export_rows(
+            db.iter_all_bookmarks(), song_files), f, fmt)
+
+
+def import_(db_path, path, fmt):
+    # The library of the other installation numbers its songs differently.
+    songs_by_file = {
+        song_file(song_id): (song_id + SONGS, song_id // SONGS_PER_ALBUM)
+        for song_id in range(SONGS)
+    }
+    stats = collections.Counter()
+    with AusisDatabase(db_path) as db, io.open(path, 'rb') as f:
+        transfer.import_rows(db, transfer.remap_rows(
+            transfer.read_rows(f, fmt), songs_by_file, stats), stats)
+    return stats
+
+
+def step(rows, name, func, *args):
+    before = peak_memory()
+    start = time.time()
+    result = func(*args)
+    rows.append((name, time.time() - start, peak_memory() - before))
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else BOOKMARKS
+    tmp_dir = tempfile.mkdtemp()
+    source = os.path.join(tmp_dir, 'source.db')
+    try:
+        with AusisDatabase(source) as db:
+            transfer.import_rows(
+                db, generate(count), collections.Counter())
+        rows = []
+        for fmt in transfer.FORMATS:
+            path = os.path.join(tmp_dir, 'bookmarks.%s' % fmt)
+            target = os.path.join(tmp_dir, 'target-%s.db' % fmt)
+            step(rows, 'export %s' % fmt, export, source, path, fmt)
+            stats = step(rows, 'import %s' % fmt, import_, target, path, fmt)
+            assert stats['added'] == count, stats
+            stats = step(
+                rows, 're-import %s' % fmt, import_, target, path, fmt)
+            assert stats['duplicate'] == count, stats
+            rows[-3] += ('%.1f' % (os.path.getsize(path) / 1024.0 ** 2),)
+            rows[-2] += ('',)
+            rows[-1] += ('',)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    report(
+        'Export and import of %d bookmarks' % count,
+        rows, ('step', 'sec', 'peak MiB growth', 'file MiB'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+'''
+Chapters of single-file audiobooks.
+
+Chapters are read from a cue sheet next to the audio file or from the
+chapter atoms of MP4 files (.m4b, .m4a): a QuickTime chapter track or a
+Nero ``chpl`` atom. MP4 files are mapped into memory and only the box
+headers of the movie metadata and the chapter samples are read, so the
+audio data of large files is never touched.
+'''
+
+import bisect
+import collections
+import io
+import mmap
+import os
+import re
+import struct
+
+Chapter = collections.namedtuple('Chapter', 'start title')
+
+MP4_EXTENSIONS = frozenset(['.m4a', '.m4b', '.mp4'])
+# Units of the chapter start times of chpl atoms per second.
+CHPL_TIMESCALE = 10000000
+# Frames of INDEX times of cue sheets per second.
+CUE_FRAMES = 75
+# Chapter tracks with more samples are taken to be malformed.
+MAX_CHAPTERS = 10000
+
+_CUE_LINE = re.compile(r'^\s*(\S+)\s*(.*?)\s*$')
+_CUE_TIME = re.compile(r'^(\d+):(\d{1,2}):(\d{1,2})$')
+
+
+def chapter_at(chapters, position):
+    '''
+    Returns the index of the chapter which `position` (in seconds) is in
+    or `None` if it is before the first chapter.
+    '''
+    i = bisect.bisect_right([c.start for c in chapters], position) - 1
+    return i if i >= 0 else None
+
+
+def read_chapters(path):
+    '''
+    Returns the chapters of a local audio file, ordered by their start.
+
+    Returns an empty list if the file has no chapters or they can not be
+    read.
+    '''
+    try:
+        for cue_path in _cue_paths(path):
+            if os.path.isfile(cue_path):
+                with io.open(cue_path, 'rb') as f:
+                    return parse_cue(
+                        _decode_text(f.read()), os.path.basename(path))
+        if os.path.splitext(path)[1].lower() in MP4_EXTENSIONS:
+            return read_mp4_chapters(path)
+    except (EnvironmentError, ValueError):
+        pass
+    return []
+
+
+def _cue_paths(path):
+    return (os.path.splitext(path)[0] + '.cue', path + '.cue')
+
+
+def _decode_text(data):
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('cp1252', 'replace')
+
+
+def _unquote(value):
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1]
+    return value
+
+
+def parse_cue(text, file_name=None):
+    '''
+    Returns the chapters of the tracks in a cue sheet.
+
+    If the sheet lists several files, only the tracks of `file_name` are
+    returned.
+    '''
+    files = {}
+    current_file, track = None, None
+    for line in text.splitlines():
+        match = _CUE_LINE.match(line)
+        if not match:
+            continue
+        command, value = match.group(1).upper(), match.group(2)
+        if command == 'FILE':
+            current_file = _unquote(value.rsplit(' ', 1)[0])
+            track = None
+            files.setdefault(current_file, [])
+        elif command == 'TRACK':
+            track = {'number': value.split()[0], 'title': None}
+            files.setdefault(current_file, []).append(track)
+        elif command == 'TITLE' and track is not None:
+            track['title'] = _unquote(value)
+        elif command == 'INDEX' and track is not None:
+            number, _, time = value.partition(' ')
+            if int(number) == 1:
+                track['start'] = _parse_cue_time(time.strip())
+
+    if len(files) == 1:
+        tracks = next(iter(files.values()))
+    else:
+        name = (file_name or '').lower()
+        tracks = next((
+            t for f, t in files.items()
+            if f and os.path.basename(f.replace('\\', '/')).lower() == name
+        ), [])
+    return sorted(
+        Chapter(t['start'], t['title'] or 'Track %s' % t['number'])
+        for t in tracks if 'start' in t)
+
+
+def _parse_cue_time(time):
+    match = _CUE_TIME.match(time)
+    if not match:
+        raise ValueError('Malformed cue sheet time: %r' % time)
+    minutes, seconds, frames = [int(v) for v in match.groups()]
+    return minutes * 60 + seconds + frames / float(CUE_FRAMES)
+
+
+def read_mp4_chapters(path):
+    '''Returns the chapters of an MP4 file.'''
+    with io.open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return []
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return parse_mp4_chapters(data)
+        finally:
+            data.close()
+
+
+def parse_mp4_chapters(data):
+    '''
+    Returns the chapters of MP4 data (a byte string or a memory map).
+
+    The QuickTime chapter track is preferred over a ``chpl`` atom.
+    Raises :exc:`ValueError` on malformed boxes.
+    '''
+    moov = _find(data, 0, len(data), b'moov')
+    if moov is None:
+        return []
+    chpl = _find(data, moov[0], moov[1], b'udta', b'chpl')
+    return _chapter_track(data, moov) or (
+        _chpl_chapters(data, chpl) if chpl else [])
+
+
+def _unpack(fmt, data, offset):
+    try:
+        return struct.unpack_from(fmt, data, offset)
+    except struct.error as e:
+        raise ValueError('Truncated MP4 data at %d: %s' % (offset, e))
+
+
+def _boxes(data, start, end):
+    '''Yields the (type, payload start, end) of the boxes in a range.'''
+    offset = start
+    while offset + 8 <= end:
+        size, kind = _unpack(b'>I4s', data, offset)
+        header = 8
+        if size == 1:
+            size, = _unpack(b'>Q', data, offset + 8)
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise ValueError('Malformed MP4 box %r at %d' % (kind, offset))
+        yield kind, offset + header, offset + size
+        offset += size
+
+
+def _find(data, start, end, *path):
+    '''Returns the (payload start, end) of the first box at `path`.'''
+    for kind, box_start, box_end in _boxes(data, start, end):
+        if kind == path[0]:
+            if len(path) == 1:
+                return box_start, box_end
+            found = _find(data, box_start, box_end, *path[1:])
+            if found:
+                return found
+
+
+def _chpl_chapters(data, box):
+    start, end = box
+    version, = _unpack(b'>B', data, start)
+    # Version and flags, followed by 4 unknown bytes in version 1.
+    offset = start + (8 if version else 4)
+    count, = _unpack(b'>B', data, offset)
+    offset += 1
+    chapters = []
+    for _ in range(count):
+        if offset + 9 > end:
+            raise ValueError('Truncated chpl atom')
+        chapter_start, length = _unpack(b'>QB', data, offset)
+        offset += 9
+        title = data[offset:offset + length].decode('utf-8', 'replace')
+        offset += length
+        chapters.append(Chapter(chapter_start / float(CHPL_TIMESCALE), title))
+    return sorted(chapters)
+
+
+def _chapter_track(data, moov):
+    '''Returns the chapters of the text track referenced by a chap box.'''
+    tracks, chapter_ids = {}, set()
+    for kind, start, end in _boxes(data, moov[0], moov[1]):
+        if kind != b'trak':
+            continue
+        tkhd = _find(data, start, end, b'tkhd')
+        if tkhd is None:
+            continue
+        version, = _unpack(b'>B', data, tkhd[0])
+        track_id, = _unpack(
+            b'>I', data, tkhd[0] + (20 if version == 1 else 12))
+        tracks[track_id] = start, end
+        chap = _find(data, start, end, b'tref', b'chap')
+        if chap:
+            chapter_ids.update(_unpack(
+                b'>%dI' % ((chap[1] - chap[0]) // 4), data, chap[0]))
+    for track_id in sorted(chapter_ids):
+        if track_id in tracks:
+            return _text_samples(data, *tracks[track_id])
+    return []
+
+
+def _full_box_entries(data, box, fmt):
+    '''Returns the entries of a full box with an entry count.'''
+    count, = _unpack(b'>I', data, box[0] + 4)
+    size = struct.calcsize(fmt)
+    if box[0] + 8 + count * size > box[1]:
+        raise ValueError('Truncated MP4 sample table')
+    return [
+        _unpack(fmt, data, box[0] + 8 + i * size) for i in range(count)]
+
+
+def _text_samples(data, start, end):
+    '''Returns the chapters of the text samples of a track.'''
+    mdhd = _find(data, start, end, b'mdia', b'mdhd')
+    stbl = _find(data, start, end, b'mdia', b'minf', b'stbl')
+    if mdhd is None or stbl is None:
+        return []
+    version, = _unpack(b'>B', data, mdhd[0])
+    timescale, = _unpack(b'>I', data, mdhd[0] + (20 if version == 1 else 12))
+    if not timescale:
+        raise ValueError('Chapter track without a timescale')
+
+    boxes = {
+        kind: (box_start, box_end)
+        for kind, box_start, box_end in _boxes(data, stbl[0], stbl[1])
+    }
+    if not all(k in boxes for k in (b'stts', b'stsz', b'stsc')):
+        return []
+    if b'co64' in boxes:
+        chunks = [o for o, in _full_box_entries(data, boxes[b'co64'], b'>Q')]
+    elif b'stco' in boxes:
+        chunks = [o for o, in _full_box_entries(data, boxes[b'stco'], b'>I')]
+    else:
+        return []
+
+    # The counts of the sample tables are not trusted: samples are only
+    # expanded up to the number of sample sizes, which is bounded.
+    stsz = boxes[b'stsz']
+    sample_size, count = _unpack(b'>II', data, stsz[0] + 4)
+    if count > MAX_CHAPTERS:
+        raise ValueError('Too many chapter samples: %d' % count)
+    if not sample_size and stsz[0] + 12 + count * 4 > stsz[1]:
+        raise ValueError('Truncated MP4 sample table')
+
+    # Runs of chunks with the same number of samples per chunk.
+    runs = _full_box_entries(data, boxes[b'stsc'], b'>III')
+    offsets = []
+    for i, (first, per_chunk, _) in enumerate(runs):
+        last = runs[i + 1][0] - 1 if i + 1 < len(runs) else len(chunks)
+        for chunk in range(max(first - 1, 0), min(last, len(chunks))):
+            offset = chunks[chunk]
+            for _ in range(min(per_chunk, count - len(offsets))):
+                size = sample_size or _unpack(
+                    b'>I', data, stsz[0] + 12 + 4 * len(offsets))[0]
+                offsets.append(offset)
+                offset += size
+
+    starts, time = [], 0
+    for samples, delta in _full_box_entries(data, boxes[b'stts'], b'>II'):
+        for _ in range(min(samples, len(offsets) - len(starts))):
+            starts.append(time / float(timescale))
+            time += delta
+
+    return sorted(
+        Chapter(chapter_start, _text_sample(data, offset))
+        for chapter_start, offset in zip(starts, offsets))
+
+
+def _text_sample(data, offset):
+    length, = _unpack(b'>H', data, offset)
+    text = data[offset + 2:offset + 2 + length]
+    if text[:2] in (b'\xfe\xff', b'\xff\xfe'):
+        return text.decode('utf-16', 'replace')
+    return text.decode('utf-8', 'replace')
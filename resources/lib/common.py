@@ -3,30 +3,377 @@ from __future__ import unicode_literals
 
 '''Common Kodi-related constants and functions.'''
 
+import collections
+import itertools
 import json
 import os
-import random
-import urllib
+import time
 
 import xbmc as kodi
+import xbmcgui as kodigui
+import xbmcplugin as kodiplugin
 
+import chapters
+import profiling
+import tracks
 import utils
 
 
 DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# In hours.
+DEFAULT_CACHE_TTL = 24
+# Calls per JSON-RPC request, which Kodi parses and answers as a whole.
+MAX_BATCH_SIZE = 100
+
+# Album and song details used by the listings and resuming. They are
+# cached in the database as a whole, so all the fields used by any mode
+# are requested.
+ALBUM_PROPERTIES = [
+    'title',
+    'artist',
+    'fanart',
+    'thumbnail',
+    'dateadded',
+]
+# TODO(naglis): add more fields
+SONG_PROPERTIES = [
+    'file',
+    'artist',
+    'title',
+    'duration',
+    'thumbnail',
+    'album',
+    'track',
+    'year',
+]
+
+
+def extract(value, path, default=None):
+    '''Returns the item at a sequence of keys in nested dicts.'''
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return default
+        value = value[key]
+    return value
+
+
+class JSONRPCClient(object):
+    '''
+    Client of the Kodi JSON-RPC API.
+
+    Request IDs are taken from a counter. The number of calls, the time
+    spent and the request and response sizes are counted per method in
+    :attr:`stats`. Round-trips of batched calls are split evenly among
+    them.
+    '''
+
+    def __init__(self, max_batch_size=MAX_BATCH_SIZE):
+        '''
+        :param max_batch_size: the number of calls per request of
+            :meth:`batch`.
+        '''
+        self._max_batch_size = max_batch_size
+        self._ids = itertools.count(1)
+        self.stats = collections.defaultdict(collections.Counter)
+
+    def _request(self, method, params):
+        request = {
+            'jsonrpc': '2.0',
+            'method': method,
+            'id': next(self._ids),
+        }
+        if params:
+            request['params'] = params
+        return request
+
+    def _execute(self, methods, payload):
+        request = json.dumps(payload)
+        start = time.time()
+        response = kodi.executeJSONRPC(request)
+        elapsed = time.time() - start
+        share = 1.0 / len(methods)
+        for method in methods:
+            stats = self.stats[method]
+            stats['calls'] += 1
+            stats['seconds'] += elapsed * share
+            stats['request_bytes'] += len(request) * share
+            stats['response_bytes'] += len(response) * share
+        return json.loads(response)
+
+    def _result(self, method, response, path, default):
+        if 'error' in response:
+            self.stats[method]['errors'] += 1
+        if path is None:
+            return response
+        if 'result' not in response:
+            return default
+        return extract(response['result'], path, default)
+
+    def call(self, method, params=None, path=None, default=None):
+        '''
+        Calls a method and returns its response.
+
+        If a `path` of keys is given, only the value at it in the result
+        is returned, or `default` if there is none.
+        '''
+        response = self._execute([method], self._request(method, params))
+        return self._result(method, response, path, default)
+
+    def batch(self, calls, path=None, default=None):
+        '''
+        Calls several methods with as few requests as possible.
+
+        `calls` are (method, params) pairs, sent in requests of up to
+        `max_batch_size` calls. Returns their responses, or the values at
+        `path` in their results, in the same order.
+        '''
+        calls = list(calls)
+        results = []
+        for start in range(0, len(calls), self._max_batch_size):
+            results.extend(self._batch(
+                calls[start:start + self._max_batch_size], path, default))
+        return results
+
+    def _batch(self, calls, path, default):
+        requests = [self._request(method, params) for method, params in calls]
+        responses = self._execute(
+            [request['method'] for request in requests], requests)
+        # Invalid batches are answered with a single error.
+        if not isinstance(responses, list):
+            responses = []
+        by_id = {response.get('id'): response for response in responses}
+        return [
+            self._result(
+                request['method'], by_id.get(request['id'], {}), path,
+                default)
+            for request in requests
+        ]
+
+    def log_stats(self, log):
+        '''Logs the stats of each method, the slowest first.'''
+        by_time = sorted(
+            self.stats.items(), key=lambda item: item[1]['seconds'],
+            reverse=True)
+        for method, stats in by_time:
+            log('JSON-RPC %s: %d calls, %.1f ms, %d B sent, %d B received, '
+                '%d errors' % (
+                    method, stats['calls'], stats['seconds'] * 1000,
+                    stats['request_bytes'], stats['response_bytes'],
+                    stats['errors']))
+
+
+rpc = JSONRPCClient()
 
 
 def json_rpc(method, **params):
-    values = {
-        'jsonrpc': '2.0',
-        'method': method,
-        'id': random.randint(1, 10000000),
+    return rpc.call(method, params)
+
+
+def get_albums_details(album_ids, properties):
+    '''
+    Returns a dict of album details keyed by album ID.
+
+    Only the requested albums are fetched, with batches of
+    ``AudioLibrary.GetAlbumDetails`` calls (see :meth:`JSONRPCClient.batch`),
+    so a listing makes one JSON-RPC round-trip whatever the size of the
+    library. Albums which are not in the library are left out.
+    '''
+    album_ids = sorted(set(album_ids))
+    details = rpc.batch([
+        ('AudioLibrary.GetAlbumDetails', {
+            'albumid': album_id,
+            'properties': properties,
+        }) for album_id in album_ids
+    ], path=('albumdetails',))
+    return {
+        album_id: album
+        for album_id, album in zip(album_ids, details) if album
     }
-    if params:
-        values.update({
-            'params': params,
-        })
-    return json.loads(kodi.executeJSONRPC(json.dumps(values)))
+
+
+def get_album_songs(album_id, properties):
+    '''Returns the details of all the songs of an album.'''
+    return rpc.call('AudioLibrary.GetSongs', {
+        'properties': properties,
+        'filter': {
+            'albumid': album_id,
+        },
+    }, path=('songs',), default=[])
+
+
+def get_albums_songs(album_ids, properties):
+    '''
+    Returns a dict of the details of all the songs of albums keyed by
+    album ID, with a single batch of ``AudioLibrary.GetSongs`` calls.
+    '''
+    album_ids = sorted(set(album_ids))
+    songs = rpc.batch([
+        ('AudioLibrary.GetSongs', {
+            'properties': properties,
+            'filter': {
+                'albumid': album_id,
+            },
+        }) for album_id in album_ids
+    ], path=('songs',), default=[])
+    return dict(zip(album_ids, songs))
+
+
+def get_library_songs(properties):
+    '''Returns the details of all the songs in the music library.'''
+    return rpc.call('AudioLibrary.GetSongs', {
+        'properties': properties,
+    }, path=('songs',), default=[])
+
+
+class MetadataCache(object):
+    '''
+    Read-through cache of album and song details stored in the database.
+
+    Counts cache hits and misses per kind of lookup in :attr:`stats`.
+    '''
+
+    def __init__(self, db, max_age, album_properties, song_properties):
+        self._db = db
+        self._max_age = max_age
+        self._album_properties = album_properties
+        self._song_properties = song_properties
+        self.stats = collections.Counter()
+
+    def get_albums(self, album_ids):
+        '''Returns a dict of album details keyed by album ID.'''
+        album_ids = set(album_ids)
+        albums = self._db.get_cached_albums(album_ids, self._max_age)
+        missing = album_ids.difference(albums)
+        self.stats['album_hits'] += len(album_ids) - len(missing)
+        self.stats['album_misses'] += len(missing)
+        if missing:
+            fetched = get_albums_details(missing, self._album_properties)
+            # Albums which are not in the library are cached as well, so
+            # that they do not cause a lookup on every listing.
+            fetched.update(
+                (album_id, {}) for album_id in missing.difference(fetched))
+            self._db.cache_albums(fetched)
+            albums.update(fetched)
+        return albums
+
+    def get_album_songs(self, album_id):
+        '''Returns the details of all the songs of an album.'''
+        songs = self._db.get_cached_album_songs(album_id, self._max_age)
+        if songs is None:
+            self.stats['song_misses'] += 1
+            songs = get_album_songs(album_id, self._song_properties)
+            self._db.cache_album_songs(album_id, songs)
+        else:
+            self.stats['song_hits'] += 1
+        return songs
+
+    def cache_albums_songs(self, album_ids):
+        '''
+        Fetches the songs of several albums at once and caches them, such
+        as those of albums whose songs were never listed.
+        '''
+        album_ids = set(album_ids)
+        self.stats['song_misses'] += len(album_ids)
+        if album_ids:
+            songs = get_albums_songs(album_ids, self._song_properties)
+            for album_id, album_songs in songs.items():
+                self._db.cache_album_songs(album_id, album_songs)
+
+    def get_track_index(self, album_id, songs=None):
+        '''
+        Returns the :class:`tracks.TrackIndex` of an album.
+
+        The index is stored in the database and only rebuilt after the
+        album's songs were invalidated. `songs` can be passed if the
+        album's songs were already fetched.
+        '''
+        data = self._db.get_track_index(album_id)
+        if data is not None:
+            self.stats['index_hits'] += 1
+            return tracks.TrackIndex.load(data)
+        self.stats['index_misses'] += 1
+        if songs is None:
+            songs = self.get_album_songs(album_id)
+        index = tracks.TrackIndex.from_songs(songs)
+        self._db.store_track_index(album_id, index.dump())
+        return index
+
+
+def get_chapters(db, path):
+    '''
+    Returns the chapters of an audio file.
+
+    The chapters are read once per modification of the file and cached in
+    the database. Only local files are read.
+    '''
+    path = utils.decode_arg(kodi.translatePath(path))
+    if '://' in path:
+        return []
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return []
+    file_chapters = db.get_cached_chapters(path, mtime)
+    if file_chapters is None:
+        with profiling.profiler.timed('chapters', 'read'):
+            file_chapters = chapters.read_chapters(path)
+        db.cache_chapters(path, mtime, file_chapters)
+    return file_chapters
+
+
+def invalidate_cache(db, method, data):
+    '''Invalidates cached metadata affected by a library notification.'''
+    if method in ('AudioLibrary.OnUpdate', 'AudioLibrary.OnRemove'):
+        data = json.loads(data) if data else {}
+        item = data.get('item', data)
+        if item.get('type') == 'song' and item.get('id'):
+            return db.invalidate_song(item['id'])
+        elif item.get('type') == 'album' and item.get('id'):
+            return db.invalidate_album(item['id'])
+        return db.clear_cache()
+    elif method in ('AudioLibrary.OnScanFinished',
+                    'AudioLibrary.OnCleanFinished'):
+        return db.clear_cache()
+
+
+def get_cache_max_age(addon):
+    '''Returns the lifetime of cached library metadata in seconds.'''
+    try:
+        hours = float(addon.getSetting('cache_ttl'))
+    except ValueError:
+        hours = DEFAULT_CACHE_TTL
+    return int(hours * 3600)
+
+
+def setup_profiling(addon, name):
+    '''
+    Enables profiling if the hidden ``profiling`` setting is on.
+
+    Returns the path of the file to dump a :mod:`cProfile` profile named
+    `name` to, or `None` if no dump directory is set.
+    '''
+    profiling.profiler.enabled = addon.getSetting('profiling') == 'true'
+    dump_dir = addon.getSetting('profiling_dump_directory')
+    if profiling.profiler.enabled and dump_dir:
+        dump_dir = kodi.translatePath(dump_dir).decode('utf-8')
+        return os.path.join(dump_dir, '%s.prof' % name)
+
+
+def get_profile(addon):
+    '''
+    Returns the profile to keep bookmarks of: the user set in the add-on
+    settings or else the name of the current Kodi profile.
+
+    Returns `None` in the Kodi master profile, whose bookmarks are kept in
+    :data:`resources.lib.db.DEFAULT_PROFILE`.
+    '''
+    user = addon.getSetting('user').strip()
+    if user:
+        return utils.decode_arg(user)
+    if (kodi.translatePath('special://profile') ==
+            kodi.translatePath('special://masterprofile')):
+        return None
+    return utils.decode_arg(kodi.getInfoLabel('System.ProfileName')) or None
 
 
 def get_db_path(db_name):
@@ -55,9 +402,7 @@ class KodiPlugin(object):
 
     def _build_url(self, **kwargs):
         '''Build and returns a plugin  URL.'''
-        return '%s?%s' % (
-            self._base_url, urllib.urlencode(utils.encode_values(kwargs)),
-        )
+        return '%s?%s' % (self._base_url, utils.urlencode(kwargs))
 
     def _t(self, string_id):
         '''A shorthand to addon.getLocalizedString.'''
@@ -65,6 +410,31 @@ class KodiPlugin(object):
             string_id = self._strings[string_id]
         return self._addon.getLocalizedString(string_id)
 
+    def _list_item(self, label, label2=None, icon=None, art=None, info=None,
+                   info_type='music', context_menu=None):
+        '''
+        Builds a :class:`xbmcgui.ListItem`.
+
+        Only the setters for the given values are called, as each one is
+        a call into Kodi.
+        '''
+        li = kodigui.ListItem(label, label2=label2 or '', iconImage=icon or '')
+        if art:
+            li.setArt(art)
+        if info:
+            li.setInfo(info_type, info)
+        if context_menu:
+            li.addContextMenuItems(items=context_menu)
+        return li
+
+    def _add_items(self, items):
+        '''
+        Adds (url, list item, is folder) tuples to the directory listing
+        with a single call into Kodi.
+        '''
+        return kodiplugin.addDirectoryItems(
+            handle=self._handle, items=items, totalItems=len(items))
+
     def log(self, msg, level=kodi.LOGDEBUG):
         msg = ('%s: %s' % (
             self._addon.getAddonInfo('id'), msg)).encode('utf-8')
@@ -74,7 +444,8 @@ class KodiPlugin(object):
         mode = args.get('mode') or 'main'
         mode_handler = 'mode_%s' % mode
         if hasattr(self, mode_handler):
-            return getattr(self, mode_handler)(args)
+            with profiling.profiler.timed('mode', mode):
+                return getattr(self, mode_handler)(args)
         else:
             self.log(
                 'Plugin called with unknown mode: %s' % mode,
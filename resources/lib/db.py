@@ -2,11 +2,25 @@
 from __future__ import unicode_literals
 
 import collections
+import contextlib
+import json
 import operator
 import sqlite3
 import time
 
+import chapters
+import profiling
+import search
+import tracks
+
 DB_FILE_NAME = 'Ausis.db'
+# In seconds.
+BUSY_TIMEOUT = 5.0
+# Name of the bookmark which is periodically updated during playback.
+CHECKPOINT = 'checkpoint'
+# Profile of the bookmarks of the Kodi master profile, which also got the
+# bookmarks made before there were profiles.
+DEFAULT_PROFILE = 'default'
 
 BOOKMARK_FIELDS = [
     'id',
@@ -15,12 +29,18 @@ BOOKMARK_FIELDS = [
     'album_id',
     'position',
     'date_added',
+    'profile',
 ]
 Bookmark = collections.namedtuple('Bookmark', BOOKMARK_FIELDS)
 
 duration_getter = operator.attrgetter('duration')
 
-SQL_SCHEMA = '''
+# Ordered schema migrations. The `user_version` of a database is the number
+# of migrations applied to it.
+SQL_MIGRATIONS = [
+    # The initial schema. Databases created before migrations were
+    # introduced already have it, hence IF NOT EXISTS.
+    '''
 CREATE TABLE IF NOT EXISTS bookmark (
     id         INTEGER      NOT NULL,
     name       VARCHAR(255),
@@ -36,7 +56,339 @@ CREATE INDEX IF NOT EXISTS bookmark_song_idx
                         ON bookmark(song_id);
 CREATE INDEX IF NOT EXISTS bookmark_album_idx
                         ON bookmark(album_id);
-'''
+''',
+    # Composite bookmark indexes and the library metadata cache.
+    '''
+DROP INDEX IF EXISTS bookmark_song_idx;
+DROP INDEX IF EXISTS bookmark_album_idx;
+CREATE INDEX IF NOT EXISTS bookmark_song_date_idx
+                        ON bookmark(song_id, date_added DESC, id DESC);
+CREATE INDEX IF NOT EXISTS bookmark_album_date_idx
+                        ON bookmark(album_id, date_added DESC, id DESC);
+CREATE INDEX IF NOT EXISTS bookmark_album_name_date_idx
+                        ON bookmark(album_id, name, date_added);
+CREATE TABLE IF NOT EXISTS album_cache (
+    album_id     INTEGER      NOT NULL,
+    details      TEXT,
+    date_cached  INTEGER      DEFAULT 0,
+    songs_cached INTEGER      DEFAULT 0,
+    PRIMARY KEY (album_id)
+);
+CREATE TABLE IF NOT EXISTS song_cache (
+    song_id      INTEGER      NOT NULL,
+    album_id     INTEGER      NOT NULL,
+    details      TEXT         NOT NULL,
+    PRIMARY KEY (song_id)
+);
+CREATE INDEX IF NOT EXISTS song_cache_album_idx
+                        ON song_cache(album_id);
+''',
+    # Per-album track index.
+    '''
+CREATE TABLE album_index (
+    album_id     INTEGER      NOT NULL,
+    data         TEXT         NOT NULL,
+    PRIMARY KEY (album_id)
+);
+''',
+    # Progress of the latest bookmark within the whole book.
+    '''
+CREATE TABLE album_progress (
+    album_id     INTEGER      NOT NULL,
+    position     REAL         NOT NULL,
+    duration     REAL         NOT NULL,
+    date_updated INTEGER      DEFAULT 0,
+    PRIMARY KEY (album_id)
+);
+''',
+    # Trigram search index of album titles, artists and song titles.
+    '''
+CREATE TABLE search_item (
+    id           INTEGER      NOT NULL,
+    album_id     INTEGER      NOT NULL,
+    song_id      INTEGER,
+    field        TEXT         NOT NULL,
+    text         TEXT         NOT NULL,
+    PRIMARY KEY (id)
+);
+CREATE INDEX search_item_album_idx
+          ON search_item(album_id, field);
+CREATE INDEX search_item_song_idx
+          ON search_item(song_id);
+CREATE TABLE search_trigram (
+    trigram      TEXT         NOT NULL,
+    item_id      INTEGER      NOT NULL,
+    PRIMARY KEY (trigram, item_id)
+) WITHOUT ROWID;
+CREATE INDEX search_trigram_item_idx
+          ON search_trigram(item_id);
+-- Number of items with each trigram, so that searches can start from
+-- the rarest trigram of the query.
+CREATE TABLE search_trigram_count (
+    trigram      TEXT         NOT NULL,
+    items        INTEGER      NOT NULL,
+    PRIMARY KEY (trigram)
+) WITHOUT ROWID;
+CREATE TRIGGER search_item_delete AFTER DELETE ON search_item
+BEGIN
+    DELETE FROM search_trigram
+          WHERE item_id = old.id;
+END;
+CREATE TRIGGER search_trigram_insert AFTER INSERT ON search_trigram
+BEGIN
+    INSERT OR IGNORE INTO search_trigram_count (trigram, items)
+                   VALUES (new.trigram, 0);
+    UPDATE search_trigram_count
+       SET items = items + 1
+     WHERE trigram = new.trigram;
+END;
+CREATE TRIGGER search_trigram_delete AFTER DELETE ON search_trigram
+BEGIN
+    UPDATE search_trigram_count
+       SET items = items - 1
+     WHERE trigram = old.trigram;
+END;
+-- Metadata cached before is fetched again, so that it gets indexed.
+DELETE FROM song_cache;
+DELETE FROM album_cache;
+''',
+    # Bookmarks and progress of several profiles. The profile leads every
+    # index, so that queries of one profile only read its own entries.
+    '''
+ALTER TABLE bookmark
+ ADD COLUMN profile TEXT NOT NULL DEFAULT 'default';
+DROP INDEX IF EXISTS bookmark_name_idx;
+DROP INDEX IF EXISTS bookmark_song_date_idx;
+DROP INDEX IF EXISTS bookmark_album_date_idx;
+DROP INDEX IF EXISTS bookmark_album_name_date_idx;
+CREATE INDEX bookmark_name_idx
+          ON bookmark(profile, name);
+CREATE INDEX bookmark_song_date_idx
+          ON bookmark(profile, song_id, date_added DESC, id DESC);
+CREATE INDEX bookmark_album_date_idx
+          ON bookmark(profile, album_id, date_added DESC, id DESC);
+CREATE INDEX bookmark_album_name_date_idx
+          ON bookmark(profile, album_id, name, date_added);
+ALTER TABLE album_progress RENAME TO old_album_progress;
+CREATE TABLE album_progress (
+    profile      TEXT         NOT NULL,
+    album_id     INTEGER      NOT NULL,
+    position     REAL         NOT NULL,
+    duration     REAL         NOT NULL,
+    date_updated INTEGER      DEFAULT 0,
+    PRIMARY KEY (profile, album_id)
+);
+INSERT INTO album_progress (
+            profile, album_id, position, duration, date_updated)
+     SELECT 'default', album_id, position, duration, date_updated
+       FROM old_album_progress;
+DROP TABLE old_album_progress;
+''',
+    # Chapters of audio files, valid as long as the file is not modified.
+    '''
+CREATE TABLE chapter_cache (
+    file         TEXT         NOT NULL,
+    mtime        REAL         NOT NULL,
+    data         TEXT         NOT NULL,
+    PRIMARY KEY (file)
+);
+''',
+    # Track indexes are rebuilt in the playback order of songs split from
+    # a single file.
+    '''
+DELETE FROM album_index;
+''',
+    # Only the latest checkpoint of an album is kept. Imports used to add
+    # checkpoints as ordinary bookmarks.
+    '''
+DELETE FROM bookmark
+      WHERE name = 'checkpoint'
+        AND id NOT IN (SELECT (SELECT latest.id
+                                 FROM bookmark AS latest
+                                WHERE latest.profile = album.profile
+                                  AND latest.album_id = album.album_id
+                                  AND latest.name = 'checkpoint'
+                             ORDER BY latest.date_added DESC, latest.id DESC
+                                LIMIT 1)
+                         FROM (SELECT DISTINCT profile, album_id
+                                 FROM bookmark
+                                WHERE name = 'checkpoint') AS album);
+''',
+]
+
+# The distinct album IDs of a profile are found by skipping through the
+# (profile, album_id, date_added, id) index instead of scanning it.
+SQL_BOOKMARKED_ALBUMS = '''
+WITH RECURSIVE album(album_id) AS (
+    SELECT MIN(album_id)
+      FROM bookmark
+     WHERE profile = :profile
+ UNION ALL
+    SELECT (SELECT MIN(album_id)
+              FROM bookmark
+             WHERE profile = :profile
+               AND album_id > album.album_id)
+      FROM album
+     WHERE album.album_id IS NOT NULL
+)'''
+
+SQL_LATEST_ALBUM_BOOKMARKS = SQL_BOOKMARKED_ALBUMS + '''
+  SELECT bookmark.*
+    FROM album
+    JOIN bookmark
+      ON bookmark.id = (SELECT latest.id
+                          FROM bookmark AS latest
+                         WHERE latest.profile = :profile
+                           AND latest.album_id = album.album_id
+                      ORDER BY latest.date_added DESC, latest.id DESC
+                         LIMIT 1)
+ORDER BY bookmark.date_added DESC, bookmark.id DESC
+   LIMIT :limit OFFSET :offset;'''
+
+SQL_ALBUM_BOOKMARKS = '''
+  SELECT *
+    FROM bookmark
+   WHERE profile = :profile
+     AND album_id = :album_id
+ORDER BY date_added DESC, id DESC
+   LIMIT :limit OFFSET :offset;'''
+
+# Keeps a single checkpoint per album, reusing its ID, so that it is
+# updated with one statement.
+SQL_CHECKPOINT = '''
+INSERT OR REPLACE INTO bookmark (
+            id, name, song_id, album_id, position, date_added, profile)
+     VALUES ((SELECT id
+                FROM bookmark
+               WHERE profile = :profile
+                 AND album_id = :album_id
+                 AND name = :name),
+             :name, :song_id, :album_id, :position, :now, :profile);'''
+
+# Imports a checkpoint into the album's single checkpoint, unless that one
+# is at least as new.
+SQL_IMPORT_CHECKPOINT = '''
+INSERT OR REPLACE INTO bookmark (
+            id, name, song_id, album_id, position, date_added, profile)
+     SELECT (SELECT id
+               FROM bookmark
+              WHERE profile = :profile
+                AND album_id = :album_id
+                AND name = :name),
+            :name, :song_id, :album_id, :position, :date_added, :profile
+      WHERE NOT EXISTS (SELECT 1
+                          FROM bookmark
+                         WHERE profile = :profile
+                           AND album_id = :album_id
+                           AND name = :name
+                           AND date_added >= :date_added);'''
+
+# The latest bookmark of an album in every profile. The profiles are found
+# by skipping through an index, like the albums above.
+SQL_LATEST_PROFILE_BOOKMARKS = '''
+WITH RECURSIVE profiles(name) AS (
+    SELECT MIN(profile)
+      FROM bookmark
+ UNION ALL
+    SELECT (SELECT MIN(profile)
+              FROM bookmark
+             WHERE profile > profiles.name)
+      FROM profiles
+     WHERE profiles.name IS NOT NULL
+)
+SELECT *
+  FROM bookmark
+ WHERE id IN (SELECT (SELECT latest.id
+                        FROM bookmark AS latest
+                       WHERE latest.profile = profiles.name
+                         AND latest.album_id = :album_id
+                    ORDER BY latest.date_added DESC, latest.id DESC
+                       LIMIT 1)
+                FROM profiles);'''
+
+# The next (profile, album, name) bookmark groups after a group. Each range
+# is a seek in bookmark_album_name_date_idx, while a single OR of them
+# would scan the index from its start.
+SQL_COMPACTION_GROUPS = '''
+  SELECT *
+    FROM (SELECT *
+            FROM (  SELECT DISTINCT profile, album_id, name
+                      FROM bookmark
+                     WHERE profile = :profile
+                       AND album_id = :album_id
+                       AND name > :name
+                  ORDER BY profile, album_id, name
+                     LIMIT :limit)
+       UNION ALL
+          SELECT *
+            FROM (  SELECT DISTINCT profile, album_id, name
+                      FROM bookmark
+                     WHERE profile = :profile
+                       AND album_id > :album_id
+                  ORDER BY profile, album_id, name
+                     LIMIT :limit)
+       UNION ALL
+          SELECT *
+            FROM (  SELECT DISTINCT profile, album_id, name
+                      FROM bookmark
+                     WHERE profile > :profile
+                  ORDER BY profile, album_id, name
+                     LIMIT :limit))
+ORDER BY profile, album_id, name
+   LIMIT :limit;'''
+
+SQL_UNINDEXED_ALBUMS = SQL_BOOKMARKED_ALBUMS + '''
+SELECT album_id
+  FROM album
+ WHERE album_id IS NOT NULL
+   AND NOT EXISTS (SELECT 1
+                     FROM album_cache
+                    WHERE album_cache.album_id = album.album_id
+                      AND album_cache.details IS NOT NULL);'''
+
+# Albums with bookmarks whose songs were never cached, so their song titles
+# are not in the search index.
+SQL_UNINDEXED_SONG_ALBUMS = SQL_BOOKMARKED_ALBUMS + '''
+SELECT album_id
+  FROM album
+ WHERE album_id IS NOT NULL
+   AND NOT EXISTS (SELECT 1
+                     FROM album_cache
+                    WHERE album_cache.album_id = album.album_id
+                      AND album_cache.songs_cached > 0);'''
+
+# The latest bookmark (of the type `name`, if given) of each album in the
+# `matched` subquery. Albums without such a bookmark are left out.
+SQL_SEARCH = SQL_BOOKMARKED_ALBUMS + '''
+  SELECT *
+    FROM bookmark
+   WHERE id IN (SELECT (SELECT latest.id
+                          FROM bookmark AS latest
+                         WHERE latest.profile = :profile
+                           AND latest.album_id = matched.album_id
+                           AND (:name IS NULL OR latest.name = :name)
+                      ORDER BY latest.date_added DESC, latest.id DESC
+                         LIMIT 1)
+                  FROM (%s) AS matched)
+ORDER BY date_added DESC, id DESC
+   LIMIT :limit OFFSET :offset;'''
+
+SQL_SEARCH_ALL_ALBUMS = '''
+SELECT album_id
+  FROM album
+ WHERE album_id IS NOT NULL'''
+
+SQL_SEARCH_ITEMS = '''
+SELECT DISTINCT album_id
+  FROM search_item
+ WHERE instr(text, :text) > 0
+   AND (:field IS NULL OR field = :field)'''
+
+# Items with the rarest trigram of the query are checked for the query.
+SQL_SEARCH_TRIGRAM = SQL_SEARCH_ITEMS + '''
+   AND id IN (SELECT item_id
+                FROM search_trigram
+               WHERE trigram = :trigram)'''
 
 
 def wrap_bookmark(results):
@@ -47,51 +399,240 @@ def wrap_bookmark(results):
     return [Bookmark(*r) for r in results]
 
 
+def iter_bookmarks(cursor):
+    '''Yields the rows of a cursor as bookmarks, one at a time.'''
+    for row in cursor:
+        yield Bookmark(*row)
+
+
+# Length of SQL statements used as their name in profiles.
+SQL_NAME_LENGTH = 80
+
+
+def sql_name(sql):
+    return ' '.join(sql.split())[:SQL_NAME_LENGTH]
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    '''Cursor which times the statements it executes.'''
+
+    def execute(self, sql, *args):
+        return profiling.profiler.timed_call(
+            'sql', sql_name(sql), super(ProfiledCursor, self).execute,
+            sql, *args)
+
+    def executemany(self, sql, *args):
+        return profiling.profiler.timed_call(
+            'sql', sql_name(sql), super(ProfiledCursor, self).executemany,
+            sql, *args)
+
+    def executescript(self, script):
+        return profiling.profiler.timed_call(
+            'sql', 'script', super(ProfiledCursor, self).executescript,
+            script)
+
+
+class ProfiledConnection(sqlite3.Connection):
+    '''
+    Connection whose cursors time their statements, including the ones
+    run with :meth:`sqlite3.Connection.execute`.
+    '''
+
+    def cursor(self, factory=ProfiledCursor):
+        return super(ProfiledConnection, self).cursor(factory)
+
+
+def connection_factory():
+    '''Returns the connection class to use with :func:`sqlite3.connect`.'''
+    return (ProfiledConnection if profiling.profiler.enabled
+            else sqlite3.Connection)
+
+
+def _statements(script):
+    '''Splits an SQL script into complete statements.'''
+    statement = ''
+    for part in script.split(';'):
+        statement += part + ';'
+        # Semicolons also end the statements inside triggers.
+        if sqlite3.complete_statement(statement):
+            yield statement
+            statement = ''
+    if statement[:-1].strip():
+        # The last statement without a semicolon.
+        yield statement
+
+
 class Database(object):
 
-    SCHEMA = None
+    MIGRATIONS = ()
 
-    def __init__(self, db_path):
+    def __init__(self, db_path, wal=True, busy_timeout=BUSY_TIMEOUT,
+                 cache_size=None):
+        '''
+        :param wal: use write-ahead logging, so that readers and a writer
+            in different processes do not block each other.
+        :param busy_timeout: seconds to wait for a lock held by another
+            connection before failing with "database is locked".
+        :param cache_size: page cache size passed to ``PRAGMA
+            cache_size`` (pages if positive, KiB if negative). The SQLite
+            default is used if `None`.
+        '''
         self._db_path = db_path
+        self._wal = wal
+        self._busy_timeout = busy_timeout
+        self._cache_size = cache_size
         self._conn = None
         self._cr = None
 
     def __enter__(self):
-        self._connect()
-        self.initialize()
-        return self
+        return self.open()
 
     def __exit__(self, exc_class, exc, traceback):
         if any((exc_class, exc)):
             self._conn.rollback()
         else:
             self._conn.commit()
+        self.close()
+
+    def open(self):
+        '''Connects to the database and initializes the schema.'''
+        self._connect()
+        self.initialize()
+        return self
+
+    def close(self):
         self._conn.close()
+        self._conn, self._cr = None, None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''
+        Commits the changes made inside the with statement.
+
+        Meant for long-lived connections opened with :meth:`open`. The
+        changes are rolled back if an exception is raised.
+        '''
+        try:
+            yield self
+        except Exception:
+            self._conn.rollback()
+            raise
+        else:
+            self._conn.commit()
 
     def _connect(self):
-        self._conn = sqlite3.connect(self._db_path)
+        self._conn = sqlite3.connect(
+            self._db_path, timeout=self._busy_timeout,
+            factory=connection_factory())
         self._cr = self._conn.cursor()
+        if self._wal:
+            self._cr.execute('PRAGMA journal_mode = WAL;')
+            # Durable enough with WAL: a power loss can only lose the
+            # latest transactions, never corrupt the database.
+            self._cr.execute('PRAGMA synchronous = NORMAL;')
+        if self._cache_size is not None:
+            self._cr.execute(
+                'PRAGMA cache_size = %d;' % int(self._cache_size))
 
     @property
     def cr(self):
         return self._cr
 
+    @property
+    def version(self):
+        return self._cr.execute('PRAGMA user_version;').fetchone()[0]
+
     def initialize(self):
-        self._cr.executescript(self.SCHEMA)
+        '''
+        Applies the migrations which the database is missing.
+
+        Connections which find the same old version at once, such as those
+        of the service and the plugin after an upgrade, apply each
+        migration only once (see :meth:`_migrate`).
+        '''
+        version = self.version
+        for script in self.MIGRATIONS[version:]:
+            version += 1
+            self._migrate(version, script)
+
+    def _migrate(self, version, script):
+        '''
+        Applies a migration script in a single transaction, unless another
+        connection has applied it since the version was read.
+
+        The transaction takes the write lock before it reads the version
+        again. The statements are executed one by one, since
+        ``executescript`` would commit the transaction first.
+        '''
+        isolation_level = self._conn.isolation_level
+        # Otherwise sqlite3 commits before PRAGMA and CREATE statements.
+        self._conn.isolation_level = None
+        try:
+            self._cr.execute('BEGIN IMMEDIATE;')
+            if self.version < version:
+                for statement in _statements(script):
+                    self._cr.execute(statement)
+                self._cr.execute('PRAGMA user_version = %d;' % version)
+            self._cr.execute('COMMIT;')
+        except sqlite3.Error:
+            try:
+                self._cr.execute('ROLLBACK;')
+            except sqlite3.OperationalError:
+                # The transaction was not started.
+                pass
+            raise
+        finally:
+            self._conn.isolation_level = isolation_level
+
+    def vacuum(self):
+        '''Rebuilds the database file to reclaim unused space.'''
+        # VACUUM can not be run inside a transaction.
+        self._conn.commit()
+        self._cr.execute('VACUUM;')
 
 
 class AusisDatabase(Database):
 
-    SCHEMA = SQL_SCHEMA
+    MIGRATIONS = SQL_MIGRATIONS
+
+    def __init__(self, db_path, profile=None, **kwargs):
+        '''
+        :param profile: the profile whose bookmarks are read and written,
+            :data:`DEFAULT_PROFILE` if `None`. It can be switched later by
+            setting :attr:`profile`.
+        '''
+        super(AusisDatabase, self).__init__(db_path, **kwargs)
+        self.profile = profile
+
+    @property
+    def profile(self):
+        return self._profile
+
+    @profile.setter
+    def profile(self, profile):
+        self._profile = profile or DEFAULT_PROFILE
+
+    def add_bookmark(self, name, song_id, album_id, position,
+                     date_added=None):
+        now = int(time.time() if date_added is None else date_added)
+        bookmark_id = self._insert_bookmark(
+            name, song_id, album_id, position, now)
+        self._update_progress(album_id, song_id, position, now)
+        return bookmark_id
+
+    def _insert_bookmark(self, name, song_id, album_id, position, now):
+        profile = self.profile
+        if name == CHECKPOINT:
+            self.cr.execute(SQL_CHECKPOINT, locals())
+            return self.cr.lastrowid
 
-    def add_bookmark(self, name, song_id, album_id, position):
-        now = int(time.time())
         if name == 'started':
             bookmark = None
             q = '''
 SELECT *
   FROM bookmark
- WHERE name = :name
+ WHERE profile = :profile
+   AND name = :name
    AND song_id = :song_id
    AND album_id = :album_id;'''
             self.cr.execute(q, locals())
@@ -111,43 +652,484 @@ UPDATE bookmark
                 return bookmark.id
 
         query = '''
-INSERT INTO bookmark (name, song_id, album_id, position, date_added)
-     VALUES (:name, :song_id, :album_id, :position, :now);'''
+INSERT INTO bookmark (name, song_id, album_id, position, date_added, profile)
+     VALUES (:name, :song_id, :album_id, :position, :now, :profile);'''
         self.cr.execute(query, locals())
         return self.cr.lastrowid
 
+    def _iter(self, query, params=None):
+        # A separate cursor, so that other queries can run while the
+        # bookmarks are being consumed.
+        return iter_bookmarks(self._conn.execute(query, params or {}))
+
+    def iter_albums(self, limit=-1, offset=0):
+        '''
+        Yields the latest bookmark of every album, newest first.
+
+        At most `limit` bookmarks are yielded (all if negative), skipping
+        the first `offset` ones.
+        '''
+        profile = self.profile
+        return self._iter(SQL_LATEST_ALBUM_BOOKMARKS, locals())
+
     def get_albums(self):
-        query = '''
-  SELECT *
-    FROM bookmark
-GROUP BY album_id
-ORDER BY date_added DESC;'''
-        return wrap_bookmark(self.cr.execute(query).fetchall())
+        return list(self.iter_albums())
+
+    def iter_all_bookmarks(self):
+        return self._iter('''
+SELECT *
+  FROM bookmark
+ WHERE profile = :profile;''', {'profile': self.profile})
+
+    def insert_bookmarks(self, bookmarks):
+        '''
+        Adds bookmarks given as dicts, skipping the ones with the same
+        album, song, name and date as an existing bookmark.
+
+        A checkpoint replaces the album's checkpoint if it is newer and is
+        skipped otherwise, so that an album keeps a single checkpoint.
+
+        Returns the number of added bookmarks.
+        '''
+        bookmarks = [
+            dict(bookmark, profile=self.profile) for bookmark in bookmarks]
+        changes = self._conn.total_changes
+        self.cr.executemany('''
+INSERT INTO bookmark (name, song_id, album_id, position, date_added, profile)
+     SELECT :name, :song_id, :album_id, :position, :date_added, :profile
+      WHERE NOT EXISTS (SELECT 1
+                          FROM bookmark
+                         WHERE profile = :profile
+                           AND album_id = :album_id
+                           AND name = :name
+                           AND date_added = :date_added
+                           AND song_id = :song_id);''', [
+            b for b in bookmarks if b['name'] != CHECKPOINT])
+        self.cr.executemany(SQL_IMPORT_CHECKPOINT, [
+            b for b in bookmarks if b['name'] == CHECKPOINT])
+        return self._conn.total_changes - changes
 
     def get_all_bookmarks(self):
-        return wrap_bookmark(
-            self.cr.execute('SELECT * FROM bookmark;').fetchall())
+        return list(self.iter_all_bookmarks())
 
     def get_bookmark(self, bookmark_id):
+        profile = self.profile
         query = '''
 SELECT *
   FROM bookmark
- WHERE id = :bookmark_id;'''
+ WHERE id = :bookmark_id
+   AND profile = :profile;'''
         self.cr.execute(query, locals())
         result = wrap_bookmark(self.cr.fetchone())
         return result if result else None
 
+    def iter_album_bookmarks(self, album_id, limit=-1, offset=0):
+        '''
+        Yields the bookmarks of an album, newest first.
+
+        `limit` and `offset` work as in :meth:`iter_albums`.
+        '''
+        profile = self.profile
+        return self._iter(SQL_ALBUM_BOOKMARKS, locals())
+
     def get_album_bookmarks(self, album_id):
+        return list(self.iter_album_bookmarks(album_id))
+
+    def get_latest_album_bookmark(self, album_id):
+        profile = self.profile
         query = '''
   SELECT *
     FROM bookmark
-   WHERE album_id = :album_id
-ORDER BY date_added DESC;'''
-        return wrap_bookmark(self.cr.execute(query, locals()).fetchall())
+   WHERE profile = :profile
+     AND album_id = :album_id
+ORDER BY date_added DESC, id DESC
+   LIMIT 1;'''
+        self.cr.execute(query, locals())
+        return wrap_bookmark(self.cr.fetchone())
 
     def remove_album_bookmarks(self, album_id):
+        profile = self.profile
+        self.cr.execute('''
+DELETE FROM album_progress
+      WHERE profile = :profile
+        AND album_id = :album_id;''', locals())
         query = '''
 DELETE FROM bookmark
-      WHERE album_id = :album_id;'''
+      WHERE profile = :profile
+        AND album_id = :album_id;'''
         self.cr.execute(query, locals())
         return self.cr.connection.total_changes >= 1
+
+    def compact_bookmarks(self, keep, after=None, limit=50):
+        '''
+        Removes old bookmarks of up to `limit` (profile, album, name)
+        groups of all the profiles.
+
+        The latest `keep` bookmarks of every group and the latest bookmark
+        of every song in every profile are kept. Groups are processed in
+        (profile, album ID, name) order, starting after the `after` group.
+
+        Returns the number of removed bookmarks and the last processed
+        group, which is `None` once all the groups have been processed.
+        '''
+        profile, album_id, name = after or ('', -1, '')
+        groups = self.cr.execute(
+            SQL_COMPACTION_GROUPS, locals()).fetchall()
+
+        removed = 0
+        for profile, album_id, name in groups:
+            # The newest bookmark of the group which is not kept.
+            oldest = self.cr.execute('''
+  SELECT date_added, id
+    FROM bookmark
+   WHERE profile = :profile
+     AND album_id = :album_id
+     AND name = :name
+ORDER BY date_added DESC, id DESC
+   LIMIT 1 OFFSET :keep;''', locals()).fetchone()
+            if not oldest:
+                continue
+            date_added, bookmark_id = oldest
+            self.cr.execute('''
+DELETE FROM bookmark
+      WHERE profile = :profile
+        AND album_id = :album_id
+        AND name = :name
+        AND (date_added < :date_added
+             OR (date_added = :date_added AND id <= :bookmark_id))
+        AND id NOT IN (
+            SELECT (SELECT latest.id
+                      FROM bookmark AS latest
+                     WHERE latest.profile = :profile
+                       AND latest.song_id = song.song_id
+                  ORDER BY latest.date_added DESC, latest.id DESC
+                     LIMIT 1)
+              FROM (SELECT DISTINCT song_id
+                      FROM bookmark
+                     WHERE profile = :profile
+                       AND album_id = :album_id) AS song);''', locals())
+            removed += self.cr.rowcount
+
+        last = groups[-1] if len(groups) == limit else None
+        return removed, last
+
+    def get_cached_albums(self, album_ids, max_age):
+        '''
+        Returns a dict of cached album details keyed by album ID.
+
+        Albums cached more than `max_age` seconds ago are left out.
+        '''
+        query = '''
+SELECT album_id, details
+  FROM album_cache
+ WHERE album_id = :album_id
+   AND details IS NOT NULL
+   AND date_cached >= :min_date;'''
+        min_date = int(time.time()) - max_age
+        result = {}
+        for album_id in set(album_ids):
+            row = self.cr.execute(query, locals()).fetchone()
+            if row:
+                result[row[0]] = json.loads(row[1])
+        return result
+
+    def cache_albums(self, albums):
+        '''Caches album details given as a dict keyed by album ID.'''
+        now = int(time.time())
+        values = [{
+            'album_id': album_id,
+            'details': json.dumps(details),
+            'now': now,
+        } for album_id, details in albums.items()]
+        self.cr.executemany('''
+INSERT OR IGNORE INTO album_cache (album_id)
+               VALUES (:album_id);''', values)
+        self.cr.executemany('''
+UPDATE album_cache
+   SET details = :details,
+       date_cached = :now
+ WHERE album_id = :album_id;''', values)
+        for album_id, details in albums.items():
+            self._remove_search_items(album_id, ('title', 'artist'))
+            self._add_search_items(search.album_items(album_id, details))
+
+    def get_cached_album_songs(self, album_id, max_age):
+        '''
+        Returns the cached songs of an album.
+
+        Returns `None` if the album's songs are not cached or were cached
+        more than `max_age` seconds ago.
+        '''
+        query = '''
+SELECT 1
+  FROM album_cache
+ WHERE album_id = :album_id
+   AND songs_cached >= :min_date;'''
+        min_date = int(time.time()) - max_age
+        if not self.cr.execute(query, locals()).fetchone():
+            return None
+        query = '''
+SELECT details
+  FROM song_cache
+ WHERE album_id = :album_id;'''
+        return [
+            json.loads(details) for details,
+            in self.cr.execute(query, locals()).fetchall()
+        ]
+
+    def cache_album_songs(self, album_id, songs):
+        now = int(time.time())
+        self.cr.execute('''
+DELETE FROM album_index
+      WHERE album_id = :album_id;''', locals())
+        self.cr.execute('''
+DELETE FROM song_cache
+      WHERE album_id = :album_id;''', locals())
+        self.cr.executemany('''
+INSERT OR REPLACE INTO song_cache (song_id, album_id, details)
+                  VALUES (:song_id, :album_id, :details);''', [{
+            'song_id': song['songid'],
+            'album_id': album_id,
+            'details': json.dumps(song),
+        } for song in songs])
+        self._remove_search_items(album_id, ('song',))
+        self._add_search_items(search.song_items(album_id, songs))
+        self.cr.execute('''
+INSERT OR IGNORE INTO album_cache (album_id)
+               VALUES (:album_id);''', locals())
+        self.cr.execute('''
+UPDATE album_cache
+   SET songs_cached = :now
+ WHERE album_id = :album_id;''', locals())
+
+    def get_track_index(self, album_id):
+        '''Returns the stored track index data of an album or `None`.'''
+        query = '''
+SELECT data
+  FROM album_index
+ WHERE album_id = :album_id;'''
+        row = self.cr.execute(query, locals()).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def store_track_index(self, album_id, data):
+        self.cr.execute('''
+INSERT OR REPLACE INTO album_index (album_id, data)
+                  VALUES (:album_id, :data);''', {
+            'album_id': album_id,
+            'data': json.dumps(data, separators=(',', ':')),
+        })
+        # Durations may have changed, recalculate the progress of every
+        # profile.
+        bookmarks = wrap_bookmark(self.cr.execute(
+            SQL_LATEST_PROFILE_BOOKMARKS, locals()).fetchall())
+        index = tracks.TrackIndex.load(data) if bookmarks else None
+        for latest in bookmarks:
+            self._update_progress(
+                album_id, latest.song_id, latest.position,
+                latest.date_added, index=index, force=True,
+                profile=latest.profile)
+
+    def _update_progress(self, album_id, song_id, position, date_added,
+                         index=None, force=False, profile=None):
+        '''
+        Updates the progress of an album in a profile (the current one by
+        default) with a bookmark position.
+
+        Older bookmarks than the one the progress was calculated from are
+        ignored, unless `force` is set. Nothing is done if the album has
+        no track index yet.
+        '''
+        if index is None:
+            data = self.get_track_index(album_id)
+            if data is None:
+                return
+            index = tracks.TrackIndex.load(data)
+        book_offset = index.book_offset(song_id, position)
+        if book_offset is None:
+            return
+        self.cr.execute('''
+INSERT OR REPLACE INTO album_progress (
+            profile, album_id, position, duration, date_updated)
+     SELECT :profile, :album_id, :book_offset, :duration, :date_added
+      WHERE :force
+         OR NOT EXISTS (SELECT 1
+                          FROM album_progress
+                         WHERE profile = :profile
+                           AND album_id = :album_id
+                           AND date_updated > :date_added);''', {
+            'profile': profile or self.profile,
+            'album_id': album_id,
+            'book_offset': book_offset,
+            'duration': index.total_duration,
+            'date_added': date_added,
+            'force': force,
+        })
+
+    def get_albums_progress(self, album_ids):
+        '''
+        Returns a dict of (position, duration) tuples of albums within the
+        whole book keyed by album ID.
+        '''
+        profile = self.profile
+        query = '''
+SELECT album_id, position, duration
+  FROM album_progress
+ WHERE profile = :profile
+   AND album_id = :album_id;'''
+        result = {}
+        for album_id in set(album_ids):
+            row = self.cr.execute(query, locals()).fetchone()
+            if row:
+                result[row[0]] = row[1:]
+        return result
+
+    def invalidate_album(self, album_id):
+        self._remove_search_items(album_id, search.FIELDS)
+        self.cr.execute('''
+DELETE FROM album_index
+      WHERE album_id = :album_id;''', locals())
+        self.cr.execute('''
+DELETE FROM song_cache
+      WHERE album_id = :album_id;''', locals())
+        self.cr.execute('''
+DELETE FROM album_cache
+      WHERE album_id = :album_id;''', locals())
+
+    def invalidate_song(self, song_id):
+        self.cr.execute('''
+DELETE FROM album_index
+      WHERE album_id IN (SELECT album_id
+                           FROM song_cache
+                          WHERE song_id = :song_id);''', locals())
+        self.cr.execute('''
+UPDATE album_cache
+   SET songs_cached = 0
+ WHERE album_id IN (SELECT album_id
+                      FROM song_cache
+                     WHERE song_id = :song_id);''', locals())
+        self.cr.execute('''
+DELETE FROM song_cache
+      WHERE song_id = :song_id;''', locals())
+        self.cr.execute('''
+DELETE FROM search_item
+      WHERE song_id = :song_id;''', locals())
+
+    def clear_cache(self):
+        '''
+        Removes all the cached metadata.
+
+        The search index is kept, its items are replaced when the albums
+        and songs are cached again. Chapters are kept as well, they are
+        checked against the modification time of their file.
+        '''
+        self.cr.execute('DELETE FROM album_index;')
+        self.cr.execute('DELETE FROM song_cache;')
+        self.cr.execute('DELETE FROM album_cache;')
+
+    def get_cached_chapters(self, path, mtime):
+        '''
+        Returns the cached chapters of a file or `None` if they are not
+        cached or the file was modified at another `mtime` since.
+        '''
+        query = '''
+SELECT data
+  FROM chapter_cache
+ WHERE file = :path
+   AND mtime = :mtime;'''
+        row = self.cr.execute(query, locals()).fetchone()
+        if row is None:
+            return None
+        return [chapters.Chapter(*c) for c in json.loads(row[0])]
+
+    def cache_chapters(self, path, mtime, file_chapters):
+        self.cr.execute('''
+INSERT OR REPLACE INTO chapter_cache (file, mtime, data)
+                  VALUES (:path, :mtime, :data);''', {
+            'path': path,
+            'mtime': mtime,
+            'data': json.dumps(file_chapters, separators=(',', ':')),
+        })
+
+    def _remove_search_items(self, album_id, fields):
+        self.cr.executemany('''
+DELETE FROM search_item
+      WHERE album_id = :album_id
+        AND field = :field;''', [
+            {'album_id': album_id, 'field': field} for field in fields])
+
+    def _add_search_items(self, items):
+        for album_id, song_id, field, text in items:
+            text = search.normalize(text)
+            if not text:
+                continue
+            self.cr.execute('''
+INSERT INTO search_item (album_id, song_id, field, text)
+     VALUES (:album_id, :song_id, :field, :text);''', locals())
+            item_id = self.cr.lastrowid
+            self.cr.executemany('''
+INSERT INTO search_trigram (trigram, item_id)
+     VALUES (:trigram, :item_id);''', [
+                {'trigram': trigram, 'item_id': item_id}
+                for trigram in search.trigrams(text)])
+
+    def get_unindexed_album_ids(self, songs=False):
+        '''
+        Returns the IDs of albums with bookmarks whose details (or songs,
+        if `songs` is set) are not cached, so they are not in the search
+        index either.
+        '''
+        query = SQL_UNINDEXED_SONG_ALBUMS if songs else SQL_UNINDEXED_ALBUMS
+        return [
+            album_id for album_id, in self.cr.execute(
+                query, {'profile': self.profile}).fetchall()
+        ]
+
+    def iter_search(self, query='', field=None, name=None, limit=-1,
+                    offset=0):
+        '''
+        Yields the latest bookmark of each album matching a search, newest
+        first.
+
+        Albums match if the album title, artist or a song title (only the
+        `field` one, if given) contains `query` and they have a bookmark
+        of type `name`, if given. An empty `query` matches all albums.
+        `limit` and `offset` work as in :meth:`iter_albums`.
+        '''
+        text = search.normalize(query)
+        params = {
+            'profile': self.profile,
+            'text': text,
+            'field': field,
+            'name': name,
+            'limit': limit,
+            'offset': offset,
+        }
+        if not text:
+            matched = SQL_SEARCH_ALL_ALBUMS
+        elif len(text) < 3:
+            matched = SQL_SEARCH_ITEMS
+        else:
+            trigram = self._rarest_trigram(text)
+            if trigram is None:
+                return iter([])
+            params['trigram'] = trigram
+            matched = SQL_SEARCH_TRIGRAM
+        return self._iter(SQL_SEARCH % matched, params)
+
+    def _rarest_trigram(self, text):
+        '''
+        Returns the trigram of `text` with the fewest items or `None` if
+        some trigram has none, so that nothing can match.
+        '''
+        trigrams = sorted(search.trigrams(text))[:search.MAX_TRIGRAMS]
+        params = {
+            'trigram%d' % i: trigram for i, trigram in enumerate(trigrams)}
+        query = '''
+SELECT trigram, items
+  FROM search_trigram_count
+ WHERE trigram IN (%s)
+   AND items > 0;''' % ', '.join(':%s' % key for key in params)
+        counts = self.cr.execute(query, params).fetchall()
+        if len(counts) < len(trigrams):
+            return None
+        return min(counts, key=lambda row: row[1])[0]
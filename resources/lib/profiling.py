@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+'''
+Opt-in timing of the plugin modes, player events and SQL queries.
+
+Profiling is enabled with the hidden ``profiling`` setting. The wall time
+spent in each section is summarized in the Kodi log. SQL statements are
+timed by the cursors of :class:`db.ProfiledConnection`, JSON-RPC calls by
+:class:`common.JSONRPCClient` itself.
+'''
+
+import collections
+import contextlib
+import threading
+import time
+
+
+class Profiler(object):
+    '''
+    Collects the number of calls and the wall time of named sections,
+    grouped by category.
+
+    When disabled, timing a section costs a single attribute check.
+    '''
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stats = collections.defaultdict(collections.Counter)
+        # The bookmark writer runs queries on its own thread.
+        self._lock = threading.Lock()
+
+    def add(self, category, name, seconds):
+        with self._lock:
+            stats = self.stats[category, name]
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+
+    @contextlib.contextmanager
+    def timed(self, category, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(category, name, time.time() - start)
+
+    def timed_call(self, category, name, func, *args, **kwargs):
+        with self.timed(category, name):
+            return func(*args, **kwargs)
+
+    def log_summary(self, log):
+        '''Logs the collected stats, the slowest sections first.'''
+        with self._lock:
+            stats = sorted(
+                self.stats.items(), key=lambda item: item[1]['seconds'],
+                reverse=True)
+        for (category, name), counts in stats:
+            log('Profile %s %s: %d calls, %.1f ms' % (
+                category, name, counts['calls'], counts['seconds'] * 1000))
+
+    def clear(self):
+        with self._lock:
+            self.stats.clear()
+
+
+profiler = Profiler()
+
+
+def call_profiled(path, func, *args, **kwargs):
+    '''
+    Calls a function under :mod:`cProfile` if profiling is enabled and
+    dumps the profile to `path`.
+    '''
+    if not (profiler.enabled and path):
+        return func(*args, **kwargs)
+    import cProfile
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        profile.dump_stats(path)
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+'''
+Text normalization for the trigram search index.
+
+Album titles, artists and song titles are stored lower-cased together with
+their trigrams. A search looks up the items which have the rarest trigram
+of the query and checks that they really contain it.
+'''
+
+# Searchable fields of the index.
+FIELDS = ('title', 'artist', 'song')
+# Only this many trigrams of long queries are looked up.
+MAX_TRIGRAMS = 32
+
+
+def normalize(text):
+    '''Lower-cases text and collapses its whitespace.'''
+    return ' '.join((text or '').lower().split())
+
+
+def trigrams(text):
+    '''Returns the set of trigrams of normalized text.'''
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def album_items(album_id, details):
+    '''Returns the (album_id, song_id, field, text) items of an album.'''
+    if not details:
+        return []
+    return [
+        (album_id, None, 'title', details.get('title')),
+        (album_id, None, 'artist', ', '.join(details.get('artist') or [])),
+    ]
+
+
+def song_items(album_id, songs):
+    '''Returns the (album_id, song_id, field, text) items of songs.'''
+    return [
+        (album_id, song.get('songid'), 'song', song.get('title'))
+        for song in songs
+    ]
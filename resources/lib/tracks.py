@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+'''Position lookups within multi-file audiobooks.'''
+
+import bisect
+import operator
+
+# Songs split from a single file (with a cue sheet) are ordered by ID.
+playback_order = operator.itemgetter('file', 'songid')
+
+
+def cumulative(durations):
+    '''Returns the start offsets of consecutive durations and their sum.'''
+    offsets, total = [0], 0
+    for duration in durations:
+        total += duration
+        offsets.append(total)
+    return offsets
+
+
+class TrackIndex(object):
+    '''
+    Compact index of the tracks of an album in playback order (see
+    :data:`playback_order`).
+
+    Resolves a song ID to its track number and a position within a song
+    to an offset within the whole book with a binary search.
+    '''
+
+    def __init__(self, song_ids, offsets, sorted_ids, sorted_tracks):
+        self.song_ids = song_ids
+        # Start of every track within the book and the total duration.
+        self.offsets = offsets
+        self._sorted_ids = sorted_ids
+        self._sorted_tracks = sorted_tracks
+
+    @classmethod
+    def from_songs(cls, songs):
+        '''Builds the index from song details of an album.'''
+        songs = sorted(songs, key=playback_order)
+        song_ids = [song['songid'] for song in songs]
+        offsets = cumulative(song.get('duration') or 0 for song in songs)
+        by_id = sorted((song_id, track) for track, song_id in enumerate(
+            song_ids))
+        return cls(
+            song_ids,
+            offsets,
+            [song_id for song_id, _ in by_id],
+            [track for _, track in by_id],
+        )
+
+    @classmethod
+    def load(cls, data):
+        return cls(
+            data['song_ids'], data['offsets'],
+            data['sorted_ids'], data['sorted_tracks'])
+
+    def dump(self):
+        return {
+            'song_ids': self.song_ids,
+            'offsets': self.offsets,
+            'sorted_ids': self._sorted_ids,
+            'sorted_tracks': self._sorted_tracks,
+        }
+
+    def __len__(self):
+        return len(self.song_ids)
+
+    @property
+    def total_duration(self):
+        return self.offsets[-1]
+
+    def track_of(self, song_id):
+        '''Returns the track number of a song or `None`.'''
+        i = bisect.bisect_left(self._sorted_ids, song_id)
+        if i < len(self._sorted_ids) and self._sorted_ids[i] == song_id:
+            return self._sorted_tracks[i]
+
+    def book_offset(self, song_id, position):
+        '''
+        Returns the offset within the whole book of a position within a
+        song or `None` if the song is not in the album.
+        '''
+        track = self.track_of(song_id)
+        if track is not None:
+            return self.offsets[track] + position
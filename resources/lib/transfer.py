@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+'''
+Streaming export and import of bookmarks.
+
+Bookmarks are written one per line, either as JSON objects or as CSV rows.
+Besides the IDs, every bookmark carries the file path of its song, which
+is used to find the song and the album in another music library. Files
+are read and written row by row, so that large histories are never held
+in memory.
+'''
+
+import csv
+import itertools
+import json
+
+FORMATS = ('jsonl', 'csv')
+FIELDS = ('name', 'file', 'song_id', 'album_id', 'position', 'date_added')
+# Bookmarks imported in a single transaction.
+BATCH_SIZE = 10000
+
+
+def export_rows(bookmarks, song_files):
+    '''
+    Yields the rows of bookmarks to export.
+
+    :param song_files: a dict of song file paths keyed by song ID.
+    '''
+    for bookmark in bookmarks:
+        yield {
+            'name': bookmark.name,
+            'file': song_files.get(bookmark.song_id),
+            'song_id': bookmark.song_id,
+            'album_id': bookmark.album_id,
+            'position': bookmark.position,
+            'date_added': bookmark.date_added,
+        }
+
+
+def _encode(value):
+    if value is None:
+        return b''
+    return value.encode('utf-8') if isinstance(value, unicode) else value
+
+
+def write_rows(rows, fileobj, fmt):
+    '''Writes rows to a file opened in binary mode. Returns their number.'''
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(fileobj)
+        writer.writerow([_encode(f) for f in FIELDS])
+        for count, row in enumerate(rows, 1):
+            writer.writerow([_encode(row[f]) for f in FIELDS])
+    else:
+        for count, row in enumerate(rows, 1):
+            line = json.dumps(row, separators=(',', ':'))
+            fileobj.write(line.encode('utf-8') + b'\n')
+    return count
+
+
+def _parse_row(row):
+    try:
+        return {
+            'name': row['name'],
+            'file': row.get('file') or None,
+            'song_id': int(row['song_id']),
+            'album_id': int(row['album_id']),
+            'position': float(row['position']),
+            'date_added': int(row['date_added']),
+        }
+    except (AttributeError, KeyError, TypeError) as e:
+        raise ValueError('Malformed bookmark row: %r' % (e,))
+
+
+def read_rows(fileobj, fmt):
+    '''
+    Yields the rows of a file opened in binary mode.
+
+    Raises :exc:`ValueError` on malformed rows.
+    '''
+    if fmt == 'csv':
+        try:
+            for row in csv.DictReader(fileobj):
+                yield _parse_row({
+                    k.decode('utf-8'): v.decode('utf-8')
+                    for k, v in row.items() if k and v is not None
+                })
+        except csv.Error as e:
+            raise ValueError('Malformed CSV: %s' % e)
+    else:
+        for line in fileobj:
+            if line.strip():
+                yield _parse_row(json.loads(line))
+
+
+def remap_rows(rows, songs_by_file, stats):
+    '''
+    Replaces the song and album IDs of rows with the ones of the song with
+    the same file in this library.
+
+    Rows without a file or whose file is not in the library are skipped
+    and counted in ``stats['unknown']``: their IDs are those of the library
+    they were exported from.
+
+    :param songs_by_file: a dict of (song ID, album ID) keyed by file path.
+    '''
+    for row in rows:
+        ids = songs_by_file.get(row['file']) if row['file'] else None
+        if ids is None:
+            stats['unknown'] += 1
+            continue
+        row['song_id'], row['album_id'] = ids
+        yield row
+
+
+def import_rows(db, rows, stats, batch_size=BATCH_SIZE):
+    '''
+    Adds the bookmarks of rows to the database in transactions of
+    `batch_size` rows.
+
+    Bookmarks which are already in the database are skipped. The numbers
+    of added and skipped rows are counted in ``stats['added']`` and
+    ``stats['duplicate']``.
+    '''
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        with db.transaction():
+            added = db.insert_bookmarks(batch)
+        stats['added'] += added
+        stats['duplicate'] += len(batch) - added
+    return stats
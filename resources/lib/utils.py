@@ -2,14 +2,32 @@
 from __future__ import unicode_literals
 
 import base64
+import collections
 import json
 import operator
 import os
-import urllib
+import posixpath
 import urlparse
 
 
 first_of = operator.itemgetter(0)
+# Paths on these are compared as they are, without resolving symlinks.
+NETWORK_SCHEMES = frozenset([
+    'dav',
+    'davs',
+    'ftp',
+    'ftps',
+    'http',
+    'https',
+    'nfs',
+    'sftp',
+    'smb',
+    'upnp',
+])
+_missing = object()
+# Characters which are not quoted in query strings.
+_safe_chars = frozenset(
+    b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_.-')
 
 
 def decode_arg(arg, encoding='utf-8'):
@@ -29,6 +47,25 @@ def encode_values(d):
     return {encode_arg(k): encode_arg(v) for k, v in d.items()}
 
 
+def quote_plus(s):
+    '''
+    Quotes a byte string like :func:`urllib.quote_plus`.
+
+    urllib is not used, as importing it loads the socket and ssl modules,
+    which is a large part of the plugin's start-up time.
+    '''
+    return b''.join(
+        c if c in _safe_chars else b'+' if c == b' ' else b'%%%02X' % ord(c)
+        for c in s)
+
+
+def urlencode(query):
+    '''Like :func:`urllib.urlencode`, but unicode is encoded as UTF-8.'''
+    return '&'.join('%s=%s' % tuple(
+        quote_plus(encode_arg(v) if isinstance(v, basestring) else str(v))
+        for v in item) for item in query.items())
+
+
 def dump_data(data):
     return base64.b64encode(json.dumps(data)) if data else ''
 
@@ -61,7 +98,38 @@ def format_duration(s):
 
 
 def remove_scheme(path):
-    return urlparse.urlparse(urllib.unquote(path)).path
+    return urlparse.urlparse(urlparse.unquote(path)).path
+
+
+def split_path(path):
+    '''
+    Splits a path or URL into a (location, path) pair, which can be
+    compared with other pairs.
+
+    The location is ``scheme://host`` for network shares and empty for local
+    files, whose path is resolved with :func:`os.path.realpath`.
+    '''
+    url = urlparse.urlparse(urlparse.unquote(path))
+    scheme = url.scheme.lower()
+    if scheme in NETWORK_SCHEMES:
+        return (
+            '%s://%s' % (scheme, url.netloc.lower()),
+            posixpath.normpath(url.path or '/'),
+        )
+    return '', os.path.realpath(url.path)
+
+
+def _split_directory(directory):
+    location, path = split_path(directory)
+    join = posixpath.join if location else os.path.join
+    return location, join(path, '')
+
+
+def _in_split_directory(location_path, directory):
+    location, path = location_path
+    dir_location, dir_path = directory
+    return (location == dir_location and
+            os.path.commonprefix([path, dir_path]) == dir_path)
 
 
 def in_directory(filename, directory):
@@ -70,7 +138,66 @@ def in_directory(filename, directory):
 
     Based on http://stackoverflow.com/q/3812849/
     '''
-    filename = remove_scheme(filename)
-    filename, directory = map(os.path.realpath, [filename, directory])
-    directory = os.path.join(directory, '')
-    return os.path.commonprefix([filename, directory]) == directory
+    return _in_split_directory(
+        split_path(filename), _split_directory(directory))
+
+
+class LRUCache(object):
+    '''A mapping which keeps only the `maxsize` most recently used items.'''
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        value = self._items.pop(key, _missing)
+        if value is _missing:
+            return default
+        self._items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+
+class DirectoryFilter(object):
+    '''
+    Checks if files are inside any of the given directories.
+
+    The directories are resolved once and the decisions for recently seen
+    files are memoized. A filter without directories matches every file.
+    '''
+
+    def __init__(self, directories, maxsize=256):
+        self.directories = [
+            _split_directory(directory)
+            for directory in directories if directory
+        ]
+        self._matches = LRUCache(maxsize)
+
+    def __nonzero__(self):
+        return bool(self.directories)
+
+    def matches(self, filename):
+        if not self.directories:
+            return True
+        result = self._matches.get(filename)
+        if result is None:
+            location_path = split_path(filename)
+            result = any(
+                _in_split_directory(location_path, directory)
+                for directory in self.directories)
+            self._matches[filename] = result
+        return result
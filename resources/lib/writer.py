@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+'''Background database writer used by the playback service.'''
+
+import collections
+import Queue
+import threading
+import time
+
+_STOP = object()
+
+BookmarkEvent = collections.namedtuple(
+    'BookmarkEvent', 'name song_id album_id position date_added')
+
+
+def _noop_log(msg, error=False):
+    pass
+
+
+class BookmarkWriter(threading.Thread):
+    '''
+    Writes bookmarks to the database on a background thread.
+
+    Events are taken from a queue. Events which arrive within `window`
+    seconds of the first one are written in a single transaction, and
+    events of the same type on the same song are coalesced into the one
+    with the latest position.
+
+    The database is opened and used only on the writer thread. Other
+    database work can be run on it in order with :meth:`submit`.
+
+    :attr:`window` can be changed while the writer runs. The change applies
+    from the next batch.
+    '''
+
+    def __init__(self, open_db, window=1.0, log=_noop_log):
+        super(BookmarkWriter, self).__init__(name='ausis-writer')
+        self.daemon = True
+        self._open_db = open_db
+        self.window = window
+        self._log = log
+        self._queue = Queue.Queue()
+
+    def add_bookmark(self, name, song_id, album_id, position):
+        '''Queues a bookmark and returns immediately.'''
+        self._queue.put(BookmarkEvent(
+            name, song_id, album_id, position, time.time()))
+
+    def submit(self, func):
+        '''Queues a call of `func` with the database as its argument.'''
+        self._queue.put(func)
+
+    def stop(self):
+        '''Writes all the queued events and waits for the thread to exit.'''
+        self._queue.put(_STOP)
+        self.join()
+
+    def _collect(self):
+        '''
+        Returns a batch of queued items and whether to stop afterwards.
+
+        Blocks until the first item arrives and then collects the items
+        arriving within the coalescing window.
+        '''
+        item = self._queue.get()
+        if item is _STOP:
+            return [], True
+        batch, deadline = [item], time.time() + self.window
+        while True:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except Queue.Empty:
+                return batch, False
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+
+    def _write_items(self, db, items):
+        '''Writes items in a single transaction.'''
+        with db.transaction():
+            for item in items:
+                if isinstance(item, BookmarkEvent):
+                    bookmark_id = db.add_bookmark(*item)
+                    self._log(
+                        'Added bookmark of type: "%s" with ID %d at: %s' % (
+                            item.name, bookmark_id, item.position))
+                else:
+                    item(db)
+
+    def _commit(self, db, items):
+        if not items:
+            return
+        try:
+            self._write_items(db, items)
+        except Exception as e:
+            if len(items) == 1:
+                self._log(
+                    'Failed to write %r: %s' % (items[0], e), error=True)
+            else:
+                # Do not let one failing item lose the others.
+                for item in items:
+                    self._commit(db, [item])
+
+    def _write(self, db, batch):
+        '''
+        Writes a batch, the bookmarks between other items in one
+        transaction.
+
+        The bookmarks before another item are committed first and the item
+        gets a transaction of its own, so that the write lock is not held
+        while it makes JSON-RPC calls or reads files.
+        '''
+        pending = collections.OrderedDict()
+        for item in batch:
+            if isinstance(item, BookmarkEvent):
+                key = item.name, item.song_id, item.album_id
+                pending.pop(key, None)
+                pending[key] = item
+            else:
+                # Keep the order of bookmarks and other writes.
+                self._commit(db, list(pending.values()))
+                pending.clear()
+                self._commit(db, [item])
+        self._commit(db, list(pending.values()))
+
+    def run(self):
+        db = self._open_db().open()
+        try:
+            stop = False
+            while not stop:
+                batch, stop = self._collect()
+                self._write(db, batch)
+        finally:
+            db.close()
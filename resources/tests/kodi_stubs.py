@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+'''
+Minimal stand-ins for the Kodi Python modules.
+
+They only implement what the addon uses and record the calls made into
+Kodi, so that tests and benchmarks can count JSON-RPC round-trips and
+other expensive calls without a running Kodi instance.
+'''
+
+import collections
+import json
+import sys
+import types
+
+LOGDEBUG, LOGINFO, LOGNOTICE, LOGWARNING, LOGERROR = range(5)
+PLAYLIST_MUSIC = 0
+
+rpc_handlers = {}
+rpc_calls = []
+settings = {}
+calls = collections.Counter()
+# Ordered playlist, player and builtin function calls.
+events = []
+directory = []
+# Kodi has a single music playlist.
+playlist = []
+# What the player is playing: 'file', 'time', 'comment' and 'type' ('audio'
+# if not set).
+player = {}
+# Values of xbmc.getInfoLabel.
+info_labels = {}
+# Answers of the next Dialog.input, Dialog.select and Dialog.browse calls.
+dialog_answers = []
+
+
+def reset():
+    '''Forgets all the registered handlers, settings and recorded calls.'''
+    rpc_handlers.clear()
+    del rpc_calls[:]
+    settings.clear()
+    calls.clear()
+    del events[:]
+    del directory[:]
+    del playlist[:]
+    player.clear()
+    del dialog_answers[:]
+    info_labels.clear()
+
+
+def _respond(payload):
+    handler = rpc_handlers.get(payload['method'])
+    result = handler(**payload.get('params', {})) if handler else {}
+    return {
+        'jsonrpc': '2.0',
+        'id': payload['id'],
+        'result': result,
+    }
+
+
+def executeJSONRPC(request):
+    '''Answers single and batched calls with the registered handlers.'''
+    rpc_calls.append(request)
+    payload = json.loads(request)
+    if isinstance(payload, list):
+        return json.dumps([_respond(p) for p in payload])
+    return json.dumps(_respond(payload))
+
+
+def log(msg, level=LOGDEBUG):
+    calls['log'] += 1
+
+
+def translatePath(path):
+    return path.encode('utf-8')
+
+
+def getInfoLabel(label):
+    return info_labels.get(label, '')
+
+
+def executebuiltin(function):
+    calls['executebuiltin'] += 1
+    events.append(('executebuiltin', function))
+
+
+class PlayList(object):
+
+    def __init__(self, playlist_id):
+        self.items = playlist
+
+    def clear(self):
+        del self.items[:]
+
+    def add(self, url, listitem=None, index=-1):
+        calls['PlayList.add'] += 1
+        events.append(('PlayList.add', url))
+        if index < 0:
+            self.items.append((url, listitem))
+        else:
+            self.items.insert(index, (url, listitem))
+
+    def size(self):
+        return len(self.items)
+
+
+class MusicInfoTag(object):
+
+    def __init__(self, comment):
+        self._comment = comment
+
+    def getComment(self):
+        return self._comment
+
+
+class Player(object):
+
+    def play(self, item=None, listitem=None, windowed=False, startpos=-1):
+        calls['Player.play'] += 1
+        events.append(('Player.play', startpos))
+
+    def isPlaying(self):
+        return 'file' in player
+
+    def isPlayingAudio(self):
+        return 'file' in player and player.get('type', 'audio') == 'audio'
+
+    def _playing(self, key):
+        if 'file' not in player:
+            raise RuntimeError('Kodi is not playing any media file')
+        return player[key]
+
+    def getPlayingFile(self):
+        return self._playing('file')
+
+    def getTime(self):
+        return self._playing('time')
+
+    def getMusicInfoTag(self):
+        self._playing('file')
+        return MusicInfoTag(player.get('comment', ''))
+
+
+class Monitor(object):
+
+    def abortRequested(self):
+        return False
+
+    def waitForAbort(self, timeout=0):
+        return False
+
+
+class Addon(object):
+
+    def __init__(self, id=None):
+        self._id = id
+
+    def getSetting(self, setting_id):
+        return settings.get(setting_id, '')
+
+    def getLocalizedString(self, string_id):
+        return 'string-%d' % string_id
+
+    def getAddonInfo(self, info_id):
+        return self._id or 'plugin.audio.ausis'
+
+
+class ListItem(object):
+
+    def __init__(self, label='', label2='', iconImage='', thumbnailImage='',
+                 path=''):
+        calls['ListItem'] += 1
+        self.label = label
+        self.label2 = label2
+        self.art = {}
+        self.info = {}
+        self.properties = {}
+        self.context_menu = []
+
+    def setArt(self, values):
+        calls['ListItem.setArt'] += 1
+        self.art.update(values)
+
+    def setInfo(self, type, infoLabels):
+        calls['ListItem.setInfo'] += 1
+        self.info.update(infoLabels)
+
+    def setProperty(self, key, value):
+        self.properties[key] = value
+
+    def addContextMenuItems(self, items, replaceItems=False):
+        calls['ListItem.addContextMenuItems'] += 1
+        self.context_menu.extend(items)
+
+
+class Dialog(object):
+
+    def yesno(self, heading, line1='', line2='', line3='', nolabel='',
+              yeslabel=''):
+        return True
+
+    def input(self, heading, defaultt='', type=0, option=0, autoclose=0):
+        return dialog_answers.pop(0) if dialog_answers else ''
+
+    def select(self, heading, list, autoclose=0, preselect=-1,
+               useDetails=False):
+        return dialog_answers.pop(0) if dialog_answers else -1
+
+    def browse(self, type, heading, shares, mask='', useThumbs=False,
+               treatAsFolder=False, defaultt='', enableMultiple=False):
+        answer = dialog_answers.pop(0) if dialog_answers else defaultt
+        return answer.encode('utf-8')
+
+    def notification(self, heading, message, icon='', time=5000,
+                     sound=True):
+        events.append(('notification', message))
+
+
+def addDirectoryItem(handle, url, listitem, isFolder=False, totalItems=0):
+    calls['addDirectoryItem'] += 1
+    directory.append((url, listitem, isFolder))
+    return True
+
+
+def addDirectoryItems(handle, items, totalItems=0):
+    calls['addDirectoryItems'] += 1
+    directory.extend(items)
+    return True
+
+
+def endOfDirectory(handle, succeeded=True, updateListing=False,
+                   cacheToDisc=True):
+    calls['endOfDirectory'] += 1
+    if not succeeded:
+        calls['failedDirectory'] += 1
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(str(name))
+    module.__dict__.update(attrs)
+    return module
+
+
+def install():
+    '''Registers the stub modules in :data:`sys.modules`.'''
+    sys.modules.update({
+        'xbmc': _module(
+            'xbmc',
+            LOGDEBUG=LOGDEBUG,
+            LOGINFO=LOGINFO,
+            LOGNOTICE=LOGNOTICE,
+            LOGWARNING=LOGWARNING,
+            LOGERROR=LOGERROR,
+            PLAYLIST_MUSIC=PLAYLIST_MUSIC,
+            PlayList=PlayList,
+            Player=Player,
+            Monitor=Monitor,
+            executeJSONRPC=executeJSONRPC,
+            executebuiltin=executebuiltin,
+            getInfoLabel=getInfoLabel,
+            log=log,
+            translatePath=translatePath,
+        ),
+        'xbmcaddon': _module('xbmcaddon', Addon=Addon),
+        'xbmcgui': _module('xbmcgui', ListItem=ListItem, Dialog=Dialog),
+        'xbmcplugin': _module(
+            'xbmcplugin',
+            addDirectoryItem=addDirectoryItem,
+            addDirectoryItems=addDirectoryItems,
+            endOfDirectory=endOfDirectory,
+        ),
+    })
@@ -0,0 +1,545 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import pytest
+
+from lib import tracks
+
+from . import kodi_stubs
+
+kodi_stubs.install()
+
+import addon  # noqa: E402
+from resources.lib import transfer  # noqa: E402
+from resources.lib.db import AusisDatabase  # noqa: E402
+
+
+def albums_handler(count):
+    '''Answers AudioLibrary.GetAlbumDetails for albums 1 to `count`.'''
+    def handler(albumid=None, properties=None, **kwargs):
+        if not 1 <= albumid <= count:
+            return {}
+        return {
+            'albumdetails': {
+                'albumid': albumid,
+                'title': 'Album %d' % albumid,
+                'artist': ['Artist %d' % albumid],
+            },
+        }
+    return handler
+
+
+def rpc_count(method=None):
+    return len([
+        c for c in kodi_stubs.rpc_calls
+        if method is None or '"%s"' % method in c
+    ])
+
+
+def main_entries():
+    '''Directory items except the search item of the main listing.'''
+    return [
+        item for item in kodi_stubs.directory
+        if 'mode=search' not in item[0]
+    ]
+
+
+def page_length(count):
+    '''Number of directory items on the first page of `count` rows.'''
+    page_size = addon.DEFAULT_PAGE_SIZE
+    return min(count, page_size) + (count > page_size)
+
+
+@pytest.yield_fixture
+def plugin():
+    kodi_stubs.reset()
+    with AusisDatabase(':memory:') as db:
+        yield addon.Ausis(
+            'plugin://plugin.audio.ausis/', 1,
+            kodi_stubs.Addon('plugin.audio.ausis'), lambda: db)
+
+
+@pytest.mark.parametrize('album_count', [1, 10, 100])
+def test_mode_main_rpc_count_is_constant(plugin, album_count):
+    kodi_stubs.rpc_handlers['AudioLibrary.GetAlbumDetails'] = albums_handler(
+        album_count)
+    for album_id in range(1, album_count + 1):
+        plugin.db.add_bookmark('started', album_id * 10, album_id, 1.0)
+
+    plugin.run({'mode': 'main'})
+
+    assert rpc_count() == 1
+    assert len(main_entries()) == page_length(album_count)
+
+
+def test_mode_main_skips_albums_missing_from_library(plugin):
+    kodi_stubs.rpc_handlers['AudioLibrary.GetAlbumDetails'] = albums_handler(1)
+    plugin.db.add_bookmark('started', 10, 1, 1.0)
+    plugin.db.add_bookmark('started', 20, 2, 1.0)
+
+    plugin.run({'mode': 'main'})
+
+    assert [li.label for _, li, _ in main_entries()] == ['Album 1']
+
+
+def songs_handler(count):
+    def handler(properties=None, filter=None, **kwargs):
+        return {
+            'songs': [{
+                'songid': song_id,
+                'title': 'Song %d' % song_id,
+                'album': 'Album %d' % filter['albumid'],
+            } for song_id in range(1, count + 1)],
+        }
+    return handler
+
+
+@pytest.mark.parametrize('bookmark_count', [1, 10, 1000])
+def test_mode_album_bookmarks_rpc_count_is_constant(plugin, bookmark_count):
+    song_count = 5
+    kodi_stubs.rpc_handlers['AudioLibrary.GetSongs'] = songs_handler(
+        song_count)
+    for i in range(bookmark_count):
+        plugin.db.add_bookmark('paused', i % song_count + 1, 1, float(i))
+
+    plugin.run({'mode': 'album_bookmarks', 'album_id': '1'})
+
+    assert rpc_count() == 1
+    assert rpc_count('AudioLibrary.GetSongs') == 1
+    assert len(kodi_stubs.directory) == page_length(
+        bookmark_count)
+
+
+def test_mode_album_bookmarks_without_bookmarks_makes_no_rpc(plugin):
+    plugin.run({'mode': 'album_bookmarks', 'album_id': '1'})
+
+    assert rpc_count() == 0
+
+
+def test_warm_mode_main_makes_no_rpc(plugin):
+    kodi_stubs.rpc_handlers['AudioLibrary.GetAlbumDetails'] = albums_handler(3)
+    for album_id in range(1, 4):
+        plugin.db.add_bookmark('started', album_id * 10, album_id, 1.0)
+
+    plugin.run({'mode': 'main'})
+    plugin.run({'mode': 'main'})
+
+    assert rpc_count() == 1
+    assert plugin.cache.stats['album_misses'] == 3
+    assert plugin.cache.stats['album_hits'] == 3
+    assert len(main_entries()) == 6
+
+
+def test_warm_mode_album_bookmarks_makes_no_rpc(plugin):
+    kodi_stubs.rpc_handlers['AudioLibrary.GetSongs'] = songs_handler(2)
+    plugin.db.add_bookmark('paused', 1, 1, 1.0)
+
+    plugin.run({'mode': 'album_bookmarks', 'album_id': '1'})
+    plugin.run({'mode': 'album_bookmarks', 'album_id': '1'})
+
+    assert rpc_count() == 1
+    assert plugin.cache.stats['song_misses'] == 1
+    assert plugin.cache.stats['song_hits'] == 1
+
+
+@pytest.mark.parametrize('method, data, cached', [
+    ('AudioLibrary.OnUpdate', '{"item": {"id": 1, "type": "song"}}', False),
+    ('AudioLibrary.OnUpdate', '{"id": 9, "type": "song"}', True),
+    ('AudioLibrary.OnRemove', '{"id": 1, "type": "album"}', False),
+    ('AudioLibrary.OnScanFinished', '', False),
+    ('Player.OnPlay', '{}', True),
+])
+def test_invalidate_cache(plugin, method, data, cached):
+    plugin.db.cache_album_songs(1, [{'songid': 1}])
+
+    addon.common.invalidate_cache(plugin.db, method, data)
+
+    assert (plugin.db.get_cached_album_songs(1, 60) is not None) == cached
+
+
+def test_mode_main_pages(plugin):
+    kodi_stubs.settings['page_size'] = '2'
+    kodi_stubs.rpc_handlers['AudioLibrary.GetAlbumDetails'] = albums_handler(5)
+    for album_id in range(1, 6):
+        plugin.db.add_bookmark(
+            'started', album_id, album_id, 1.0, date_added=album_id)
+
+    plugin.run({'mode': 'main', 'page': '1'})
+
+    labels = [li.label for _, li, _ in kodi_stubs.directory]
+    assert labels == ['Album 3', 'Album 2', 'string-30022']
+    assert 'page=2' in kodi_stubs.directory[-1][0]
+    assert plugin.cache.stats['album_misses'] == 2
+
+
+def test_mode_album_bookmarks_last_page_has_no_next_item(plugin):
+    kodi_stubs.settings['page_size'] = '2'
+    kodi_stubs.rpc_handlers['AudioLibrary.GetSongs'] = songs_handler(1)
+    for i in range(4):
+        plugin.db.add_bookmark('paused', 1, 1, float(i), date_added=i)
+
+    plugin.run({'mode': 'album_bookmarks', 'album_id': '1', 'page': '1'})
+
+    assert len(kodi_stubs.directory) == 2
+
+
+def test_listing_is_added_in_one_batch(plugin):
+    kodi_stubs.rpc_handlers['AudioLibrary.GetAlbumDetails'] = albums_handler(3)
+    for album_id in range(1, 4):
+        plugin.db.add_bookmark('started', album_id, album_id, 1.0)
+
+    plugin.run({'mode': 'main'})
+
+    assert kodi_stubs.calls['addDirectoryItems'] == 1
+    assert kodi_stubs.calls['addDirectoryItem'] == 0
+    assert len(main_entries()) == 3
+
+
+def resume_album(plugin, song_count, bookmarked_song_id):
+    songs = [{
+        'songid': song_id,
+        'file': '/books/%02d.mp3' % song_id,
+        'title': 'Song %d' % song_id,
+    } for song_id in range(song_count, 0, -1)]
+    kodi_stubs.rpc_handlers.update({
+        'AudioLibrary.GetSongs': lambda **kwargs: {'songs': songs},
+        'Playlist.Insert': lambda **kwargs: 'OK',
+    })
+    bookmark_id = plugin.db.add_bookmark(
+        'paused', bookmarked_song_id, 1, 12.5)
+    plugin.run({'mode': 'resume', 'bookmark_id': bookmark_id})
+
+
+def test_mode_resume_starts_playback_first(plugin):
+    resume_album(plugin, 5, 3)
+
+    assert kodi_stubs.events == [
+        ('PlayList.add', '/books/03.mp3'),
+        ('Player.play', 0),
+        ('PlayList.add', '/books/04.mp3'),
+        ('PlayList.add', '/books/05.mp3'),
+    ]
+    insert = [c for c in kodi_stubs.rpc_calls if 'Playlist.Insert' in c]
+    assert len(insert) == 1
+    assert '[{"songid": 1}, {"songid": 2}]' in insert[0]
+
+
+def test_mode_resume_sets_start_offset(plugin):
+    resume_album(plugin, 2, 1)
+
+    url, li = kodi_stubs.playlist[0]
+    assert url == '/books/01.mp3'
+    assert li.properties['StartOffset'] == '12.50'
+    assert not [c for c in kodi_stubs.rpc_calls if 'Playlist.Insert' in c]
+
+
+def test_mode_resume_song_split_from_one_file(plugin):
+    kodi_stubs.rpc_handlers.update({
+        'AudioLibrary.GetSongs': lambda **kwargs: {'songs': [{
+            'songid': song_id,
+            'file': '/books/book.flac',
+            'title': 'Part %d' % song_id,
+        } for song_id in (3, 1, 2)]},
+        'Playlist.Insert': lambda **kwargs: 'OK',
+    })
+    bookmark_id = plugin.db.add_bookmark('paused', 2, 1, 12.5)
+
+    plugin.run({'mode': 'resume', 'bookmark_id': bookmark_id})
+
+    assert [li.label for _, li in kodi_stubs.playlist] == ['Part 2', 'Part 3']
+    insert = [c for c in kodi_stubs.rpc_calls if 'Playlist.Insert' in c]
+    assert '[{"songid": 1}]' in insert[0]
+
+
+def test_mode_resume_with_stale_track_index(plugin):
+    plugin.db.cache_album_songs(1, [{
+        'songid': song_id,
+        'file': '/books/%02d.mp3' % song_id,
+        'title': 'Song %d' % song_id,
+    } for song_id in range(1, 6)])
+    # An index of the songs in another order.
+    plugin.db.store_track_index(1, tracks.TrackIndex.from_songs([
+        {'songid': song_id, 'file': '/old/%02d.mp3' % (9 - song_id)}
+        for song_id in range(1, 9)
+    ]).dump())
+    kodi_stubs.rpc_handlers['Playlist.Insert'] = lambda **kwargs: 'OK'
+    bookmark_id = plugin.db.add_bookmark('paused', 3, 1, 12.5)
+
+    plugin.run({'mode': 'resume', 'bookmark_id': bookmark_id})
+
+    assert rpc_count('AudioLibrary.GetSongs') == 0
+    assert kodi_stubs.playlist[0][0] == '/books/03.mp3'
+
+
+def test_mode_resume_missing_song_plays_album(plugin):
+    resume_album(plugin, 3, 9)
+
+    assert kodi_stubs.events[-1] == ('Player.play', -1)
+    assert kodi_stubs.calls['PlayList.add'] == 3
+
+
+def test_mode_main_shows_progress(plugin):
+    kodi_stubs.rpc_handlers['AudioLibrary.GetAlbumDetails'] = albums_handler(2)
+    plugin.db.store_track_index(1, tracks.TrackIndex.from_songs([
+        {'songid': 1, 'file': '01.mp3', 'duration': 100},
+        {'songid': 2, 'file': '02.mp3', 'duration': 300},
+    ]).dump())
+    plugin.db.add_bookmark('paused', 2, 1, 100.0, date_added=2)
+    plugin.db.add_bookmark('paused', 3, 2, 1.0, date_added=1)
+
+    plugin.run({'mode': 'main'})
+
+    assert rpc_count() == 1
+    assert [li.label2 for _, li, _ in main_entries()] == [
+        'string-30023', '']
+
+
+def test_modes_are_profiled(plugin, monkeypatch):
+    monkeypatch.setattr(addon.profiler, 'enabled', True)
+    addon.profiler.clear()
+
+    plugin.run({'mode': 'main'})
+
+    assert addon.profiler.stats['mode', 'main']['calls'] == 1
+    addon.profiler.clear()
+
+
+def test_database_is_opened_by_modes_which_use_it():
+    kodi_stubs.reset()
+
+    def open_db():
+        opened.append(True)
+        return AusisDatabase(':memory:').open()
+    opened = []
+    plugin = addon.Ausis(
+        'plugin://plugin.audio.ausis/', 1, kodi_stubs.Addon(), open_db)
+
+    with plugin:
+        plugin.run({'mode': 'unknown'})
+    assert not opened
+
+    with plugin:
+        plugin.run({'mode': 'main'})
+        plugin.run({'mode': 'main'})
+    assert opened == [True]
+
+
+def container_update_args():
+    '''Returns the plugin arguments of the last Container.Update call.'''
+    function = kodi_stubs.events[-1][1]
+    assert function.startswith('Container.Update(')
+    url = function[len('Container.Update('):-1].split(',')[0]
+    return addon.utils.parse_query(url.split('?', 1)[1].encode('ascii'))
+
+
+def test_mode_search_asks_for_query(plugin):
+    kodi_stubs.dialog_answers.append('hobbit')
+
+    plugin.run({'mode': 'search'})
+
+    assert kodi_stubs.calls['failedDirectory'] == 1
+    assert container_update_args() == {'mode': 'search', 'query': 'hobbit'}
+
+
+def test_mode_search_cancelled(plugin):
+    plugin.run({'mode': 'search'})
+
+    assert kodi_stubs.calls['failedDirectory'] == 1
+    assert kodi_stubs.events == []
+
+
+def test_mode_search_indexes_unlisted_albums(plugin):
+    kodi_stubs.rpc_handlers['AudioLibrary.GetAlbumDetails'] = albums_handler(
+        12)
+    kodi_stubs.rpc_handlers['AudioLibrary.GetSongs'] = songs_handler(1)
+    for album_id in range(1, 13):
+        plugin.db.add_bookmark('paused', album_id, album_id, 1.0)
+
+    plugin.run({'mode': 'search', 'query': 'album 1'})
+    plugin.run({'mode': 'search', 'query': 'album 2'})
+
+    # One batch of album details and one of songs.
+    assert rpc_count() == 2
+    labels = [li.label for _, li, _ in kodi_stubs.directory]
+    assert labels == [
+        'string-30028', 'Album 12', 'Album 11', 'Album 10', 'Album 1',
+        'string-30028', 'Album 2',
+    ]
+
+
+def test_mode_search_by_song_of_unlisted_album(plugin):
+    def handler(properties=None, filter=None, **kwargs):
+        return {'songs': [{
+            'songid': filter['albumid'] * 10,
+            'title': 'Chapter of book %d' % filter['albumid'],
+        }]}
+    kodi_stubs.rpc_handlers['AudioLibrary.GetAlbumDetails'] = albums_handler(
+        3)
+    kodi_stubs.rpc_handlers['AudioLibrary.GetSongs'] = handler
+    for album_id in range(1, 4):
+        plugin.db.add_bookmark('paused', album_id * 10, album_id, 1.0)
+
+    plugin.run({'mode': 'search', 'query': 'book 2', 'field': 'song'})
+
+    labels = [li.label for _, li, _ in kodi_stubs.directory]
+    assert labels == ['string-30028', 'Album 2']
+
+
+def test_mode_search_filter(plugin):
+    kodi_stubs.dialog_answers.extend([2, 2])
+
+    plugin.run({'mode': 'search_filter', 'query': 'tolkien'})
+
+    assert kodi_stubs.events[-1][1].endswith(',replace)')
+    assert container_update_args() == {
+        'mode': 'search', 'query': 'tolkien', 'field': 'artist',
+        'name': 'paused'}
+
+
+def library_songs_handler(files):
+    '''Answers AudioLibrary.GetSongs for all the songs of the library.'''
+    def handler(properties=None, **kwargs):
+        return {'songs': [{
+            'songid': song_id,
+            'albumid': album_id,
+            'file': path,
+        } for path, (song_id, album_id) in files.items()]}
+    return handler
+
+
+@pytest.mark.parametrize('fmt', transfer.FORMATS)
+def test_export_and_import_remap_songs_by_file(plugin, tmpdir, fmt):
+    kodi_stubs.rpc_handlers['AudioLibrary.GetSongs'] = library_songs_handler({
+        '/books/a.mp3': (1, 10),
+        '/books/b.mp3': (2, 10),
+    })
+    plugin.db.add_bookmark('paused', 1, 10, 5.0, date_added=100)
+    plugin.db.add_bookmark('stopped', 2, 10, 6.0, date_added=200)
+    plugin.db.add_bookmark('paused', 3, 30, 7.0, date_added=300)
+    kodi_stubs.dialog_answers.extend([
+        unicode(tmpdir), transfer.FORMATS.index(fmt)])
+
+    plugin.run({'mode': 'export'})
+
+    path = tmpdir.join(addon.EXPORT_FILE_NAME % fmt)
+    assert kodi_stubs.events[-1][0] == 'notification'
+
+    # The same files have other IDs in the library of another installation.
+    kodi_stubs.reset()
+    kodi_stubs.rpc_handlers['AudioLibrary.GetSongs'] = library_songs_handler({
+        '/books/a.mp3': (101, 110),
+        '/books/b.mp3': (102, 110),
+    })
+    kodi_stubs.dialog_answers.append(unicode(path))
+    with AusisDatabase(':memory:') as db:
+        other = addon.Ausis(
+            'plugin://plugin.audio.ausis/', 1,
+            kodi_stubs.Addon('plugin.audio.ausis'), lambda: db)
+        db.add_bookmark('paused', 101, 110, 5.0, date_added=100)
+
+        other.run({'mode': 'import'})
+
+        assert sorted(
+            (b.name, b.song_id, b.album_id, b.position, b.date_added)
+            for b in db.iter_all_bookmarks()
+        ) == [
+            ('paused', 101, 110, 5.0, 100),
+            ('stopped', 102, 110, 6.0, 200),
+        ]
+    assert kodi_stubs.events == [('notification', 'string-30040')]
+
+
+def test_import_malformed_file(plugin, tmpdir):
+    path = tmpdir.join('bookmarks.jsonl')
+    path.write(b'not json\n')
+    kodi_stubs.dialog_answers.append(unicode(path))
+
+    plugin.run({'mode': 'import'})
+
+    assert kodi_stubs.events == [('notification', 'string-30041')]
+    assert list(plugin.db.iter_all_bookmarks()) == []
+
+
+def test_export_to_unwritable_directory(plugin):
+    kodi_stubs.rpc_handlers['AudioLibrary.GetSongs'] = library_songs_handler(
+        {'/books/a.mp3': (1, 10)})
+    plugin.db.add_bookmark('paused', 1, 10, 5.0)
+    kodi_stubs.dialog_answers.extend(['smb://server/books/', 0])
+
+    plugin.run({'mode': 'export'})
+
+    assert kodi_stubs.events == [('notification', 'string-30044')]
+
+
+def test_export_cancelled(plugin):
+    plugin.run({'mode': 'export'})
+
+    assert kodi_stubs.rpc_calls == []
+    assert kodi_stubs.events == []
+
+
+@pytest.fixture
+def single_file_book(plugin, tmpdir):
+    '''An album of a single file with chapters in a cue sheet.'''
+    book = tmpdir.join('book.m4b')
+    book.write(b'\0' * 64, mode='wb')
+    tmpdir.join('book.cue').write(b'''\
+FILE "book.m4b" MP4
+  TRACK 01 AUDIO
+    TITLE "Prologue"
+    INDEX 01 00:00:00
+  TRACK 02 AUDIO
+    TITLE "The Road"
+    INDEX 01 02:00:00
+''', mode='wb')
+    kodi_stubs.rpc_handlers['AudioLibrary.GetSongs'] = lambda **kwargs: {
+        'songs': [{'songid': 1, 'file': unicode(book), 'title': 'Book'}]}
+    return plugin.db.add_bookmark('paused', 1, 1, 150.0)
+
+
+def test_mode_album_bookmarks_shows_chapters(
+        plugin, single_file_book, monkeypatch):
+    read_chapters = addon.chapters.read_chapters
+    reads = []
+    monkeypatch.setattr(
+        addon.chapters, 'read_chapters',
+        lambda path: reads.append(path) or read_chapters(path))
+    plugin.db.add_bookmark('started', 1, 1, 10.0)
+
+    plugin.run({'mode': 'album_bookmarks', 'album_id': '1'})
+    plugin.run({'mode': 'album_bookmarks', 'album_id': '1'})
+
+    assert [li.label for _, li, _ in kodi_stubs.directory[:2]] == [
+        '[string-30010] Book: Prologue (0:00:10)',
+        '[string-30011] Book: The Road (0:02:30)',
+    ]
+    assert len(reads) == 1
+
+
+def test_mode_album_bookmarks_looks_up_chapters_once_per_file(
+        plugin, single_file_book, monkeypatch):
+    get_chapters = addon.common.get_chapters
+    lookups = []
+    monkeypatch.setattr(
+        addon.common, 'get_chapters',
+        lambda db, path: lookups.append(path) or get_chapters(db, path))
+    for position in (10.0, 20.0, 30.0):
+        plugin.db.add_bookmark('seeked', 1, 1, position)
+
+    plugin.run({'mode': 'album_bookmarks', 'album_id': '1'})
+
+    assert len(kodi_stubs.directory) == 4
+    assert len(lookups) == 1
+
+
+@pytest.mark.parametrize('setting, offset', [
+    ('false', '150.00'),
+    ('true', '120.00'),
+])
+def test_mode_resume_to_chapter_start(
+        plugin, single_file_book, setting, offset):
+    kodi_stubs.settings['resume_chapter_start'] = setting
+
+    plugin.run({'mode': 'resume', 'bookmark_id': single_file_book})
+
+    assert kodi_stubs.playlist[0][1].properties['StartOffset'] == offset
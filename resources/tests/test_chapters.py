@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import struct
+
+import pytest
+
+from lib import chapters
+from lib.chapters import Chapter
+
+
+def box(kind, *children):
+    payload = b''.join(children)
+    return struct.pack(b'>I4s', 8 + len(payload), kind) + payload
+
+
+def full_box(kind, payload, version=0):
+    return box(kind, struct.pack(b'>B3x', version), payload)
+
+
+def chpl(titles, version=1):
+    entries = b''.join(
+        struct.pack(b'>QB', int(start * chapters.CHPL_TIMESCALE),
+                    len(title.encode('utf-8'))) + title.encode('utf-8')
+        for start, title in titles)
+    return full_box(
+        b'chpl',
+        (b'\0' * 4 if version else b'') +
+        struct.pack(b'>B', len(titles)) + entries,
+        version=version)
+
+
+def trak(track_id, *children):
+    return box(
+        b'trak',
+        full_box(b'tkhd', struct.pack(b'>III', 0, 0, track_id) + b'\0' * 72),
+        *children)
+
+
+def text_track(track_id, titles, timescale, mdat_offset):
+    '''
+    A chapter text track of (start, title) samples stored in two chunks
+    starting at `mdat_offset`. The first chapter has to start at 0.
+    '''
+    starts = [start for start, _ in titles]
+    durations = [b - a for a, b in zip(starts, starts[1:])] + [1.0]
+    samples = [
+        struct.pack(b'>H', len(title.encode('utf-8'))) + title.encode('utf-8')
+        for _, title in titles]
+    split = len(samples) // 2 or 1
+    chunk_offsets = [
+        mdat_offset, mdat_offset + sum(len(s) for s in samples[:split])]
+    stbl = box(
+        b'stbl',
+        full_box(b'stts', struct.pack(b'>I', len(titles)) + b''.join(
+            struct.pack(b'>II', 1, int(duration * timescale))
+            for duration in durations)),
+        full_box(b'stsc', struct.pack(
+            b'>7I', 2, 1, split, 1, 2, len(samples) - split, 1)),
+        full_box(b'stsz', struct.pack(b'>II', 0, len(samples)) + b''.join(
+            struct.pack(b'>I', len(s)) for s in samples)),
+        full_box(b'stco', struct.pack(b'>I', 2) + b''.join(
+            struct.pack(b'>I', o) for o in chunk_offsets)),
+    )
+    return trak(track_id, box(
+        b'mdia',
+        full_box(b'mdhd', struct.pack(b'>IIII', 0, 0, timescale, 0) +
+                 b'\0' * 4),
+        box(b'minf', stbl),
+    )), b''.join(samples)
+
+
+def mp4(titles=(), chpl_titles=None, timescale=1000):
+    '''Builds an MP4 file with a chapter track and/or a chpl atom.'''
+    ftyp = box(b'ftyp', b'M4B \0\0\0\0')
+
+    def build(mdat_offset):
+        traks = [trak(1, box(b'tref', box(b'chap', struct.pack(b'>I', 2))))]
+        samples = b''
+        if titles:
+            chapter_trak, samples = text_track(
+                2, titles, timescale, mdat_offset)
+            traks.append(chapter_trak)
+        udta = box(b'udta', chpl(chpl_titles)) if chpl_titles else b''
+        return box(b'moov', *(traks + [udta])), samples
+
+    moov, _ = build(0)
+    # The samples follow the headers of the mdat box after the moov box.
+    moov, samples = build(len(ftyp) + len(moov) + 8)
+    return ftyp + moov + box(b'mdat', samples, b'\0' * 1000)
+
+
+def test_chapter_track():
+    data = mp4([(0.0, 'Intro'), (61.5, 'Chapter 1'), (3600.0, 'Žodis')])
+
+    assert chapters.parse_mp4_chapters(data) == [
+        Chapter(0.0, 'Intro'), Chapter(61.5, 'Chapter 1'),
+        Chapter(3600.0, 'Žodis')]
+
+
+@pytest.mark.parametrize('version', [0, 1])
+def test_chpl_atom(version):
+    data = box(b'moov', box(b'udta', chpl(
+        [(0.0, 'One'), (90.25, 'Two')], version=version)))
+
+    assert chapters.parse_mp4_chapters(data) == [
+        Chapter(0.0, 'One'), Chapter(90.25, 'Two')]
+
+
+def test_chapter_track_is_preferred_over_chpl():
+    data = mp4([(0.0, 'Track')], chpl_titles=[(0.0, 'Nero')])
+
+    assert chapters.parse_mp4_chapters(data) == [Chapter(0.0, 'Track')]
+
+
+def patch_table(data, kind, offset, value):
+    '''Overwrites a 32-bit field of the first `kind` box of MP4 data.'''
+    start = data.index(kind) + 4 + offset
+    return data[:start] + struct.pack(b'>I', value) + data[start + 4:]
+
+
+def test_sample_counts_are_bounded():
+    titles = [(0.0, 'One'), (5.0, 'Two')]
+    data = mp4(titles)
+    # Samples of the first time-to-sample entry and of the chunks of the
+    # first sample-to-chunk run.
+    for kind, offset in ((b'stts', 8), (b'stsc', 12)):
+        huge = patch_table(data, kind, offset, 0xFFFFFFFF)
+        assert chapters.parse_mp4_chapters(huge) == [
+            Chapter(start, title) for start, title in titles]
+
+
+@pytest.mark.parametrize('sample_size', [0, 2])
+def test_too_many_samples(tmpdir, sample_size):
+    data = mp4([(0.0, 'One'), (5.0, 'Two')])
+    # The sample size and count of the sample size table.
+    data = patch_table(data, b'stsz', 4, sample_size)
+    data = patch_table(data, b'stsz', 8, 0xFFFFFFFF)
+    with pytest.raises(ValueError):
+        chapters.parse_mp4_chapters(data)
+
+    book = tmpdir.join('book.m4b')
+    book.write(data, mode='wb')
+    assert chapters.read_chapters(unicode(book)) == []
+
+
+def test_no_chapters():
+    assert chapters.parse_mp4_chapters(box(b'ftyp', b'M4A ')) == []
+    assert chapters.parse_mp4_chapters(mp4()) == []
+
+
+@pytest.mark.parametrize('data', [
+    box(b'moov', struct.pack(b'>I4s', 100, b'udta')),
+    struct.pack(b'>I4s', 4, b'moov'),
+    box(b'moov', box(b'udta', chpl([(0.0, 'One')])[:-3])),
+])
+def test_malformed_boxes(data):
+    with pytest.raises(ValueError):
+        chapters.parse_mp4_chapters(data)
+
+
+CUE = '''\
+REM GENRE Audiobook
+PERFORMER "Author"
+TITLE "Book"
+FILE "book.m4b" MP4
+  TRACK 01 AUDIO
+    TITLE "Prologue"
+    INDEX 01 00:00:00
+  TRACK 02 AUDIO
+    INDEX 00 01:59:00
+    INDEX 01 02:00:37
+  TRACK 03 AUDIO
+    TITLE "Pabaiga"
+    INDEX 01 125:00:00
+'''
+
+
+def test_parse_cue():
+    assert chapters.parse_cue(CUE) == [
+        Chapter(0.0, 'Prologue'),
+        Chapter(120.0 + 37 / 75.0, 'Track 02'),
+        Chapter(7500.0, 'Pabaiga'),
+    ]
+
+
+def test_parse_cue_of_several_files():
+    cue = CUE + '''\
+FILE "part 2.mp3" MP3
+  TRACK 04 AUDIO
+    TITLE "Part two"
+    INDEX 01 00:00:00
+'''
+    assert chapters.parse_cue(cue, 'Part 2.mp3') == [Chapter(0.0, 'Part two')]
+    assert len(chapters.parse_cue(cue, 'book.m4b')) == 3
+    assert chapters.parse_cue(cue, 'other.mp3') == []
+
+
+def test_read_chapters(tmpdir):
+    book = tmpdir.join('book.m4b')
+    book.write(mp4([(0.0, 'One'), (5.0, 'Two')]), mode='wb')
+    assert chapters.read_chapters(unicode(book)) == [
+        Chapter(0.0, 'One'), Chapter(5.0, 'Two')]
+
+    # A cue sheet takes precedence.
+    tmpdir.join('book.cue').write(CUE.encode('cp1252'), mode='wb')
+    assert len(chapters.read_chapters(unicode(book))) == 3
+
+    empty = tmpdir.join('empty.m4b')
+    empty.write(b'', mode='wb')
+    broken = tmpdir.join('broken.m4a')
+    broken.write(struct.pack(b'>I4s', 4, b'moov'), mode='wb')
+    for path in (empty, broken, tmpdir.join('missing.m4b'),
+                 tmpdir.join('song.mp3')):
+        assert chapters.read_chapters(unicode(path)) == []
+
+
+def test_chapter_at():
+    book = [Chapter(10.0, 'One'), Chapter(20.0, 'Two')]
+
+    assert chapters.chapter_at(book, 5.0) is None
+    assert chapters.chapter_at(book, 10.0) == 0
+    assert chapters.chapter_at(book, 19.9) == 0
+    assert chapters.chapter_at(book, 1000.0) == 1
+    assert chapters.chapter_at([], 1.0) is None
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+import pytest
+
+from . import kodi_stubs
+
+kodi_stubs.install()
+
+from resources.lib import common  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    kodi_stubs.reset()
+    kodi_stubs.rpc_handlers['AudioLibrary.GetAlbumDetails'] = (
+        lambda albumid, **kwargs: {'albumdetails': {'albumid': albumid}})
+    return common.JSONRPCClient()
+
+
+def test_call_extracts_result_path(client):
+    assert client.call(
+        'AudioLibrary.GetAlbumDetails', {'albumid': 1},
+        path=('albumdetails', 'albumid')) == 1
+    assert client.call(
+        'AudioLibrary.GetAlbumDetails', {'albumid': 1},
+        path=('songs',), default=[]) == []
+    assert client.call('JSONRPC.Ping')['result'] == {}
+
+
+def test_request_ids_increase(client):
+    client.call('JSONRPC.Ping')
+    client.batch([('JSONRPC.Ping', None), ('JSONRPC.Ping', None)])
+
+    ids = [request['id'] for request in json.loads(kodi_stubs.rpc_calls[1])]
+    assert [json.loads(kodi_stubs.rpc_calls[0])['id']] + ids == [1, 2, 3]
+
+
+def test_batch_is_one_round_trip_in_call_order(client, monkeypatch):
+    execute = kodi_stubs.executeJSONRPC
+    # Responses to batches may come in any order.
+    monkeypatch.setattr(
+        common.kodi, 'executeJSONRPC',
+        lambda request: json.dumps(json.loads(execute(request))[::-1]))
+
+    details = client.batch([
+        ('AudioLibrary.GetAlbumDetails', {'albumid': album_id})
+        for album_id in (3, 1, 2)
+    ], path=('albumdetails', 'albumid'))
+
+    assert details == [3, 1, 2]
+    assert len(kodi_stubs.rpc_calls) == 1
+    assert client.stats['AudioLibrary.GetAlbumDetails']['calls'] == 3
+
+
+def test_batch_is_split_into_bounded_requests(client):
+    client = common.JSONRPCClient(max_batch_size=2)
+
+    details = client.batch([
+        ('AudioLibrary.GetAlbumDetails', {'albumid': album_id})
+        for album_id in range(1, 6)
+    ], path=('albumdetails', 'albumid'))
+
+    assert details == [1, 2, 3, 4, 5]
+    assert [len(json.loads(c)) for c in kodi_stubs.rpc_calls] == [2, 2, 1]
+
+
+def test_errors_are_counted(client, monkeypatch):
+    monkeypatch.setattr(
+        common.kodi, 'executeJSONRPC',
+        lambda request: json.dumps({
+            'id': json.loads(request)['id'],
+            'jsonrpc': '2.0',
+            'error': {'code': -32602, 'message': 'Invalid params.'},
+        }))
+
+    assert client.call(
+        'AudioLibrary.GetAlbumDetails', {'albumid': 1},
+        path=('albumdetails',)) is None
+    assert client.stats['AudioLibrary.GetAlbumDetails']['errors'] == 1
+
+
+def test_log_stats(client):
+    client.call('JSONRPC.Ping')
+    client.call('AudioLibrary.GetAlbumDetails', {'albumid': 1})
+    messages = []
+
+    client.log_stats(messages.append)
+
+    assert len(messages) == 2
+    assert all('1 calls' in message for message in messages)
+
+
+@pytest.mark.parametrize('user, profile_name, expected', [
+    ('', '', None),
+    ('', 'Kids', 'Kids'),
+    (' Jonas ', 'Kids', 'Jonas'),
+])
+def test_get_profile(user, profile_name, expected):
+    kodi_stubs.reset()
+    kodi_stubs.settings['user'] = user
+    kodi_stubs.info_labels['System.ProfileName'] = profile_name
+
+    assert common.get_profile(kodi_stubs.Addon()) == expected
+
+
+def test_get_profile_of_master_profile(monkeypatch):
+    kodi_stubs.reset()
+    kodi_stubs.info_labels['System.ProfileName'] = 'Master user'
+    monkeypatch.setattr(
+        common.kodi, 'translatePath', lambda path: b'/home/kodi/userdata')
+
+    assert common.get_profile(kodi_stubs.Addon()) is None
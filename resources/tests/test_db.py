@@ -1,16 +1,21 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import multiprocessing
+import os
+import re
+import shutil
 import tempfile
+import time
 
 import pytest
 
-from lib import db as database, utils
+from lib import db as database, tracks, utils
 
 BOOKMARK_DATA = [
-    database.Bookmark(None, 'started', 1, 2, 3.45, None),
-    database.Bookmark(None, 'paused', 2, 2, 6.78, None),
-    database.Bookmark(None, 'started', 3, 4, 7.89, None),
+    database.Bookmark(None, 'started', 1, 2, 3.45, None, 'default'),
+    database.Bookmark(None, 'paused', 2, 2, 6.78, None, 'default'),
+    database.Bookmark(None, 'started', 3, 4, 7.89, None, 'default'),
 ]
 
 
@@ -30,7 +35,7 @@ def table_exists(cr, table):
 
 
 class DummyDatabase(database.Database):
-    SCHEMA = 'CREATE TABLE IF NOT EXISTS test (value varchar);'
+    MIGRATIONS = ['CREATE TABLE IF NOT EXISTS test (value varchar);']
 
     def put_value(self, value):
         self.cr.execute(
@@ -42,6 +47,51 @@ class DummyDatabase(database.Database):
         return bool(utils.first_of(self.cr.fetchone()))
 
 
+# The schema databases were created with before migrations were introduced.
+LEGACY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS bookmark (
+    id         INTEGER      NOT NULL,
+    name       VARCHAR(255),
+    song_id    INTEGER      NOT NULL,
+    album_id   INTEGER      NOT NULL,
+    position   REAL         NOT NULL,
+    date_added INTEGER      DEFAULT 0,
+    PRIMARY KEY (id)
+);
+CREATE INDEX IF NOT EXISTS bookmark_name_idx
+                        ON bookmark(name);
+CREATE INDEX IF NOT EXISTS bookmark_song_idx
+                        ON bookmark(song_id);
+CREATE INDEX IF NOT EXISTS bookmark_album_idx
+                        ON bookmark(album_id);
+'''
+
+
+def index_exists(cr, index):
+    cr.execute('''
+    SELECT
+        COUNT(1)
+    FROM
+        sqlite_master
+    WHERE
+        type = 'index'
+    AND
+        name = :index
+    ;''', locals())
+    return bool(utils.first_of(cr.fetchone()))
+
+
+class CountingDatabase(DummyDatabase):
+    MIGRATIONS = [
+        'CREATE TABLE test (value varchar);',
+        'CREATE TABLE other (value varchar);',
+    ]
+
+    def _migrate(self, version, script):
+        self.migrated = getattr(self, 'migrated', []) + [version]
+        return super(CountingDatabase, self)._migrate(version, script)
+
+
 @pytest.fixture
 def one_bookmark():
     return BOOKMARK_DATA[0]
@@ -49,12 +99,12 @@ def one_bookmark():
 
 @pytest.fixture
 def one_bookmark_data():
-    return BOOKMARK_DATA[0][1:-1]
+    return BOOKMARK_DATA[0][1:5]
 
 
 @pytest.fixture
 def bookmarks_data():
-    return [b[1:-1] for b in BOOKMARK_DATA]
+    return [b[1:5] for b in BOOKMARK_DATA]
 
 
 @pytest.fixture
@@ -68,10 +118,16 @@ def ausis_mem_db():
 
 
 @pytest.yield_fixture
-def temp_db():
-    tmp_file = tempfile.NamedTemporaryFile()
-    yield DummyDatabase(tmp_file.name)
-    tmp_file.close()
+def temp_path():
+    # WAL mode creates files next to the database.
+    tmp_dir = tempfile.mkdtemp()
+    yield os.path.join(tmp_dir, 'test.db')
+    shutil.rmtree(tmp_dir)
+
+
+@pytest.fixture
+def temp_db(temp_path):
+    return DummyDatabase(temp_path)
 
 
 def test_initialize_initializes_schema(mem_db):
@@ -127,6 +183,52 @@ def test_get_albums(ausis_mem_db, bookmarks_data):
         assert len(db.get_albums()) == 2
 
 
+def test_get_albums_returns_latest_bookmark(ausis_mem_db):
+    with ausis_mem_db as db:
+        db.add_bookmark('paused', 1, 1, 1.0, date_added=1)
+        latest_id = db.add_bookmark('paused', 2, 1, 2.0, date_added=3)
+        db.add_bookmark('seeked', 1, 1, 3.0, date_added=2)
+        other_id = db.add_bookmark('paused', 3, 2, 1.0, date_added=2)
+
+        assert [b.id for b in db.get_albums()] == [latest_id, other_id]
+
+
+def query_plan(db, query, params=None):
+    return [row[-1] for row in db.cr.execute(
+        'EXPLAIN QUERY PLAN %s' % query, params or {}).fetchall()]
+
+
+def full_scans(plan):
+    return [
+        detail for detail in plan
+        if re.match(r'SCAN (TABLE )?(bookmark|latest)\b', detail)
+    ]
+
+
+def test_get_albums_query_plan(ausis_mem_db):
+    with ausis_mem_db as db:
+        plan = query_plan(db, database.SQL_LATEST_ALBUM_BOOKMARKS, {
+            'profile': database.DEFAULT_PROFILE,
+            'limit': -1,
+            'offset': 0,
+        })
+        assert not full_scans(plan)
+        assert any('bookmark_album_date_idx' in d for d in plan)
+
+
+def test_get_album_bookmarks_query_plan(ausis_mem_db):
+    with ausis_mem_db as db:
+        plan = query_plan(db, database.SQL_ALBUM_BOOKMARKS, {
+            'profile': database.DEFAULT_PROFILE,
+            'album_id': 1,
+            'limit': 10,
+            'offset': 10,
+        })
+        assert not full_scans(plan)
+        assert not [d for d in plan if 'TEMP B-TREE' in d]
+        assert any('bookmark_album_date_idx' in d for d in plan)
+
+
 def test_get_all_bookmarks(ausis_mem_db, bookmarks_data):
     with ausis_mem_db as db:
         for data in bookmarks_data:
@@ -156,3 +258,614 @@ def test_remove_album_bookmarks(ausis_mem_db, bookmarks_data):
         assert removed
         assert not db.get_album_bookmarks(remove_album_id)
         assert len(db.get_album_bookmarks(other_album_id)) == 1
+
+
+def test_cache_albums(ausis_mem_db):
+    with ausis_mem_db as db:
+        db.cache_albums({1: {'albumid': 1, 'title': 'A'}, 2: {}})
+        assert db.get_cached_albums([1, 2, 3], 60) == {
+            1: {'albumid': 1, 'title': 'A'},
+            2: {},
+        }
+
+
+def test_cached_albums_expire(ausis_mem_db):
+    with ausis_mem_db as db:
+        db.cache_albums({1: {'albumid': 1}})
+        assert not db.get_cached_albums([1], -1)
+
+
+def test_cache_album_songs(ausis_mem_db):
+    songs = [{'songid': 1, 'title': 'A'}, {'songid': 2, 'title': 'B'}]
+    with ausis_mem_db as db:
+        assert db.get_cached_album_songs(1, 60) is None
+        db.cache_album_songs(1, songs)
+        assert sorted(db.get_cached_album_songs(1, 60)) == sorted(songs)
+        db.cache_album_songs(2, [])
+        assert db.get_cached_album_songs(2, 60) == []
+
+
+def test_invalidate_song(ausis_mem_db):
+    with ausis_mem_db as db:
+        db.cache_albums({1: {'albumid': 1}})
+        db.cache_album_songs(1, [{'songid': 1}, {'songid': 2}])
+        db.invalidate_song(2)
+        assert db.get_cached_album_songs(1, 60) is None
+        assert db.get_cached_albums([1], 60)
+
+
+def test_invalidate_album(ausis_mem_db):
+    with ausis_mem_db as db:
+        db.cache_albums({1: {'albumid': 1}, 2: {'albumid': 2}})
+        db.cache_album_songs(1, [{'songid': 1}])
+        db.invalidate_album(1)
+        assert db.get_cached_album_songs(1, 60) is None
+        assert list(db.get_cached_albums([1, 2], 60)) == [2]
+
+
+def test_clear_cache(ausis_mem_db):
+    with ausis_mem_db as db:
+        db.cache_albums({1: {'albumid': 1}})
+        db.cache_album_songs(1, [{'songid': 1}])
+        db.clear_cache()
+        assert db.get_cached_album_songs(1, 60) is None
+        assert not db.get_cached_albums([1], 60)
+
+
+def test_transaction_commits_on_open_connection(temp_db):
+    db = temp_db.open()
+    with db.transaction():
+        db.put_value('Hello')
+    try:
+        with db.transaction():
+            db.put_value('World')
+            1 / 0
+    except ZeroDivisionError:
+        pass
+    db.close()
+
+    with temp_db as db:
+        assert db.has_value('Hello')
+        assert not db.has_value('World')
+
+
+def test_compact_bookmarks_keeps_latest_per_album_and_name(ausis_mem_db):
+    with ausis_mem_db as db:
+        for i in range(10):
+            db.add_bookmark('seeked', 1, 1, float(i), date_added=i)
+            db.add_bookmark('paused', 1, 1, float(i), date_added=i)
+        db.add_bookmark('seeked', 3, 2, 1.0, date_added=1)
+
+        removed, last = db.compact_bookmarks(3)
+
+        assert removed == 14
+        assert last is None
+        assert sorted(
+            (b.name, b.position) for b in db.get_album_bookmarks(1)) == [
+            ('paused', 7.0), ('paused', 8.0), ('paused', 9.0),
+            ('seeked', 7.0), ('seeked', 8.0), ('seeked', 9.0),
+        ]
+        assert len(db.get_album_bookmarks(2)) == 1
+
+
+def test_compact_bookmarks_keeps_latest_per_song(ausis_mem_db):
+    with ausis_mem_db as db:
+        db.add_bookmark('seeked', 1, 1, 1.0, date_added=1)
+        for i in range(2, 5):
+            db.add_bookmark('seeked', 2, 1, float(i), date_added=i)
+
+        db.compact_bookmarks(1)
+
+        assert sorted(
+            (b.song_id, b.position) for b in db.get_album_bookmarks(1)) == [
+            (1, 1.0), (2, 4.0),
+        ]
+
+
+def test_compact_bookmarks_incrementally(ausis_mem_db):
+    with ausis_mem_db as db:
+        for album_id in range(1, 6):
+            for i in range(3):
+                db.add_bookmark('paused', album_id, album_id, float(i),
+                                date_added=i)
+
+        passes, total, last = 0, 0, None
+        while True:
+            removed, last = db.compact_bookmarks(1, after=last, limit=2)
+            passes, total = passes + 1, total + removed
+            if last is None:
+                break
+
+        assert passes == 3
+        assert total == 10
+        assert len(db.get_all_bookmarks()) == 5
+
+
+def test_compaction_groups_query_plan(ausis_mem_db):
+    with ausis_mem_db as db:
+        plan = query_plan(db, database.SQL_COMPACTION_GROUPS, {
+            'profile': database.DEFAULT_PROFILE,
+            'album_id': 1,
+            'name': 'paused',
+            'limit': 50,
+        })
+        assert not full_scans(plan)
+        assert len([
+            d for d in plan
+            if d.startswith('SEARCH bookmark') and
+            'bookmark_album_name_date_idx' in d
+        ]) == 3
+
+
+def test_vacuum(temp_db):
+    with temp_db as db:
+        db.put_value('Hello')
+        db.vacuum()
+        assert db.has_value('Hello')
+
+
+def test_migrations_set_user_version(ausis_mem_db):
+    with ausis_mem_db as db:
+        assert db.version == len(database.SQL_MIGRATIONS)
+
+
+def test_up_to_date_database_is_not_migrated(temp_path):
+    with CountingDatabase(temp_path) as db:
+        assert db.migrated == [1, 2]
+    with CountingDatabase(temp_path) as db:
+        assert not hasattr(db, 'migrated')
+        assert db.version == 2
+
+
+def test_only_missing_migrations_are_applied(temp_path):
+    db = CountingDatabase(temp_path)
+    db.MIGRATIONS = CountingDatabase.MIGRATIONS[:1]
+    with db:
+        assert db.migrated == [1]
+    with CountingDatabase(temp_path) as db:
+        assert db.migrated == [2]
+        assert table_exists(db.cr, 'other')
+
+
+def test_failed_migration_is_rolled_back(temp_path):
+    db = DummyDatabase(temp_path)
+    db.MIGRATIONS = [
+        'CREATE TABLE test (value varchar);',
+        'CREATE TABLE other (value varchar); INSERT INTO missing VALUES (1);',
+    ]
+    with pytest.raises(database.sqlite3.OperationalError):
+        with db:
+            pass
+
+    db._connect()
+    assert db.version == 1
+    assert table_exists(db.cr, 'test')
+    assert not table_exists(db.cr, 'other')
+
+
+def test_migration_applied_by_another_connection_is_skipped(temp_path):
+    first, second = CountingDatabase(temp_path), CountingDatabase(temp_path)
+    first._connect()
+    second._connect()
+    # Both connections find the new database before either migrates it.
+    assert first.version == second.version == 0
+
+    first.initialize()
+    # The second connection goes on from the version it found.
+    for version, script in enumerate(second.MIGRATIONS, 1):
+        second._migrate(version, script)
+
+    assert second.version == 2
+    first.close()
+    second.close()
+
+
+def migrate(path, results):
+    try:
+        database.AusisDatabase(path).open().close()
+    except database.sqlite3.Error as e:
+        results.put(unicode(e))
+    else:
+        results.put(None)
+
+
+def test_concurrent_migrations(temp_path):
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=migrate, args=(temp_path, results))
+        for _ in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(30)
+
+    assert [results.get(timeout=1) for _ in processes] == [None] * 4
+    with database.AusisDatabase(temp_path) as db:
+        assert db.version == len(database.SQL_MIGRATIONS)
+
+
+def test_legacy_database_is_upgraded(temp_path):
+    conn = database.sqlite3.connect(temp_path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany('''
+INSERT INTO bookmark (name, song_id, album_id, position, date_added)
+     VALUES (?, ?, ?, ?, ?);''', [b[1:6] for b in BOOKMARK_DATA])
+    conn.commit()
+    conn.close()
+
+    with database.AusisDatabase(temp_path) as db:
+        assert db.version == len(database.SQL_MIGRATIONS)
+        assert len(db.get_all_bookmarks()) == len(BOOKMARK_DATA)
+        assert table_exists(db.cr, 'album_cache')
+        assert table_exists(db.cr, 'song_cache')
+        assert index_exists(db.cr, 'bookmark_album_date_idx')
+        assert not index_exists(db.cr, 'bookmark_album_idx')
+
+
+def test_wal_journal_mode(temp_path):
+    with database.AusisDatabase(temp_path) as db:
+        assert db.cr.execute('PRAGMA journal_mode;').fetchone()[0] == 'wal'
+        assert db.cr.execute('PRAGMA synchronous;').fetchone()[0] == 1
+
+
+def test_cache_size(temp_path):
+    with database.AusisDatabase(temp_path, cache_size=-4096) as db:
+        assert db.cr.execute('PRAGMA cache_size;').fetchone()[0] == -4096
+
+
+def run_concurrently(path, role, count, results):
+    errors, latencies = 0, []
+    db = database.AusisDatabase(path).open()
+    for i in range(count):
+        start = time.time()
+        try:
+            if role == 'writer':
+                with db.transaction():
+                    db.add_bookmark('seeked', i % 10, i % 3, float(i))
+            else:
+                db.get_albums()
+                db.get_album_bookmarks(1)
+        except database.sqlite3.OperationalError:
+            errors += 1
+        latencies.append(time.time() - start)
+    db.close()
+    results.put((role, errors, max(latencies)))
+
+
+def test_concurrent_reader_and_writer(temp_path):
+    # Create the schema before the processes start.
+    with database.AusisDatabase(temp_path):
+        pass
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=run_concurrently, args=(temp_path, role, 300, results))
+        for role in ('writer', 'reader')
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(30)
+
+    for _ in processes:
+        role, errors, max_latency = results.get(timeout=1)
+        assert errors == 0, '%s got "database is locked"' % role
+        assert max_latency < 1.0
+
+
+def test_iter_album_bookmarks_is_lazy(ausis_mem_db, bookmarks_data):
+    with ausis_mem_db as db:
+        for data in bookmarks_data:
+            db.add_bookmark(*data)
+        bookmarks = db.iter_album_bookmarks(2)
+        first = next(bookmarks)
+        # Other queries do not disturb the iteration.
+        db.get_bookmark(first.id)
+        assert [first] + list(bookmarks) == db.get_album_bookmarks(2)
+
+
+def test_get_latest_album_bookmark(ausis_mem_db):
+    with ausis_mem_db as db:
+        assert db.get_latest_album_bookmark(1) is None
+        db.add_bookmark('paused', 1, 1, 1.0, date_added=2)
+        latest_id = db.add_bookmark('paused', 2, 1, 2.0, date_added=3)
+        db.add_bookmark('seeked', 1, 1, 3.0, date_added=1)
+        assert db.get_latest_album_bookmark(1).id == latest_id
+
+
+def test_iter_albums_pages(ausis_mem_db):
+    with ausis_mem_db as db:
+        for album_id in range(1, 6):
+            db.add_bookmark('paused', 1, album_id, 1.0, date_added=album_id)
+
+        pages = [
+            [b.album_id for b in db.iter_albums(limit=2, offset=offset)]
+            for offset in (0, 2, 4)
+        ]
+        assert pages == [[5, 4], [3, 2], [1]]
+
+
+def test_iter_album_bookmarks_pages(ausis_mem_db):
+    with ausis_mem_db as db:
+        for i in range(5):
+            db.add_bookmark('paused', i, 1, float(i), date_added=i)
+
+        page = db.iter_album_bookmarks(1, limit=2, offset=1)
+        assert [b.position for b in page] == [3.0, 2.0]
+
+
+def test_track_index_is_invalidated_with_songs(ausis_mem_db):
+    data = {'song_ids': [1, 2]}
+    with ausis_mem_db as db:
+        assert db.get_track_index(1) is None
+        db.cache_album_songs(1, [{'songid': 1}, {'songid': 2}])
+        db.store_track_index(1, data)
+        db.store_track_index(2, data)
+        assert db.get_track_index(1) == data
+
+        db.invalidate_song(2)
+        assert db.get_track_index(1) is None
+        assert db.get_track_index(2) == data
+
+        db.store_track_index(1, data)
+        db.cache_album_songs(1, [{'songid': 1}])
+        assert db.get_track_index(1) is None
+
+        db.clear_cache()
+        assert db.get_track_index(2) is None
+
+
+def album_track_index(*durations):
+    return tracks.TrackIndex.from_songs([{
+        'songid': song_id,
+        'file': '%02d.mp3' % song_id,
+        'duration': duration,
+    } for song_id, duration in enumerate(durations, 1)]).dump()
+
+
+def test_album_progress(ausis_mem_db):
+    with ausis_mem_db as db:
+        db.add_bookmark('paused', 2, 1, 5.0, date_added=1)
+        assert db.get_albums_progress([1]) == {}
+
+        db.store_track_index(1, album_track_index(10, 20, 30))
+        assert db.get_albums_progress([1]) == {1: (15.0, 60)}
+
+        db.add_bookmark('paused', 3, 1, 1.0, date_added=3)
+        db.add_bookmark('paused', 1, 1, 1.0, date_added=2)
+        db.add_bookmark('paused', 9, 1, 1.0, date_added=4)
+        assert db.get_albums_progress([1, 2]) == {1: (31.0, 60)}
+
+        db.remove_album_bookmarks(1)
+        assert db.get_albums_progress([1]) == {}
+
+
+def test_checkpoint_is_updated_in_place(ausis_mem_db):
+    with ausis_mem_db as db:
+        db.add_bookmark('paused', 1, 1, 1.0, date_added=1)
+        first_id = db.add_bookmark(
+            database.CHECKPOINT, 1, 1, 5.0, date_added=2)
+        db.add_bookmark(database.CHECKPOINT, 2, 2, 5.0, date_added=2)
+        checkpoint_id = db.add_bookmark(
+            database.CHECKPOINT, 2, 1, 7.0, date_added=3)
+
+        assert checkpoint_id == first_id
+        assert db.get_bookmark(first_id) == database.Bookmark(
+            first_id, database.CHECKPOINT, 2, 1, 7.0, 3,
+            database.DEFAULT_PROFILE)
+        assert len(db.get_album_bookmarks(1)) == 2
+        assert db.get_latest_album_bookmark(1).id == first_id
+
+
+@pytest.fixture
+def search_db(ausis_mem_db):
+    with ausis_mem_db as db:
+        db.cache_albums({
+            1: {'title': 'The Hobbit', 'artist': ['J. R. R. Tolkien']},
+            2: {'title': 'Dune', 'artist': ['Frank Herbert']},
+            3: {'title': 'Žalias', 'artist': ['Tolkien Fan']},
+            4: {},
+        })
+        db.cache_album_songs(2, [
+            {'songid': 21, 'title': 'Chapter 1: The Desert'},
+        ])
+        for album_id, name in enumerate(
+                ['paused', 'stopped', 'paused', 'paused'], 1):
+            db.add_bookmark(
+                name, album_id * 10, album_id, 1.0, date_added=album_id)
+        yield db
+
+
+@pytest.mark.parametrize('kwargs, album_ids', [
+    ({'query': 'hobbit'}, [1]),
+    ({'query': '  THE   '}, [2, 1]),
+    ({'query': 'the', 'field': 'title'}, [1]),
+    ({'query': 'tolkien'}, [3, 1]),
+    ({'query': 'tolkien', 'field': 'title'}, []),
+    ({'query': 'žal'}, [3]),
+    ({'query': 'desert', 'field': 'song'}, [2]),
+    ({'query': 'du'}, [2]),
+    ({'query': 'tolkien', 'name': 'stopped'}, []),
+    ({'name': 'paused'}, [4, 3, 1]),
+    ({}, [4, 3, 2, 1]),
+    ({'query': 'nothing'}, []),
+])
+def test_iter_search(search_db, kwargs, album_ids):
+    results = search_db.iter_search(**kwargs)
+
+    assert [bookmark.album_id for bookmark in results] == album_ids
+
+
+def test_search_index_follows_cache(search_db):
+    search_db.cache_albums({1: {'title': 'Silmarillion'}})
+    assert not list(search_db.iter_search('hobbit'))
+    assert [b.album_id for b in search_db.iter_search('silma')] == [1]
+
+    search_db.invalidate_song(21)
+    assert not list(search_db.iter_search('desert'))
+
+    search_db.invalidate_album(2)
+    assert not list(search_db.iter_search('dune'))
+
+    search_db.clear_cache()
+    assert [b.album_id for b in search_db.iter_search('silma')] == [1]
+
+
+def test_get_unindexed_album_ids(search_db):
+    search_db.add_bookmark('paused', 50, 5, 1.0)
+    search_db.invalidate_album(2)
+
+    assert search_db.get_unindexed_album_ids() == [2, 5]
+    assert search_db.get_unindexed_album_ids(songs=True) == [1, 2, 3, 4, 5]
+
+
+def test_search_uses_trigram_index(search_db):
+    plan = query_plan(
+        search_db, database.SQL_SEARCH % database.SQL_SEARCH_TRIGRAM, {
+            'profile': database.DEFAULT_PROFILE, 'trigram': 'hob',
+            'text': 'hob', 'field': None, 'name': None, 'limit': -1,
+            'offset': 0})
+
+    assert any(detail.startswith('SEARCH search_trigram') for detail in plan)
+    assert not [
+        detail for detail in plan
+        if re.match(r'SCAN (TABLE )?search_', detail)
+    ]
+    assert not full_scans(plan)
+
+
+def test_profiles_are_partitioned(ausis_mem_db):
+    with ausis_mem_db as db:
+        db.add_bookmark('started', 1, 1, 1.0, date_added=1)
+        db.add_bookmark(database.CHECKPOINT, 1, 1, 2.0, date_added=2)
+        db.profile = 'kids'
+        db.add_bookmark('started', 1, 1, 5.0, date_added=3)
+        db.add_bookmark(database.CHECKPOINT, 1, 1, 6.0, date_added=4)
+        kids_only = db.add_bookmark('paused', 20, 2, 1.0, date_added=5)
+
+        assert [b.album_id for b in db.get_albums()] == [2, 1]
+        assert [b.position for b in db.get_album_bookmarks(1)] == [6.0, 5.0]
+
+        db.profile = None
+        assert [b.album_id for b in db.get_albums()] == [1]
+        assert [b.position for b in db.get_album_bookmarks(1)] == [2.0, 1.0]
+        assert db.get_bookmark(kids_only) is None
+
+        db.remove_album_bookmarks(1)
+        assert db.get_albums() == []
+        db.profile = 'kids'
+        assert len(db.get_album_bookmarks(1)) == 2
+
+
+def test_profile_switch(ausis_mem_db):
+    with ausis_mem_db as db:
+        db.add_bookmark('paused', 1, 1, 1.0)
+        db.profile = 'kids'
+        assert db.get_albums() == []
+        db.profile = None
+        assert db.profile == database.DEFAULT_PROFILE
+        assert len(db.get_albums()) == 1
+
+
+def test_album_progress_per_profile(ausis_mem_db):
+    with ausis_mem_db as db:
+        db.add_bookmark('paused', 2, 1, 30.0, date_added=1)
+        db.profile = 'kids'
+        db.add_bookmark('paused', 1, 1, 10.0, date_added=2)
+
+        db.store_track_index(1, album_track_index(100.0, 100.0))
+
+        assert db.get_albums_progress([1]) == {1: (10.0, 200.0)}
+        db.profile = None
+        assert db.get_albums_progress([1]) == {1: (130.0, 200.0)}
+
+
+def test_compact_bookmarks_of_all_profiles(ausis_mem_db):
+    with ausis_mem_db as db:
+        for profile in ('default', 'kids'):
+            db.profile = profile
+            for i in range(3):
+                db.add_bookmark('paused', i, 1, float(i), date_added=i)
+
+        passes, total, last = 0, 0, None
+        while True:
+            removed, last = db.compact_bookmarks(1, after=last, limit=1)
+            passes, total = passes + 1, total + removed
+            if last is None:
+                break
+
+        assert (passes, total) == (3, 0)
+        db.add_bookmark('paused', 0, 1, 9.0, date_added=9)
+        assert db.compact_bookmarks(1) == (1, None)
+        assert [b.position for b in db.get_album_bookmarks(1)] == [
+            9.0, 2.0, 1.0]
+
+
+def test_bookmarks_are_migrated_to_default_profile(temp_path):
+    old = database.AusisDatabase(temp_path)
+    old.MIGRATIONS = database.SQL_MIGRATIONS[:5]
+    with old:
+        old.cr.executemany('''
+INSERT INTO bookmark (name, song_id, album_id, position, date_added)
+     VALUES (?, ?, ?, ?, ?);''', [b[1:6] for b in BOOKMARK_DATA])
+        old.cr.execute('''
+INSERT INTO album_progress (album_id, position, duration)
+     VALUES (2, 6.78, 100.0);''')
+
+    with database.AusisDatabase(temp_path) as db:
+        assert {b.profile for b in db.get_all_bookmarks()} == {
+            database.DEFAULT_PROFILE}
+        assert len(db.get_all_bookmarks()) == len(BOOKMARK_DATA)
+        assert db.get_albums_progress([2]) == {2: (6.78, 100.0)}
+
+
+def test_duplicate_checkpoints_are_removed(temp_path):
+    old = database.AusisDatabase(temp_path)
+    old.MIGRATIONS = database.SQL_MIGRATIONS[:8]
+    with old:
+        old.cr.executemany('''
+INSERT INTO bookmark (name, song_id, album_id, position, date_added)
+     VALUES (?, ?, ?, ?, ?);''', [
+            ('checkpoint', 1, 1, 1.0, 100),
+            ('checkpoint', 2, 1, 2.0, 200),
+            ('checkpoint', 3, 2, 3.0, 100),
+            ('paused', 1, 1, 4.0, 50),
+        ])
+
+    with database.AusisDatabase(temp_path) as db:
+        assert sorted(
+            (b.name, b.song_id) for b in db.get_all_bookmarks()) == [
+            ('checkpoint', 2), ('checkpoint', 3), ('paused', 1)]
+
+
+def test_profile_leads_every_bookmark_index(ausis_mem_db):
+    with ausis_mem_db as db:
+        indexes = [name for name, in db.cr.execute('''
+SELECT name
+  FROM sqlite_master
+ WHERE type = 'index'
+   AND tbl_name = 'bookmark';''')]
+        assert indexes
+        for index in indexes:
+            columns = db.cr.execute(
+                'PRAGMA index_info(%s);' % index).fetchall()
+            assert columns[0][2] == 'profile'
+
+
+def test_chapter_cache(ausis_mem_db):
+    book = [database.chapters.Chapter(0.0, 'One'),
+            database.chapters.Chapter(60.5, 'Du')]
+    with ausis_mem_db as db:
+        assert db.get_cached_chapters('/books/a.m4b', 1.5) is None
+        db.cache_chapters('/books/a.m4b', 1.5, book)
+        db.cache_chapters('/books/b.mp3', 1.5, [])
+
+        assert db.get_cached_chapters('/books/a.m4b', 1.5) == book
+        assert db.get_cached_chapters('/books/b.mp3', 1.5) == []
+        # Modified since.
+        assert db.get_cached_chapters('/books/a.m4b', 2.0) is None
+
+        db.cache_chapters('/books/a.m4b', 2.0, book[:1])
+        assert db.get_cached_chapters('/books/a.m4b', 2.0) == book[:1]
+        assert db.get_cached_chapters('/books/a.m4b', 1.5) is None
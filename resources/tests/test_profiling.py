@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import pstats
+import shutil
+import tempfile
+
+import pytest
+
+from lib import db as database, profiling
+
+
+@pytest.yield_fixture
+def profiler():
+    profiling.profiler.clear()
+    profiling.profiler.enabled = True
+    yield profiling.profiler
+    profiling.profiler.enabled = False
+    profiling.profiler.clear()
+
+
+def test_disabled_profiler_collects_nothing():
+    profiler = profiling.Profiler()
+    with profiler.timed('mode', 'main'):
+        pass
+
+    assert not profiler.stats
+
+
+def test_timed_sections(profiler):
+    for _ in range(3):
+        with profiler.timed('event', 'paused'):
+            pass
+    messages = []
+    profiler.log_summary(messages.append)
+
+    assert profiler.stats['event', 'paused']['calls'] == 3
+    assert messages == [
+        'Profile event paused: 3 calls, %.1f ms' % (
+            profiler.stats['event', 'paused']['seconds'] * 1000)]
+
+
+def test_sql_queries_are_timed(profiler):
+    with database.AusisDatabase(':memory:') as db:
+        db.add_bookmark('paused', 1, 1, 1.0)
+        list(db.iter_albums())
+
+    names = [name for category, name in profiler.stats if category == 'sql']
+    assert any(name.startswith('CREATE TABLE') for name in names)
+    assert any(name.startswith('INSERT INTO bookmark') for name in names)
+    assert any(name.startswith('WITH RECURSIVE album') for name in names)
+
+
+def test_disabled_profiler_uses_plain_connections():
+    assert database.connection_factory() is database.sqlite3.Connection
+
+
+def test_call_profiled_dumps_profile(profiler):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'plugin-main.prof')
+        assert profiling.call_profiled(path, sum, [1, 2]) == 3
+        assert pstats.Stats(path).total_calls > 0
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import pytest
+
+from lib import search
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('  The   Hobbit ', 'the hobbit'),
+    ('ŽALIAS', 'žalias'),
+    (None, ''),
+])
+def test_normalize(text, expected):
+    assert search.normalize(text) == expected
+
+
+def test_trigrams():
+    assert search.trigrams('abcd') == {'abc', 'bcd'}
+    assert search.trigrams('ab') == set()
+
+
+def test_album_items():
+    assert search.album_items(1, {}) == []
+    assert search.album_items(1, {'title': 'Dune', 'artist': ['A', 'B']}) == [
+        (1, None, 'title', 'Dune'),
+        (1, None, 'artist', 'A, B'),
+    ]
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import pytest
+
+from . import kodi_stubs
+
+kodi_stubs.install()
+
+import service  # noqa: E402
+
+
+class RecordingWriter(object):
+
+    def __init__(self):
+        self.bookmarks = []
+        self.window = 1.0
+
+    def add_bookmark(self, name, song_id, album_id, position):
+        self.bookmarks.append((name, song_id, album_id, position))
+
+    def submit(self, func):
+        pass
+
+
+def rpc_count(method):
+    return len([c for c in kodi_stubs.rpc_calls if '"%s"' % method in c])
+
+
+def play(song_id, position=0.0):
+    kodi_stubs.player.update({
+        'file': '/books/%02d.mp3' % song_id,
+        'time': position,
+    })
+
+
+@pytest.fixture
+def player():
+    kodi_stubs.reset()
+    kodi_stubs.rpc_handlers.update({
+        'Player.GetActivePlayers': lambda: [
+            {'playerid': 0, 'type': 'audio'}],
+        'Player.GetItem': lambda playerid, properties: {'item': {
+            'id': int(kodi_stubs.player['file'][-6:-4]),
+            'albumid': 1,
+            'file': kodi_stubs.player['file'],
+        }},
+    })
+    return service.AudioBookPlayer(RecordingWriter())
+
+
+def test_events_reuse_current_item(player):
+    play(1)
+    player.onPlayBackStarted()
+    player.onAVStarted()
+    for position in range(5):
+        play(1, float(position))
+        player.onPlayBackSeek(position, 0)
+    player.onPlayBackPaused()
+    player.onPlayBackResumed()
+
+    assert rpc_count('Player.GetActivePlayers') == 1
+    assert rpc_count('Player.GetItem') == 1
+    assert len(player._writer.bookmarks) == 8
+
+
+def test_track_change_refreshes_current_item(player):
+    play(1, 10.0)
+    player.onPlayBackStarted()
+    play(2, 3.0)
+    player.onPlayBackPaused()
+
+    assert rpc_count('Player.GetActivePlayers') == 1
+    assert rpc_count('Player.GetItem') == 2
+    assert player._writer.bookmarks == [
+        ('started', 1, 1, 10.0),
+        ('paused', 2, 1, 3.0),
+    ]
+
+
+def test_stop_forgets_current_item(player):
+    play(1)
+    player.onPlayBackStarted()
+    kodi_stubs.player.clear()
+    player.onPlayBackStopped()
+    play(1)
+    player.onPlayBackStarted()
+
+    assert rpc_count('Player.GetActivePlayers') == 2
+    assert rpc_count('Player.GetItem') == 2
+
+
+def test_checkpoint_makes_no_rpc(player):
+    play(1, 1.0)
+    player.onPlayBackStarted()
+    calls = len(kodi_stubs.rpc_calls)
+    for position in (2.0, 3.0, 3.0):
+        play(1, position)
+        player.checkpoint()
+
+    assert len(kodi_stubs.rpc_calls) == calls
+    assert player._writer.bookmarks[1:] == [
+        ('checkpoint', 1, 1, 2.0),
+        ('checkpoint', 1, 1, 3.0),
+    ]
+
+
+def test_audiobook_directories_are_reloaded_on_settings_change(player):
+    kodi_stubs.settings['audiobook_directory_2'] = '/music'
+    monitor = service.AusisMonitor(
+        player._writer, on_settings_changed=player.load_settings)
+    monitor.onSettingsChanged()
+    play(1)
+    player.onPlayBackPaused()
+    kodi_stubs.settings['audiobook_directory_2'] = '/books'
+    monitor.onSettingsChanged()
+    player.onPlayBackPaused()
+
+    assert player._writer.bookmarks == [('paused', 1, 1, 0.0)]
+
+
+def test_settings_change_applies_intervals(player):
+    kodi_stubs.settings.update({
+        'checkpoint_interval': '5',
+        'write_delay': '0.5',
+    })
+
+    service.apply_settings(player, player._writer)
+
+    assert player.checkpoint_interval == 5
+    assert player._writer.window == 0.5
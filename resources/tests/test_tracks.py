@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import pytest
+
+from lib import tracks
+
+SONGS = [
+    {'songid': 30, 'file': '/book/02.mp3', 'duration': 200},
+    {'songid': 10, 'file': '/book/03.mp3', 'duration': 300},
+    {'songid': 20, 'file': '/book/01.mp3', 'duration': 100},
+]
+
+
+@pytest.fixture
+def index():
+    return tracks.TrackIndex.from_songs(SONGS)
+
+
+def test_tracks_are_in_file_order(index):
+    assert index.song_ids == [20, 30, 10]
+    assert index.offsets == [0, 100, 300, 600]
+    assert index.total_duration == 600
+    assert len(index) == 3
+
+
+@pytest.mark.parametrize('song_id, track', [
+    (20, 0),
+    (30, 1),
+    (10, 2),
+    (5, None),
+    (25, None),
+    (99, None),
+])
+def test_track_of(index, song_id, track):
+    assert index.track_of(song_id) == track
+
+
+def test_book_offset(index):
+    assert index.book_offset(10, 12.5) == 312.5
+    assert index.book_offset(5, 12.5) is None
+
+
+def test_empty_index():
+    index = tracks.TrackIndex.from_songs([])
+    assert index.track_of(10) is None
+    assert index.total_duration == 0
+
+
+def test_songs_of_one_file_are_in_id_order():
+    index = tracks.TrackIndex.from_songs([
+        {'songid': song_id, 'file': '/book/book.flac', 'duration': 100}
+        for song_id in (3, 1, 2)])
+    assert index.song_ids == [1, 2, 3]
+
+
+def test_dump_and_load(index):
+    loaded = tracks.TrackIndex.load(index.dump())
+    assert loaded.dump() == index.dump()
+    assert loaded.track_of(10) == 2
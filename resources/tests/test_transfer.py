@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import collections
+import io
+
+import pytest
+
+from lib import transfer
+from lib.db import AusisDatabase
+
+
+@pytest.yield_fixture
+def db():
+    with AusisDatabase(':memory:') as db:
+        yield db
+
+
+def rows(count):
+    return [{
+        'name': 'paused',
+        'file': '/books/Žalias/%02d.mp3' % i,
+        'song_id': i,
+        'album_id': 1,
+        'position': i + 0.25,
+        'date_added': 1000 + i,
+    } for i in range(1, count + 1)]
+
+
+@pytest.mark.parametrize('fmt', transfer.FORMATS)
+def test_round_trip(fmt):
+    f = io.BytesIO()
+
+    assert transfer.write_rows(rows(3), f, fmt) == 3
+
+    f.seek(0)
+    assert list(transfer.read_rows(f, fmt)) == rows(3)
+
+
+@pytest.mark.parametrize('fmt', transfer.FORMATS)
+def test_round_trip_without_file(fmt):
+    row = dict(rows(1)[0], file=None)
+    f = io.BytesIO()
+    transfer.write_rows([row], f, fmt)
+
+    f.seek(0)
+    read = list(transfer.read_rows(f, fmt))
+    assert read == [row]
+
+    # The IDs of a row without a file can not be mapped to this library.
+    stats = collections.Counter()
+    assert list(transfer.remap_rows(read, {None: (10, 20)}, stats)) == []
+    assert stats == {'unknown': 1}
+
+
+@pytest.mark.parametrize('fmt, data', [
+    ('jsonl', b'{"name": "paused"}\n'),
+    ('jsonl', b'[1, 2]\n'),
+    ('jsonl', b'not json\n'),
+    ('csv', b'name,song_id\npaused,1\n'),
+    ('csv', b'name,song_id,album_id,position,date_added\npaused,x,1,1,1\n'),
+])
+def test_read_malformed_rows(fmt, data):
+    with pytest.raises(ValueError):
+        list(transfer.read_rows(io.BytesIO(data), fmt))
+
+
+def test_export_rows(db):
+    db.add_bookmark('started', 1, 2, 3.5, date_added=100)
+
+    exported = list(transfer.export_rows(
+        db.iter_all_bookmarks(), {1: '/books/01.mp3'}))
+
+    assert exported == [{
+        'name': 'started',
+        'file': '/books/01.mp3',
+        'song_id': 1,
+        'album_id': 2,
+        'position': 3.5,
+        'date_added': 100,
+    }]
+
+
+def test_remap_rows():
+    stats = collections.Counter()
+    imported = rows(3)
+    imported[2]['file'] = None
+    songs_by_file = {imported[0]['file']: (10, 20)}
+
+    remapped = list(transfer.remap_rows(imported, songs_by_file, stats))
+
+    assert [(r['song_id'], r['album_id']) for r in remapped] == [(10, 20)]
+    assert stats == {'unknown': 2}
+
+
+def test_import_rows_skips_duplicates(db):
+    stats = collections.Counter()
+    transfer.import_rows(db, rows(5), stats, batch_size=2)
+    transfer.import_rows(db, rows(7), stats, batch_size=2)
+
+    assert stats == {'added': 7, 'duplicate': 5}
+    assert sorted(
+        (b.song_id, b.position) for b in db.iter_all_bookmarks()) == [
+        (i, i + 0.25) for i in range(1, 8)]
+
+
+def test_import_rows_keeps_one_checkpoint_per_album(db):
+    db.add_bookmark('checkpoint', 1, 1, 10.0, date_added=1000)
+    stats = collections.Counter()
+    checkpoints = [
+        dict(row, name='checkpoint', date_added=date_added)
+        for row, date_added in zip(rows(2), (500, 2000))]
+
+    transfer.import_rows(db, checkpoints, stats)
+    db.add_bookmark('checkpoint', 2, 1, 30.0, date_added=3000)
+
+    assert stats == {'added': 1, 'duplicate': 1}
+    assert [(b.name, b.song_id, b.position) for b in
+            db.iter_all_bookmarks()] == [('checkpoint', 2, 30.0)]
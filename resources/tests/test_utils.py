@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import os
+import shutil
+import tempfile
+
 import pytest
 
 from lib import utils
@@ -41,6 +45,91 @@ def test_encode_values(input, expected):
     ('/home/foo/ab/test/test.mp3', '/home/foo/ab', True),
     ('/home/foo/abc/test/test.mp3', '/home/foo/ab', False),
     ('zip:///home/foo/ab/test/test.zip', '/home/foo/ab', True),
+    ('smb://nas/books/a/test.mp3', 'smb://NAS/books/', True),
+    ('smb://nas/books/a/test.mp3', 'smb://other/books', False),
+    ('nfs://nas/books/a/test.mp3', 'smb://nas/books', False),
+    ('smb://nas/books/../music/test.mp3', 'smb://nas/books', False),
+    ('/books/a/test.mp3', 'nfs://nas/books', False),
 ])
 def test_in_directory(filename, directory, expected):
     assert utils.in_directory(filename, directory) == expected
+
+
+@pytest.yield_fixture
+def temp_dir():
+    path = tempfile.mkdtemp()
+    yield path
+    shutil.rmtree(path)
+
+
+def test_directory_filter_resolves_symlinks(temp_dir):
+    books = os.path.join(temp_dir, 'books')
+    link = os.path.join(temp_dir, 'link')
+    os.mkdir(books)
+    os.symlink(books, link)
+
+    directory_filter = utils.DirectoryFilter([link, 'smb://nas/books'])
+
+    assert directory_filter.matches(os.path.join(books, 'a', 'test.mp3'))
+    assert directory_filter.matches(os.path.join(link, 'test.mp3'))
+    assert directory_filter.matches('smb://nas/books/a/test.mp3')
+    assert not directory_filter.matches(os.path.join(temp_dir, 'test.mp3'))
+    assert not directory_filter.matches('nfs://nas/books/a/test.mp3')
+
+
+def test_directory_filter_memoizes_recent_files(monkeypatch):
+    directory_filter = utils.DirectoryFilter(['/books'], maxsize=2)
+    calls = []
+    split_path = utils.split_path
+
+    def counting_split_path(path):
+        calls.append(path)
+        return split_path(path)
+
+    monkeypatch.setattr(utils, 'split_path', counting_split_path)
+    for filename in ['/books/1.mp3', '/books/1.mp3', '/books/2.mp3',
+                     '/music/3.mp3', '/books/1.mp3']:
+        directory_filter.matches(filename)
+
+    assert calls == [
+        '/books/1.mp3', '/books/2.mp3', '/music/3.mp3', '/books/1.mp3']
+
+
+def test_empty_directory_filter_matches_everything():
+    directory_filter = utils.DirectoryFilter(['', ''])
+
+    assert not directory_filter
+    assert directory_filter.matches('/music/test.mp3')
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = utils.LRUCache(maxsize=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3
+
+    assert len(cache) == 2
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('b', 0) == 0
+
+
+@pytest.mark.parametrize('query', [
+    {'mode': 'main'},
+    {'album_id': 12},
+    {'q': 'A/B & C=D?'},
+    {u'name': u'Audioknygos ąčę'},
+    {'empty': ''},
+])
+def test_urlencode_matches_urllib(query):
+    import urllib
+    assert utils.urlencode(query) == urllib.urlencode(
+        utils.encode_values(query))
+
+
+def test_urlencode_round_trip():
+    query = {'mode': 'resume', 'bookmark_id': 3, 'title': u'Žalias ~ 100%'}
+
+    assert utils.parse_query(utils.urlencode(query).encode('ascii')) == {
+        'mode': 'resume', 'bookmark_id': '3', 'title': u'Žalias ~ 100%'}
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from lib import db as database
+from lib.writer import BookmarkWriter
+
+
+@pytest.yield_fixture
+def db_path():
+    # WAL mode creates files next to the database.
+    tmp_dir = tempfile.mkdtemp()
+    yield os.path.join(tmp_dir, 'test.db')
+    shutil.rmtree(tmp_dir)
+
+
+def start_writer(db_path, window):
+    writer = BookmarkWriter(
+        lambda: database.AusisDatabase(db_path), window=window)
+    writer.start()
+    return writer
+
+
+def test_writer_coalesces_same_event_on_same_song(db_path):
+    writer = start_writer(db_path, window=60)
+    for position in range(10):
+        writer.add_bookmark('seeked', 1, 1, float(position))
+    writer.add_bookmark('seeked', 2, 1, 5.0)
+    writer.add_bookmark('paused', 1, 1, 9.5)
+    writer.stop()
+
+    with database.AusisDatabase(db_path) as db:
+        bookmarks = db.get_all_bookmarks()
+    assert sorted((b.name, b.song_id, b.position) for b in bookmarks) == [
+        ('paused', 1, 9.5),
+        ('seeked', 1, 9.0),
+        ('seeked', 2, 5.0),
+    ]
+
+
+def test_writer_writes_queued_events_on_stop(db_path):
+    writer = start_writer(db_path, window=0)
+    for song_id in range(1, 101):
+        writer.add_bookmark('paused', song_id, 1, 1.0)
+    writer.stop()
+
+    with database.AusisDatabase(db_path) as db:
+        assert len(db.get_all_bookmarks()) == 100
+
+
+def test_writer_keeps_order_of_submitted_tasks(db_path):
+    writer = start_writer(db_path, window=60)
+    writer.add_bookmark('paused', 1, 1, 1.0)
+    writer.submit(lambda db: db.remove_album_bookmarks(1))
+    writer.add_bookmark('paused', 2, 1, 2.0)
+    writer.stop()
+
+    with database.AusisDatabase(db_path) as db:
+        assert [b.song_id for b in db.get_all_bookmarks()] == [2]
+
+
+def test_writer_survives_failing_task(db_path):
+    writer = start_writer(db_path, window=0)
+    writer.submit(lambda db: 1 / 0)
+    writer.add_bookmark('paused', 1, 1, 1.0)
+    writer.stop()
+
+    with database.AusisDatabase(db_path) as db:
+        assert len(db.get_all_bookmarks()) == 1
+
+
+def test_writer_commits_bookmarks_before_submitted_tasks(db_path):
+    seen = []
+
+    def task(db):
+        # The plugin can read and write while a task makes JSON-RPC calls.
+        with database.AusisDatabase(db_path, busy_timeout=0) as other:
+            seen.append([b.song_id for b in other.get_all_bookmarks()])
+            other.add_bookmark('paused', 2, 1, 2.0)
+
+    writer = start_writer(db_path, window=60)
+    writer.add_bookmark('paused', 1, 1, 1.0)
+    writer.submit(task)
+    writer.stop()
+
+    assert seen == [[1]]
+    with database.AusisDatabase(db_path) as db:
+        assert len(db.get_all_bookmarks()) == 2
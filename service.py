@@ -1,43 +1,118 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import functools
+import time
+
 import xbmc as kodi
 import xbmcaddon as kodiaddon
 
 from resources.lib import common, utils
 from resources.lib.db import (
     AusisDatabase,
+    CHECKPOINT,
     DB_FILE_NAME,
 )
+from resources.lib.profiling import profiler
+from resources.lib.writer import BookmarkWriter
 
 addon = kodiaddon.Addon(id='plugin.audio.ausis')
 DB_PATH = common.get_db_path(DB_FILE_NAME)
+# In seconds.
+DEFAULT_WRITE_DELAY = 1.0
+DEFAULT_BOOKMARK_RETENTION = 50
+DEFAULT_CHECKPOINT_INTERVAL = 30
+# Longest time the service loop sleeps, in seconds.
+SERVICE_INTERVAL = 10
+# Time between bookmark compaction passes in seconds.
+COMPACTION_INTERVAL = 24 * 60 * 60
+AUDIOBOOK_DIRECTORY_SETTINGS = (
+    'audiobook_directory',
+    'audiobook_directory_2',
+    'audiobook_directory_3',
+)
 
 
 def get_audio_player_id():
-    resp = common.json_rpc('Player.GetActivePlayers')
-    for player in resp.get('result', []):
+    players = common.rpc.call(
+        'Player.GetActivePlayers', path=(), default=[])
+    for player in players:
         if player.get('type') == 'audio':
             return player.get('playerid')
 
 
-def get_current_info():
-    player_id = get_audio_player_id()
-    if player_id is not None:
-        resp = common.json_rpc(
-            'Player.GetItem',
-            playerid=player_id,
-            properties=[
-                'albumid',
-                'file',
-            ],
-        )
-        return resp.get('result', {}).get('item', {})
+def get_current_info(player_id):
+    return common.rpc.call('Player.GetItem', {
+        'playerid': player_id,
+        'properties': [
+            'albumid',
+            'file',
+        ],
+    }, path=('item',), default={})
+
+
+def ensure_track_index(db, album_id):
+    '''
+    Builds the track index of an album if it is missing, so that the
+    album's progress is updated with its bookmarks.
+    '''
+    common.MetadataCache(
+        db,
+        common.get_cache_max_age(addon),
+        common.ALBUM_PROPERTIES,
+        common.SONG_PROPERTIES,
+    ).get_track_index(album_id)
 
 
 class AudioBookPlayer(kodi.Player):
     '''Customized player which stores bookmarks.'''
 
+    def __init__(self, writer):
+        super(AudioBookPlayer, self).__init__()
+        self._writer = writer
+        self._forget_current()
+        self.load_settings()
+
+    def load_settings(self):
+        self._audiobook_dirs = get_audiobook_filter()
+        # Read by the service loop on every pass.
+        self.checkpoint_interval = get_checkpoint_interval()
+
+    def _forget_current(self):
+        self._player_id = None
+        self._current = {}
+        self._current_file = None
+        self._last_checkpoint = None
+
+    def _get_current(self, refresh=False):
+        '''
+        Returns the currently playing item.
+
+        The active player and the item are looked up with JSON-RPC only
+        when playback starts or the playing file changes, other events
+        reuse them.
+        '''
+        try:
+            playing_file = self.getPlayingFile()
+        except RuntimeError:
+            playing_file = None
+        if not (refresh or (
+                playing_file and playing_file != self._current_file)):
+            return self._current
+
+        if self._player_id is None:
+            self._player_id = get_audio_player_id()
+        if self._player_id is None:
+            self._current = {}
+        else:
+            self._current = get_current_info(self._player_id)
+        # Retry with the next event if the item is not known yet, the
+        # audio player might not have been active either.
+        if not self._current:
+            self._player_id = None
+        self._current_file = playing_file if self._current else None
+        return self._current
+
     def _get_offset(self):
         try:
             info = self.getMusicInfoTag()
@@ -54,9 +129,6 @@ class AudioBookPlayer(kodi.Player):
         :class:`xbmcgui.ListItem` and use it to get the currently
         playing audiofile.
         '''
-
-        audiobook_dir = utils.decode_arg(
-            addon.getSetting('audiobook_directory'))
         try:
             position = self.getTime()
 
@@ -64,7 +136,7 @@ class AudioBookPlayer(kodi.Player):
             if name == 'started':
                 position = max(0.0, position)
 
-            current = get_current_info()
+            current = self._get_current(refresh=name == 'started')
             if not current:
                 return
             song_id, album_id, filename = map(
@@ -74,48 +146,206 @@ class AudioBookPlayer(kodi.Player):
             if not (song_id and album_id):
                 return
 
-            # File not from the audiobook directory.
-            if (audiobook_dir and filename and not
-                    utils.in_directory(filename, audiobook_dir)):
+            # File not from the audiobook directories.
+            if filename and not self._audiobook_dirs.matches(filename):
                 return
             offset = self._get_offset()
         except RuntimeError:
             kodi.log('Runtime error', level=kodi.LOGERROR)
         else:
-            with AusisDatabase(DB_PATH) as db:
-                bookmark_id = db.add_bookmark(
-                    name, song_id, album_id, offset + position)
-                kodi.log('Added bookmark of type: "%s" with ID %d at: %s' % (
-                    name, bookmark_id, offset + position))
+            if name == 'started':
+                self._writer.submit(
+                    lambda db: ensure_track_index(db, album_id))
+                if filename:
+                    # Read chapters now rather than when listing bookmarks.
+                    self._writer.submit(
+                        lambda db: common.get_chapters(db, filename))
+            elif name == CHECKPOINT:
+                # Nothing to save while paused.
+                checkpoint = song_id, album_id, offset + position
+                if checkpoint == self._last_checkpoint:
+                    return
+                self._last_checkpoint = checkpoint
+            self._writer.add_bookmark(
+                name, song_id, album_id, offset + position)
+
+    def checkpoint(self):
+        '''
+        Saves the current position as the album's checkpoint.
+
+        Uses the cached playing item, so no JSON-RPC calls are made unless
+        the track has changed.
+        '''
+        with profiler.timed('event', CHECKPOINT):
+            self._bookmark(CHECKPOINT)
 
     def onPlayBackStarted(self):
-        self._bookmark('started')
+        with profiler.timed('event', 'started'):
+            self._bookmark('started')
+
+    def onAVStarted(self):
+        with profiler.timed('event', 'av_started'):
+            self._get_current()
 
     def onPlayBackPaused(self):
-        self._bookmark('paused')
+        with profiler.timed('event', 'paused'):
+            self._bookmark('paused')
 
     def onPlayBackResumed(self):
-        self._bookmark('resumed')
+        with profiler.timed('event', 'resumed'):
+            self._bookmark('resumed')
 
     def onPlayBackSeek(self, time, seek_offset):
-        self._bookmark('seeked')
+        with profiler.timed('event', 'seeked'):
+            self._bookmark('seeked')
 
     def onPlayBackEnded(self):
-        self._bookmark('ended')
+        with profiler.timed('event', 'ended'):
+            self._bookmark('ended')
+        self._forget_current()
 
     def onPlayBackStopped(self):
-        self._bookmark('stopped')
+        with profiler.timed('event', 'stopped'):
+            self._bookmark('stopped')
+        self._forget_current()
+
+
+class AusisMonitor(kodi.Monitor):
+    '''Monitor which keeps the cached library metadata up to date.'''
+
+    def __init__(self, writer, on_settings_changed=None):
+        super(AusisMonitor, self).__init__()
+        self._writer = writer
+        self._on_settings_changed = on_settings_changed
+
+    def onSettingsChanged(self):
+        if self._on_settings_changed is not None:
+            self._on_settings_changed()
+
+    def onNotification(self, sender, method, data):
+        if not method.startswith('AudioLibrary.'):
+            return
+        with profiler.timed('event', method):
+            self._writer.submit(
+                lambda db: common.invalidate_cache(db, method, data))
+
+
+class BookmarkCompactor(object):
+    '''
+    Removes old bookmarks in small steps while nothing is playing.
+
+    Each call runs one step of the current compaction pass on the
+    writer's database. A new pass starts :data:`COMPACTION_INTERVAL`
+    seconds after the previous one has finished.
+    '''
+
+    def __init__(self):
+        self._after = None
+        self._removed = 0
+        self._next_pass = 0
+
+    def due(self):
+        return time.time() >= self._next_pass
+
+    def __call__(self, db):
+        keep = get_bookmark_retention()
+        if keep > 0:
+            removed, self._after = db.compact_bookmarks(
+                keep, after=self._after)
+            self._removed += removed
+            if self._after is not None:
+                return
+            kodi.log('Removed %d old bookmarks' % self._removed)
+            if (self._removed and
+                    addon.getSetting('vacuum_after_compaction') == 'true'):
+                db.vacuum()
+        self._removed = 0
+        self._next_pass = time.time() + COMPACTION_INTERVAL
+
+
+def log_writer(msg, error=False):
+    kodi.log(msg, level=kodi.LOGERROR if error else kodi.LOGDEBUG)
+
+
+def get_audiobook_filter():
+    return utils.DirectoryFilter(
+        utils.decode_arg(addon.getSetting(setting_id))
+        for setting_id in AUDIOBOOK_DIRECTORY_SETTINGS)
+
+
+def get_write_delay():
+    try:
+        return float(addon.getSetting('write_delay'))
+    except ValueError:
+        return DEFAULT_WRITE_DELAY
+
+
+def get_checkpoint_interval():
+    try:
+        return max(0, int(addon.getSetting('checkpoint_interval')))
+    except ValueError:
+        return DEFAULT_CHECKPOINT_INTERVAL
+
+
+def get_bookmark_retention():
+    try:
+        return int(addon.getSetting('bookmark_retention'))
+    except ValueError:
+        return DEFAULT_BOOKMARK_RETENTION
+
+
+def apply_settings(player, writer):
+    '''Applies changed settings to the player and the writer.'''
+    player.load_settings()
+    writer.window = get_write_delay()
+    # Bookmarks queued before the change are still written to the old
+    # profile.
+    profile = common.get_profile(addon)
+
+    def switch_profile(db):
+        db.profile = profile
+    writer.submit(switch_profile)
 
 
 def main():
-    monitor = kodi.Monitor()
-    player = AudioBookPlayer()  # noqa
+    # Profiles of the whole service would mix up its threads, so only the
+    # timing summary is logged.
+    common.setup_profiling(addon, 'service')
+    # The writer keeps a single connection open for the lifetime of the
+    # service, so that playback events do not pay for connecting and
+    # schema setup, and the player callbacks never wait for the database.
+    writer = BookmarkWriter(
+        lambda: AusisDatabase(DB_PATH, profile=common.get_profile(addon)),
+        window=get_write_delay(), log=log_writer)
+    writer.start()
+    player = AudioBookPlayer(writer)
+    monitor = AusisMonitor(writer, on_settings_changed=functools.partial(
+        apply_settings, player, writer))
+    compactor = BookmarkCompactor()
+    last_checkpoint = 0
 
     while not monitor.abortRequested():
-        if monitor.waitForAbort(10):
+        # The interval can be changed in the settings meanwhile.
+        checkpoint_interval = player.checkpoint_interval
+        if monitor.waitForAbort(
+                min(checkpoint_interval or SERVICE_INTERVAL,
+                    SERVICE_INTERVAL)):
             break
+        if player.isPlayingAudio():
+            if (checkpoint_interval and
+                    time.time() >= last_checkpoint + checkpoint_interval):
+                player.checkpoint()
+                last_checkpoint = time.time()
+        elif not player.isPlaying() and compactor.due():
+            writer.submit(compactor)
     del player
     del monitor
+    # Write the queued events before exiting.
+    writer.stop()
+    common.rpc.log_stats(kodi.log)
+    if profiler.enabled:
+        profiler.log_summary(
+            lambda msg: kodi.log(msg, level=kodi.LOGNOTICE))
 
 
 if __name__ == '__main__':